@@ -0,0 +1,86 @@
+"""Checks the peak memory of the annual summary stays flat as the number of
+WOfLs in the year grows when they're counted in batches
+(`WofsProcessor(time_batch=...)`), and that the batched summary is identical
+to the unbatched one.
+
+Each summary is computed in a fresh process, so its peak RSS isn't hidden by
+an earlier, larger run. Large arrays are always given back to the OS when
+freed (see `MALLOC_MMAP_THRESHOLD`), otherwise where glibc happens to reuse
+freed memory makes the peak vary from run to run by more than the tolerance.
+The check fails if the peak above the RSS before computing grows by more
+than `--tolerance` from the smallest number of WOfLs to the largest.
+
+    python benchmarks/batched_summary.py --n-times 50 --n-times 100 --n-times 200
+"""
+
+import os
+import resource
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import List
+
+import dask
+import numpy as np
+import psutil
+from typer import Exit, Option, run
+from typing_extensions import Annotated
+
+from dep_wofs.processors import WofsProcessor
+from fixtures import wofls
+
+# Allocations larger than this are mapped, and unmapped when freed, rather
+# than glibc's default of raising the threshold as large arrays are freed
+MALLOC_MMAP_THRESHOLD = 64 * 1024
+
+
+def summarize(n_times: int, size: int, time_batch: int | None) -> tuple[int, dict]:
+    """The growth of RSS while summarizing `n_times` WOfLs, in bytes, and the
+    summary as numpy arrays."""
+    daily = wofls(n_times=n_times, shape=(size, size))
+    processor = WofsProcessor(time_batch=time_batch)
+    before = psutil.Process().memory_info().rss
+    with dask.config.set(scheduler="threads"):
+        summary = processor.process(daily).compute()
+    # In kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak - before, {name: var.values for name, var in summary.items()}
+
+
+def in_fresh_process(*args) -> tuple[int, dict]:
+    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(summarize, *args).result()
+
+
+def main(
+    n_times: Annotated[List[int], Option()] = [50, 100, 200],
+    size: int = 3200,
+    time_batch: int = 10,
+    tolerance: float = 0.25,
+) -> None:
+    # Inherited by the processes the summaries run in
+    os.environ.setdefault("MALLOC_MMAP_THRESHOLD_", str(MALLOC_MMAP_THRESHOLD))
+    n_times = sorted(n_times)
+    peaks = []
+    for n in n_times:
+        growth, batched = in_fresh_process(n, size, time_batch)
+        unbatched_growth, unbatched = in_fresh_process(n, size, None)
+        for name, values in unbatched.items():
+            np.testing.assert_array_equal(batched[name], values)
+        peaks.append(growth)
+        print(
+            f"{n:>5} WOfLs: peak RSS growth {growth / 2**20:7.1f}MiB in batches "
+            f"of {time_batch}, {unbatched_growth / 2**20:7.1f}MiB unbatched"
+        )
+    print("Batched and unbatched summaries are identical")
+
+    if peaks[-1] > peaks[0] * (1 + tolerance):
+        print(
+            f"Peak memory grew by {peaks[-1] / peaks[0] - 1:.0%} from "
+            f"{n_times[0]} to {n_times[-1]} WOfLs in batches"
+        )
+        raise Exit(code=1)
+    print(f"Peak memory in batches is flat to within {tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,144 @@
+"""Checks an annual summary interrupted by SIGTERM resumes from its checkpoint
+to the same output as an uninterrupted run, and that a scene manifest
+resumes with the scenes recorded before the interruption. Also times
+flushing the checkpoint, which has to fit in the pod's termination grace
+period.
+
+The bucket is a moto mock, so nothing touches the network. Run from the root
+of the repository:
+
+    python benchmarks/checkpoints.py --n-times 60 --time-batch 10
+"""
+
+import os
+import signal
+import tempfile
+import time
+
+import dask
+import numpy as np
+from moto import mock_aws
+from typer import Exit, run
+
+from dep_wofs.accumulators import Accumulator
+from dep_wofs.checkpoints import AccumulatorCheckpoint, SceneManifest, checkpointing
+from dep_wofs.processors import IncrementalWofsProcessor, WofsProcessor
+from dep_wofs.storage import s3_client
+from fixtures import wofls
+
+BUCKET = "checkpoint-bucket"
+
+
+class Scene:
+    """Stands in for the STAC item of a WOfL."""
+
+    def __init__(self, time: np.datetime64):
+        self.id = f"wofl_{time}"
+        self.properties = dict(datetime=f"{time}Z")
+        self.assets = dict()
+
+
+class InterruptedCheckpoint(AccumulatorCheckpoint):
+    """Sends this process SIGTERM after `after` batches."""
+
+    def __init__(self, *args, after: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._after = after
+
+    def advance(self, until) -> None:
+        super().advance(until)
+        self._after -= 1
+        if self._after == 0:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+
+def summarize(daily, time_batch: int, checkpoint: AccumulatorCheckpoint):
+    """Summarize the WOfLs of `daily` which aren't in the checkpoint yet, as
+    `process_wofs_tile.py --checkpoint True` does."""
+    accumulator = checkpoint.load() or Accumulator()
+    times = [t for t in daily.time.values if Scene(t).id not in accumulator.items]
+    scenes = [Scene(t) for t in times]
+    checkpoint.start(accumulator, scenes)
+    remaining = daily.sel(time=times)
+    processor = IncrementalWofsProcessor(
+        accumulator, time_batch=time_batch, checkpoint=checkpoint
+    )
+    with checkpointing(checkpoint):
+        return processor.process(remaining).compute(), len(scenes)
+
+
+def main(n_times: int = 60, size: int = 3200, time_batch: int = 10) -> None:
+    failed = False
+    with mock_aws(), dask.config.set(scheduler="threads"):
+        client = s3_client()
+        client.create_bucket(Bucket=BUCKET)
+        daily = wofls(n_times=n_times, shape=(size, size))
+        expected = WofsProcessor().process(daily).compute()
+
+        # Interrupted halfway, then resumed
+        key = "summary_checkpoint.npz"
+        after = n_times // time_batch // 2
+        interrupted = InterruptedCheckpoint(
+            BUCKET, key, interval=float("inf"), client=client, after=after
+        )
+        start = time.perf_counter()
+        try:
+            summarize(daily, time_batch, interrupted)
+            print("The run wasn't interrupted")
+            failed = True
+        except SystemExit as e:
+            print(
+                f"Interrupted after {after} batches of {time_batch} (exit code "
+                f"{e.code}), {time.perf_counter() - start:.2f}s in"
+            )
+        flush_start = time.perf_counter()
+        interrupted.flush()
+        flush_seconds = time.perf_counter() - flush_start
+
+        resumed, n_resumed = summarize(
+            daily, time_batch, AccumulatorCheckpoint(BUCKET, key, client=client)
+        )
+        for name, var in expected.items():
+            if not np.array_equal(resumed[name].values, var.values, equal_nan=True):
+                print(f"{name} differs from the uninterrupted summary")
+                failed = True
+        print(
+            f"Resumed with {n_resumed} of {n_times} WOfLs left, output identical "
+            f"to an uninterrupted run: {not failed}. Flushing the checkpoint of "
+            f"a {size}x{size} tile took {flush_seconds:.2f}s"
+        )
+
+        # A manifest which was flushed by SIGTERM, and a retry on a new pod
+        with (
+            tempfile.TemporaryDirectory() as first,
+            tempfile.TemporaryDirectory() as retry,
+        ):
+            manifest = SceneManifest(
+                BUCKET, "scenes.jsonl", first, interval=float("inf"), client=client
+            )
+            try:
+                with checkpointing(manifest):
+                    manifest.add({"exists_0": "exists"})
+                    manifest.add({"scene_1": "complete", "scene_2": "skipped"})
+                    os.kill(os.getpid(), signal.SIGTERM)
+            except SystemExit:
+                pass
+            resumed_manifest = SceneManifest(
+                BUCKET, "scenes.jsonl", retry, client=client
+            )
+            if (
+                not resumed_manifest.resumed
+                or resumed_manifest.scenes != manifest.scenes
+            ):
+                print("The manifest didn't resume with the scenes recorded")
+                failed = True
+            else:
+                print(f"Manifest resumed with {len(resumed_manifest.scenes)} scenes")
+            resumed_manifest.delete()
+
+    if failed:
+        raise Exit(code=1)
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,54 @@
+"""Compares the native WOfL classifier in dep_wofs.classifier with the
+upstream `WOfSClassifier` path, checking the "water" bytes are identical.
+
+    python benchmarks/classify.py --n-times 4 --size 3200
+"""
+
+import time
+import tracemalloc
+
+import dask
+import numpy as np
+from typer import run
+
+from dep_wofs.processors import DepWOfSClassifier
+from fixtures import StaticDem, landsat_scenes, patch_upstream_scaling
+
+patch_upstream_scaling()
+
+
+def measure(name, classifier, scenes):
+    tracemalloc.start()
+    start = time.perf_counter()
+    wofls = classifier.compute(scenes).compute()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    pixels_per_second = scenes.qa_pixel.size / elapsed
+    print(
+        f"{name:>8}: {elapsed:7.2f}s, {pixels_per_second / 1e6:6.1f}M pixels/s, "
+        f"peak {peak / 2**20:8.1f}MiB"
+    )
+    return wofls
+
+
+def main(n_times: int = 4, size: int = 3200, chunks: int = 4096) -> None:
+    scenes = landsat_scenes(n_times=n_times, shape=(size, size), chunks=chunks)
+    with dask.config.set(scheduler="threads"):
+        expected = measure(
+            "upstream",
+            DepWOfSClassifier(dem_cache=StaticDem(), dem_key="", native=False),
+            scenes,
+        )
+        actual = measure(
+            "native", DepWOfSClassifier(dem_cache=StaticDem(), dem_key=""), scenes
+        )
+
+    assert actual.water.dtype == expected.water.dtype
+    np.testing.assert_array_equal(actual.water.values, expected.water.values)
+    print("Outputs are identical")
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,72 @@
+"""Checks `CubeSearcher` only opens the cubes of path/rows near a DEP tile
+which crosses the antimeridian.
+
+In EPSG:4326 the extent of such a tile runs from about -179.5 to 179.5
+unless it's split at 180, and then intersects every path/row at its
+latitude. For each tile in the DEP grid which crosses 180 this searches with
+a url function which records the path/rows it's asked for, and fails if any
+of them is more than `MAX_DEGREES` from the antimeridian. Run from the root
+of the repository:
+
+    python benchmarks/cube.py
+"""
+
+from odc.geo.geom import Geometry
+from typer import Exit, run
+
+from dep_tools.exceptions import EmptyCollectionError
+from dep_wofs.cube import CubeSearcher
+from dep_wofs.grid import dep_grid, landsat_grid
+
+# A path/row is about 2.5 degrees wide at the latitudes of the DEP grid
+MAX_DEGREES = 5
+
+
+def crosses_antimeridian(geometry: Geometry) -> bool:
+    return geometry.to_crs("EPSG:4326", wrapdateline=True).geom.geom_type == (
+        "MultiPolygon"
+    )
+
+
+def distance_from_antimeridian(geometry) -> float:
+    parts = getattr(geometry, "geoms", [geometry])
+    return max(min(180 - part.bounds[0], part.bounds[2] + 180) for part in parts)
+
+
+def main() -> None:
+    tiles = dep_grid()
+    tiles = tiles[[crosses_antimeridian(g.extent) for g in tiles.geobox]]
+    if len(tiles) == 0:
+        print("No tiles in the grid cross the antimeridian")
+        raise Exit(code=1)
+
+    path_rows = landsat_grid()
+    failed = False
+    for tile_id, geobox in tiles.geobox.items():
+        searched = []
+
+        def url(path_row, year):
+            searched.append(path_row)
+            # Nothing is there, so each cube is empty
+            return f"/nonexistent/{path_row[0]}/{path_row[1]}/{year}.zarr"
+
+        try:
+            CubeSearcher(url, "2020").search(geobox)
+        except EmptyCollectionError:
+            pass
+
+        far = [
+            path_row
+            for path_row in searched
+            if distance_from_antimeridian(path_rows.geometry[path_row]) > MAX_DEGREES
+        ]
+        print(f"{tile_id}: {len(searched)} path/rows, {len(far)} far away")
+        failed |= len(searched) == 0 or len(far) > 0
+
+    if failed:
+        raise Exit(code=1)
+    print("Only path/rows near the antimeridian are searched")
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,323 @@
+"""Synthetic inputs for the benchmarks. Nothing here touches the network."""
+
+from functools import partial
+
+import dask.array as da
+import numpy as np
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import wrap_xr, xr_coords
+import wofs.virtualproduct
+from xarray import DataArray, Dataset
+
+# A DEP tile is 96km on a side at 30m
+TILE_SHAPE = (3200, 3200)
+
+# WOfL values with rough real world frequencies: dry, wet, nodata, cloud,
+# cloud shadow, terrain shadow, high slope and combinations thereof
+_WOFL_VALUES = np.array([0, 128, 1, 64, 32, 8, 16, 96, 192], dtype="uint8")
+_WOFL_WEIGHTS = np.array([0.45, 0.1, 0.15, 0.15, 0.05, 0.03, 0.03, 0.02, 0.02])
+
+
+# Collection 2 QA_PIXEL values: clear, clear water, fill, cloud (with dilated
+# cloud and cirrus variants), cloud shadow and snow
+_QA_VALUES = np.array(
+    [21824, 21952, 1, 22280, 24088, 21826, 54596, 23888, 30048], dtype="uint16"
+)
+_QA_WEIGHTS = np.array([0.5, 0.15, 0.1, 0.08, 0.04, 0.04, 0.03, 0.04, 0.02])
+
+
+_SUMMARY_NODATA = -999
+
+
+def tile_geobox(shape: tuple[int, int] = TILE_SHAPE) -> GeoBox:
+    return GeoBox.from_bbox(
+        (0, 0, shape[1] * 30, shape[0] * 30), crs="EPSG:3832", resolution=30
+    )
+
+
+def wofls(
+    n_times: int = 100,
+    shape: tuple[int, int] = TILE_SHAPE,
+    chunks: int = 4096,
+    seed: int = 42,
+    geobox: GeoBox | None = None,
+) -> Dataset:
+    """A year of daily WOfLs on `geobox` or else a tile of `shape`, chunked
+    like `OdcLoader` output. The same arguments always give the same values."""
+    geobox = geobox if geobox is not None else tile_geobox(shape)
+
+    def block(block_info=None):
+        location = block_info[None]["chunk-location"]
+        rng = np.random.default_rng([seed, *location])
+        return rng.choice(
+            _WOFL_VALUES, size=block_info[None]["chunk-shape"], p=_WOFL_WEIGHTS
+        )
+
+    water = da.map_blocks(
+        block,
+        dtype="uint8",
+        chunks=da.core.normalize_chunks((1, chunks, chunks), (n_times, *geobox.shape)),
+    )
+
+    coords = dict(
+        time=np.datetime64("2020-01-01") + np.arange(n_times).astype("timedelta64[D]"),
+        **xr_coords(geobox),
+    )
+    return Dataset(dict(water=DataArray(water, coords=coords, dims=("time", "y", "x"))))
+
+
+def landsat_scenes(
+    n_times: int = 4,
+    shape: tuple[int, int] = TILE_SHAPE,
+    chunks: int = 4096,
+    seed: int = 42,
+    geobox: GeoBox | None = None,
+) -> Dataset:
+    """Collection 2 SR bands and qa_pixel, chunked like the WOfL loader output,
+    on `geobox` or else a tile of `shape`. Reflectance is drawn to cover both
+    water and land, with some nodata (0) and saturated values. The same
+    arguments always give the same values."""
+    geobox = geobox if geobox is not None else tile_geobox(shape)
+    block_chunks = da.core.normalize_chunks(
+        (1, chunks, chunks), (n_times, *geobox.shape)
+    )
+
+    def sr_block(band_index, block_info=None):
+        location = block_info[None]["chunk-location"]
+        rng = np.random.default_rng([seed, band_index, *location])
+        size = block_info[None]["chunk-shape"]
+        values = rng.integers(7000, 30000, size=size, dtype="uint16")
+        values[rng.random(size) < 0.02] = 0
+        values[rng.random(size) < 0.01] = 65535
+        return values
+
+    def qa_block(block_info=None):
+        location = block_info[None]["chunk-location"]
+        rng = np.random.default_rng([seed, len(bands), *location])
+        return rng.choice(
+            _QA_VALUES, size=block_info[None]["chunk-shape"], p=_QA_WEIGHTS
+        )
+
+    coords = dict(
+        time=np.datetime64("2020-01-01T22:00")
+        + np.arange(n_times).astype("timedelta64[D]"),
+        **xr_coords(geobox),
+    )
+    bands = ["blue", "green", "red", "nir08", "swir16", "swir22"]
+    data = {
+        band: DataArray(
+            da.map_blocks(partial(sr_block, i), dtype="uint16", chunks=block_chunks),
+            coords=coords,
+            dims=("time", "y", "x"),
+            attrs=dict(nodata=0),
+        )
+        for i, band in enumerate(bands)
+    }
+    data["qa_pixel"] = DataArray(
+        da.map_blocks(qa_block, dtype="uint16", chunks=block_chunks),
+        coords=coords,
+        dims=("time", "y", "x"),
+        attrs=dict(nodata=1),
+    )
+    return Dataset(data).odc.assign_crs(geobox.crs)
+
+
+def annual_summaries(
+    n_years: int = 10,
+    shape: tuple[int, int] = TILE_SHAPE,
+    chunks: int = 4096,
+    seed: int = 42,
+) -> Dataset:
+    """Annual int16 count_clear and count_wet, as loaded for the full history
+    summary, with some never observed (nodata) pixels. The same arguments
+    always give the same values."""
+    block_chunks = da.core.normalize_chunks((1, chunks, chunks), (n_years, *shape))
+
+    def counts_block(wet, block_info=None):
+        location = block_info[None]["chunk-location"]
+        rng = np.random.default_rng([seed, *location])
+        size = block_info[None]["chunk-shape"]
+        clear = rng.integers(0, 60, size=size, dtype="int16")
+        clear[rng.random(size) < 0.05] = _SUMMARY_NODATA
+        if not wet:
+            return clear
+        counts = (clear * rng.random(size) * 0.3).astype("int16")
+        return np.where(clear == _SUMMARY_NODATA, clear, counts)
+
+    geobox = tile_geobox(shape)
+    coords = dict(
+        time=np.array(
+            [np.datetime64(f"{2000 + year}-01-01") for year in range(n_years)]
+        ),
+        **xr_coords(geobox),
+    )
+    return Dataset(
+        {
+            name: DataArray(
+                da.map_blocks(
+                    partial(counts_block, name == "count_wet"),
+                    dtype="int16",
+                    chunks=block_chunks,
+                ),
+                coords=coords,
+                dims=("time", "y", "x"),
+                attrs=dict(nodata=_SUMMARY_NODATA),
+            )
+            for name in ["count_clear", "count_wet"]
+        }
+    ).odc.assign_crs(geobox.crs)
+
+
+def dem(geobox: GeoBox, seed: int = 42) -> DataArray:
+    """Smooth hills of up to about 1000m, steep enough in places to be masked
+    for slope and terrain shadow."""
+    rng = np.random.default_rng(seed)
+    y, x = np.meshgrid(
+        np.linspace(0, 1, geobox.shape[0]),
+        np.linspace(0, 1, geobox.shape[1]),
+        indexing="ij",
+    )
+    elevation = np.zeros(geobox.shape, dtype="float32")
+    for _ in range(20):
+        cy, cx, width, height = rng.random(4)
+        elevation += (height * 1000) * np.exp(
+            -((y - cy) ** 2 + (x - cx) ** 2) / (0.001 + 0.01 * width)
+        )
+    return wrap_xr(elevation, geobox)
+
+
+class StaticDem:
+    """Stands in for `DemCache`, serving `dem` for any geobox."""
+
+    def get(self, geobox: GeoBox, key: str) -> DataArray:
+        return dem(geobox)
+
+
+def _scale_usgs_collection2(data):
+    scaled = Dataset(
+        {
+            name: wofs.virtualproduct.scale_and_clip_dataarray(
+                band, scale_factor=0.275, add_offset=-2000, valid_range=(0, 10000)
+            )
+            for name, band in data.data_vars.items()
+        },
+        attrs=data.attrs,
+    )
+    return scaled
+
+
+def patch_upstream_scaling() -> None:
+    """Recent xarray releases drop variable attributes in
+    `Dataset.map(keep_attrs=False)`, which loses the nodata value upstream
+    `eo_filter` needs. This makes the upstream `WOfSClassifier` keep them, as
+    it did with older releases."""
+    wofs.virtualproduct.scale_usgs_collection2 = _scale_usgs_collection2
+
+
+_LANDSAT_ASSETS = [
+    "thumbnail",
+    "reduced_resolution_browse",
+    "index",
+    "MTL.json",
+    "ANG.txt",
+    "MTL.txt",
+    "MTL.xml",
+    "qa_pixel",
+    "qa_radsat",
+    "qa_aerosol",
+    "coastal",
+    "blue",
+    "green",
+    "red",
+    "nir08",
+    "swir16",
+    "swir22",
+]
+
+
+def landsat_search_response(
+    n_items: int = 5000, years: tuple[int, int] = (2013, 2024), seed: int = 42
+) -> dict:
+    """A landsatlook search response, as a FeatureCollection of `n_items`
+    Collection 2 SR items spread over `years`, with both https and S3 hrefs
+    for each asset like the real thing. The same arguments always give the
+    same response."""
+    rng = np.random.default_rng(seed)
+    features = []
+    ids = set()
+    while len(features) < n_items:
+        path, row = rng.integers(60, 90), rng.integers(60, 80)
+        day = np.datetime64(f"{years[0]}-01-01") + rng.integers(
+            0, 365 * (years[1] - years[0] + 1)
+        )
+        date = str(day).replace("-", "")
+        id = f"LC08_L2SP_{path:03d}{row:03d}_{date}_{date}_02_T1_SR"
+        if id in ids:
+            continue
+        ids.add(id)
+        folder = (
+            f"collection02/level-2/standard/oli-tirs/{str(day)[:4]}/"
+            f"{path:03d}/{row:03d}/{id[:-3]}"
+        )
+        lon, lat = -180 + path * 2.0, -10 - (row - 60) * 1.0
+        features.append(
+            {
+                "type": "Feature",
+                "stac_version": "1.0.0",
+                "stac_extensions": [
+                    "https://stac-extensions.github.io/projection/v1.0.0/schema.json",
+                    "https://stac-extensions.github.io/eo/v1.0.0/schema.json",
+                    "https://stac-extensions.github.io/alternate-assets/v1.1.0/schema.json",
+                ],
+                "id": id,
+                "collection": "landsat-c2l2-sr",
+                "bbox": [lon, lat - 1.8, lon + 2.2, lat],
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [
+                        [
+                            [lon, lat],
+                            [lon + 2.2, lat - 0.4],
+                            [lon + 1.8, lat - 1.8],
+                            [lon - 0.4, lat - 1.4],
+                            [lon, lat],
+                        ]
+                    ],
+                },
+                "properties": {
+                    "datetime": f"{day}T22:{len(ids) % 60:02d}:00.000000Z",
+                    "eo:cloud_cover": float(rng.uniform(0, 100)),
+                    "platform": "LANDSAT_8",
+                    "instruments": ["OLI", "TIRS"],
+                    "landsat:wrs_path": f"{path:03d}",
+                    "landsat:wrs_row": f"{row:03d}",
+                    "landsat:collection_category": "T1",
+                    "proj:epsg": 32700 + int((lon + 180) // 6) + 1,
+                    "proj:shape": [7801, 7681],
+                    "proj:transform": [30.0, 0.0, 199785.0, 0.0, -30.0, -1079085.0],
+                },
+                "assets": {
+                    name: {
+                        "title": name,
+                        "href": f"https://landsatlook.usgs.gov/data/{folder}/{id}_{name}",
+                        "type": "image/tiff; application=geotiff; profile=cloud-optimized",
+                        "roles": ["data"],
+                        "alternate": {
+                            "s3": {
+                                "storage:platform": "AWS",
+                                "storage:requester_pays": True,
+                                "href": f"s3://usgs-landsat/{folder}/{id}_{name}",
+                            }
+                        },
+                    }
+                    for name in _LANDSAT_ASSETS
+                },
+                "links": [
+                    {
+                        "rel": "self",
+                        "href": f"https://landsatlook.usgs.gov/stac-server/collections/landsat-c2l2-sr/items/{id}",
+                    }
+                ],
+            }
+        )
+    return {"type": "FeatureCollection", "features": features}
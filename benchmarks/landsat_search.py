@@ -0,0 +1,250 @@
+"""Times the Landsat search of process_wofls_tile.py against a local fake of
+landsatlook, which serves a recorded search response in pages with a delay
+per request, like the real API.
+
+It compares
+
+- rewriting asset hrefs to their S3 alternates by round tripping each item
+  through pystac (as was done) with rewriting the dicts in place, and checks
+  they give the same hrefs,
+- a single search over all years with a search per year run concurrently,
+- searching with an empty, a fresh and an expired `CachingStacApiIO` cache.
+
+    python benchmarks/landsat_search.py
+    python benchmarks/landsat_search.py --response recorded.json --latency 0.5
+
+`--response` is a FeatureCollection saved from landsatlook. Without it, a
+synthetic one of `--n-items` items is used.
+"""
+
+import copy
+import json
+import tempfile
+import threading
+import time
+from functools import partial
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Optional
+
+import pystac_client
+from pystac import read_dict
+from typer import Exit, run
+
+from dep_wofs.searchers import WindowedSearcher, use_alternate_s3_href
+from dep_wofs.stac_cache import CachingStacApiIO
+from fixtures import landsat_search_response
+
+
+def roundtrip_alternate_s3_href(modifiable: dict) -> None:
+    """The href rewrite as it was, building a pystac Item from each feature."""
+    if modifiable["type"] == "FeatureCollection":
+        new_features = list()
+        for item_dict in modifiable["features"]:
+            roundtrip_alternate_s3_href(item_dict)
+            new_features.append(item_dict)
+        modifiable["features"] = new_features
+    else:
+        stac_object = read_dict(modifiable)
+        for _, asset in stac_object.assets.items():
+            asset_dict = asset.to_dict()
+            if "alternate" in asset_dict.keys():
+                asset.href = asset.to_dict()["alternate"]["s3"]["href"]
+        modifiable.update(stac_object.to_dict())
+
+
+def hrefs(response: dict) -> list[str]:
+    return [
+        asset["href"]
+        for feature in response["features"]
+        for asset in feature["assets"].values()
+    ]
+
+
+class FakeLandsatlook(BaseHTTPRequestHandler):
+    """A STAC API serving `features`, filtered by datetime only, `page_size`
+    at a time with an ETag, after sleeping `latency` seconds."""
+
+    features: list[dict] = []
+    page_size = 100
+    latency = 0.2
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body: dict) -> None:
+        FakeLandsatlook.requests += 1
+        time.sleep(self.latency)
+        content = json.dumps(body).encode()
+        etag = f'"{sha256(content).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/geo+json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        root = f"http://{self.headers['Host']}"
+        self._reply(
+            {
+                "type": "Catalog",
+                "stac_version": "1.0.0",
+                "id": "landsatlook",
+                "description": "A fake landsatlook",
+                "conformsTo": [
+                    "https://api.stacspec.org/v1.0.0/core",
+                    "https://api.stacspec.org/v1.0.0/item-search",
+                ],
+                "links": [
+                    {"rel": "self", "href": root},
+                    {"rel": "root", "href": root},
+                    {
+                        "rel": "search",
+                        "type": "application/geo+json",
+                        "href": f"{root}/search",
+                        "method": "POST",
+                    },
+                ],
+            }
+        )
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        start, _, end = body.get("datetime", "../..").partition("/")
+        matches = [
+            feature
+            for feature in self.features
+            if (start in ["", ".."] or feature["properties"]["datetime"] >= start)
+            and (end in ["", ".."] or feature["properties"]["datetime"] <= end)
+        ]
+        page = body.get("page", 0)
+        links = []
+        if (page + 1) * self.page_size < len(matches):
+            links.append(
+                {
+                    "rel": "next",
+                    "href": f"http://{self.headers['Host']}/search",
+                    "method": "POST",
+                    "body": {**body, "page": page + 1},
+                }
+            )
+        self._reply(
+            {
+                "type": "FeatureCollection",
+                "features": matches[
+                    page * self.page_size : (page + 1) * self.page_size
+                ],
+                "links": links,
+            }
+        )
+
+
+class ClientSearcher:
+    """The search LandsatPystacSearcher makes, without the area."""
+
+    def __init__(self, client: pystac_client.Client, datetime: str):
+        self._client = client
+        self._datetime = datetime
+
+    def search(self, area=None):
+        return self._client.search(
+            collections=["landsat-c2l2-sr"], datetime=self._datetime, method="POST"
+        ).item_collection()
+
+
+def timed(work: Callable) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = work()
+    return time.perf_counter() - start, result
+
+
+def main(
+    response: Optional[Path] = None,
+    n_items: int = 5_000,
+    page_size: int = 100,
+    latency: float = 0.2,
+    max_workers: int = 8,
+) -> None:
+    recorded = (
+        json.loads(response.read_text())
+        if response is not None
+        else landsat_search_response(n_items)
+    )
+    n_items = len(recorded["features"])
+    datetimes = sorted(f["properties"]["datetime"] for f in recorded["features"])
+    datetime = f"{datetimes[0][:4]}/{datetimes[-1][:4]}"
+
+    # Rewriting hrefs, on copies so each starts from the original hrefs
+    roundtrip, new = copy.deepcopy(recorded), copy.deepcopy(recorded)
+    roundtrip_seconds, _ = timed(lambda: roundtrip_alternate_s3_href(roundtrip))
+    new_seconds, _ = timed(lambda: use_alternate_s3_href(new))
+    print(
+        f"Rewriting {n_items} items: pystac round trip {roundtrip_seconds:.3f}s, "
+        f"in place {new_seconds:.3f}s ({roundtrip_seconds / new_seconds:.0f}x)"
+    )
+    if hrefs(roundtrip) != hrefs(new):
+        print("The rewrites give different hrefs")
+        raise Exit(code=1)
+
+    FakeLandsatlook.features = sorted(
+        recorded["features"], key=lambda f: f["properties"]["datetime"]
+    )
+    FakeLandsatlook.page_size = page_size
+    FakeLandsatlook.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeLandsatlook)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    def search(windowed: bool, stac_io=None) -> int:
+        client = pystac_client.Client.open(
+            url, modifier=use_alternate_s3_href, stac_io=stac_io
+        )
+        searcher = (
+            WindowedSearcher(
+                partial(ClientSearcher, client), datetime, max_workers=max_workers
+            )
+            if windowed
+            else ClientSearcher(client, datetime)
+        )
+        return len(searcher.search(None))
+
+    print(f"Searching {datetime}, {page_size} items a page, {latency}s a request")
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cases = [
+                ("single search", False, None),
+                ("search per year", True, None),
+                ("empty cache", True, CachingStacApiIO(cache_dir, ttl=3600)),
+                ("fresh cache", True, CachingStacApiIO(cache_dir, ttl=3600)),
+                ("expired cache", True, CachingStacApiIO(cache_dir, ttl=0)),
+            ]
+            for name, windowed, stac_io in cases:
+                FakeLandsatlook.requests = 0
+                seconds, found = timed(partial(search, windowed, stac_io))
+                print(
+                    f"{name:>16}: {seconds:6.2f}s, {found} items, "
+                    f"{FakeLandsatlook.requests} requests"
+                    + (
+                        f" ({stac_io.hits} hits, {stac_io.revalidations} "
+                        f"revalidated, {stac_io.misses} missed)"
+                        if stac_io is not None
+                        else ""
+                    )
+                )
+                if found != n_items:
+                    print(f"Expected {n_items} items")
+                    raise Exit(code=1)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    run(main)
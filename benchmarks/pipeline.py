@@ -0,0 +1,373 @@
+"""Runs the whole pipeline, `process_wofls_tile.py` then `process_wofs_tile.py`
+then `process_wofs_full_history_tile.py`, for a few tiles against a local
+stand in for the cloud, to measure throughput and I/O off-cloud.
+
+Synthetic Landsat scenes (see fixtures.py) covering the given path/rows and
+a DEM are written as COGs with static STAC catalogs on disk, and the bucket is
+a moto S3 server. The entry points are pointed at these through the settings
+in config.py and run as separate processes, as they are in production. After
+each step, the STAC items it wrote are added to a static catalog standing in
+for the DEP catalog, so the next step finds them.
+
+The time and bytes written of each step, and the per stage records the entry
+points write (see dep_wofs/instrumentation.py), are printed and optionally
+written to `--output`. Given `--baseline`, the output of an earlier run, any
+step more than `--tolerance` slower or writing more fails the run.
+
+With `--cube`, the WOfLs are also written to per path/row Zarr cubes, and
+the annual summaries read them from there (see dep_wofs/cube.py).
+
+Needs dep-tools, the grid cache (see build_grid_cache.py) and moto[server],
+so it's simplest to run in the image, as CI does:
+
+    docker run --rm <image> bash -c "pip install 'moto[server]' && \\
+        python benchmarks/pipeline.py --path-rows 74,72 --n-scenes 2 --max-tiles 2"
+"""
+
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timezone
+from pathlib import Path
+from typing import List, Optional
+
+import boto3
+import numpy as np
+from moto.server import ThreadedMotoServer
+from odc.geo.geobox import GeoBox
+from odc.geo.geom import Geometry, unary_union
+from pystac import Asset, Catalog, CatalogType, Collection, Extent, Item, MediaType
+from pystac import SpatialExtent, TemporalExtent
+from pystac.extensions.projection import ProjectionExtension
+from typer import Exit, Option, run
+from typing_extensions import Annotated
+
+from dep_wofs.config import GRID_CACHE_DIR
+from dep_wofs.grid import dep_grid, grid_cache_dir, landsat_grid
+from dep_wofs.instrumentation import read_stage_records
+from fixtures import dem, landsat_scenes
+
+REPOSITORY = Path(__file__).parent.parent
+BUCKET = "dep-wofs-local"
+YEAR = 2020
+STEPS = ["process_wofls_tile", "process_wofs_tile", "process_wofs_full_history_tile"]
+
+_S3_HTTPS_HREF = re.compile(r"https://([^.]+)\.s3[.\w-]*\.amazonaws\.com/(.+)")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _utm_crs(geometry: Geometry) -> str:
+    lon, lat = geometry.centroid.coords[0]
+    zone = int((lon + 180) // 6) + 1
+    return f"EPSG:{(32600 if lat >= 0 else 32700) + zone}"
+
+
+def _collection(id: str, items: list[Item]) -> Collection:
+    collection = Collection(
+        id=id,
+        description=f"Local stand in for {id}",
+        extent=Extent(
+            SpatialExtent([[-180.0, -90.0, 180.0, 90.0]]),
+            TemporalExtent([[None, None]]),
+        ),
+    )
+    collection.add_items(items)
+    return collection
+
+
+def _save_catalog(root: Path, id: str, collections: list[Collection]) -> str:
+    catalog = Catalog(id=id, description=f"Local stand in for {id}")
+    catalog.add_children(collections)
+    catalog.normalize_and_save(str(root), CatalogType.SELF_CONTAINED)
+    return str(root / "catalog.json")
+
+
+def write_landsat_catalog(
+    root: Path, path_rows: list[tuple[int, int]], n_scenes: int
+) -> str:
+    """Synthetic C2L2 scenes covering each path/row, as COGs, in a static
+    catalog like the USGS one."""
+    items = []
+    for path, row in path_rows:
+        footprint = Geometry(landsat_grid().loc[(path, row)].geometry, "EPSG:4326")
+        geobox = GeoBox.from_geopolygon(
+            footprint, resolution=30, crs=_utm_crs(footprint), anchor="center"
+        )
+        scenes = landsat_scenes(n_times=n_scenes, geobox=geobox, seed=path * 1000 + row)
+        for i, timestamp in enumerate(scenes.time.values):
+            date = np.datetime_as_string(timestamp, unit="D").replace("-", "")
+            id = f"LC08_L2SP_{path:03d}{row:03d}_{date}_{date}_02_T1_SR"
+            item = Item(
+                id=id,
+                geometry=footprint.json,
+                bbox=list(footprint.boundingbox),
+                datetime=timestamp.astype("datetime64[us]")
+                .item()
+                .replace(tzinfo=timezone.utc),
+                properties={
+                    "landsat:wrs_path": f"{path:03d}",
+                    "landsat:wrs_row": f"{row:03d}",
+                    "platform": "landsat-8",
+                    "proj:epsg": geobox.crs.epsg,
+                    "proj:shape": list(geobox.shape),
+                    "proj:transform": list(geobox.affine)[:6],
+                },
+                collection="landsat-c2l2-sr",
+                stac_extensions=[ProjectionExtension.get_schema_uri()],
+            )
+            for band, data in scenes.isel(time=i).data_vars.items():
+                cog = root / "data" / id / f"{id}_{band}.TIF"
+                cog.parent.mkdir(parents=True, exist_ok=True)
+                data.odc.write_cog(cog, overwrite=True)
+                item.add_asset(
+                    band,
+                    Asset(href=str(cog), media_type=MediaType.COG, roles=["data"]),
+                )
+            items.append(item)
+
+    return _save_catalog(root, "landsat", [_collection("landsat-c2l2-sr", items)])
+
+
+def write_dem_catalog(root: Path, area: Geometry, resolution: float = 0.001) -> str:
+    """A synthetic DEM covering `area`, coarser than the real 30m one to keep
+    it small, in a static catalog like earth-search's."""
+    geobox = GeoBox.from_geopolygon(
+        area.buffer(0.5), resolution=resolution, crs="EPSG:4326"
+    )
+    cog = root / "data" / "dem.tif"
+    cog.parent.mkdir(parents=True, exist_ok=True)
+    dem(geobox).odc.write_cog(cog, overwrite=True)
+    item = Item(
+        id="dem",
+        geometry=geobox.extent.json,
+        bbox=list(geobox.extent.boundingbox),
+        datetime=None,
+        properties={
+            "start_datetime": "2021-04-22T00:00:00Z",
+            "end_datetime": "2021-04-22T00:00:00Z",
+            "proj:epsg": 4326,
+            "proj:shape": list(geobox.shape),
+            "proj:transform": list(geobox.affine)[:6],
+        },
+        collection="cop-dem-glo-30",
+        stac_extensions=[ProjectionExtension.get_schema_uri()],
+    )
+    item.add_asset(
+        "data", Asset(href=str(cog), media_type=MediaType.COG, roles=["data"])
+    )
+    return _save_catalog(root, "dem", [_collection("cop-dem-glo-30", [item])])
+
+
+def write_dep_catalog(root: Path, client) -> str:
+    """The STAC items written to the bucket so far, in a static catalog with
+    a collection for each dataset (e.g. "dep_ls_wofl"), read through S3."""
+    paginator = client.get_paginator("list_objects_v2")
+    collections = dict()
+    for page in paginator.paginate(Bucket=BUCKET):
+        for object in page.get("Contents", []):
+            key = object["Key"]
+            if not key.endswith(".stac-item.json"):
+                continue
+            body = client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+            item = Item.from_dict(json.loads(body))
+            item.clear_links()
+            for asset in item.assets.values():
+                asset.href = _S3_HTTPS_HREF.sub(r"s3://\1/\2", asset.href)
+            collection = key.split("/")[0]
+            item.collection_id = collection
+            collections.setdefault(collection, []).append(item)
+
+    return _save_catalog(
+        root,
+        "dep",
+        [_collection(id, items) for id, items in sorted(collections.items())],
+    )
+
+
+def bucket_bytes(client, prefix: str = "") -> int:
+    paginator = client.get_paginator("list_objects_v2")
+    return sum(
+        object["Size"]
+        for page in paginator.paginate(Bucket=BUCKET, Prefix=prefix)
+        for object in page.get("Contents", [])
+    )
+
+
+def run_step(step: str, tasks: list[list[str]], env: dict, cwd: Path) -> dict:
+    """Run each of `tasks`, the arguments of `step`, in a process of its own."""
+    errors = 0
+    start = time.perf_counter()
+    for arguments in tasks:
+        result = subprocess.run(
+            [sys.executable, str(REPOSITORY / "dep_wofs" / f"{step}.py"), *arguments],
+            env=env,
+            cwd=cwd,
+        )
+        errors += result.returncode != 0
+    seconds = time.perf_counter() - start
+    return dict(tasks=len(tasks), errors=errors, seconds=seconds)
+
+
+def main(
+    path_rows: Annotated[List[str], Option(help='Landsat path/rows, like "74,72"')] = [
+        "74,72"
+    ],
+    n_scenes: int = 2,
+    max_tiles: Annotated[
+        int, Option(help="How many DEP tiles in the path/rows to summarise")
+    ] = 2,
+    version: str = "0.0.0-local",
+    scheduler: str = "threads",
+    cube: bool = False,
+    output: Optional[Path] = None,
+    baseline: Optional[Path] = None,
+    tolerance: float = 0.25,
+) -> None:
+    if grid_cache_dir() is None:
+        print("The grid cache is needed, run dep_wofs/build_grid_cache.py first")
+        raise Exit(code=1)
+
+    path_rows = [tuple(int(i) for i in pr.split(",")) for pr in path_rows]
+    footprints = unary_union(
+        [
+            Geometry(landsat_grid().loc[path_row].geometry, "EPSG:4326")
+            for path_row in path_rows
+        ]
+    )
+    tiles = [
+        tile
+        for tile, geobox in dep_grid().geobox.items()
+        if geobox.extent.to_crs("EPSG:4326").intersects(footprints)
+    ][:max_tiles]
+
+    port = _free_port()
+    server = ThreadedMotoServer(port=port)
+    server.start()
+    endpoint = f"http://127.0.0.1:{port}"
+    credentials = dict(
+        AWS_ACCESS_KEY_ID="testing",
+        AWS_SECRET_ACCESS_KEY="testing",
+        AWS_DEFAULT_REGION="us-west-2",
+    )
+    client = boto3.client(
+        "s3",
+        endpoint_url=endpoint,
+        aws_access_key_id=credentials["AWS_ACCESS_KEY_ID"],
+        aws_secret_access_key=credentials["AWS_SECRET_ACCESS_KEY"],
+        region_name=credentials["AWS_DEFAULT_REGION"],
+    )
+    client.create_bucket(
+        Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": "us-west-2"}
+    )
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            print("Writing synthetic inputs", file=sys.stderr)
+            env = dict(
+                os.environ,
+                **credentials,
+                PYTHONPATH=os.pathsep.join(
+                    [str(REPOSITORY), os.environ.get("PYTHONPATH", "")]
+                ),
+                WOFS_BUCKET=BUCKET,
+                WOFS_S3_ENDPOINT_URL=endpoint,
+                WOFS_GRID_CACHE_DIR=str((REPOSITORY / GRID_CACHE_DIR).resolve()),
+                WOFS_DEM_CACHE_DIR=str(root / "dem_cache"),
+                WOFS_TASK_STATE_PATH=str(root / "task_state.sqlite"),
+                WOFS_LANDSAT_STAC_URL=write_landsat_catalog(
+                    root / "landsat", path_rows, n_scenes
+                ),
+                WOFS_DEM_STAC_URL=write_dem_catalog(root / "dem", footprints),
+                WOFS_DEP_STAC_URL=write_dep_catalog(root / "dep", client),
+            )
+
+            common = ["--version", version, "--scheduler", scheduler]
+            step_tasks = dict(
+                process_wofls_tile=[
+                    ["--path", str(path), "--row", str(row), "--datetime", str(YEAR)]
+                    + (["--cube", "True"] if cube else [])
+                    for path, row in path_rows
+                ],
+                process_wofs_tile=[
+                    [
+                        "--column",
+                        str(column),
+                        "--row",
+                        str(row),
+                        "--datetime",
+                        str(YEAR),
+                    ]
+                    + (["--cube-version", version] if cube else [])
+                    for column, row in tiles
+                ],
+                process_wofs_full_history_tile=[
+                    [
+                        "--column",
+                        str(column),
+                        "--row",
+                        str(row),
+                        "--datetime",
+                        f"{YEAR}/{YEAR}",
+                    ]
+                    for column, row in tiles
+                ],
+            )
+
+            results = dict()
+            for step in STEPS:
+                written = bucket_bytes(client)
+                results[step] = run_step(
+                    step,
+                    [arguments + common for arguments in step_tasks[step]],
+                    env,
+                    root,
+                )
+                results[step]["bytes_written"] = bucket_bytes(client) - written
+                write_dep_catalog(root / "dep", client)
+                print(f"{step:>32}: {json.dumps(results[step])}")
+
+            records = read_stage_records(BUCKET, "", client)
+    finally:
+        server.stop()
+
+    if len(records) > 0:
+        print(
+            records.groupby(["dataset_id", "stage"])[
+                ["seconds", "bytes_read", "dask_tasks"]
+            ].sum()
+        )
+
+    if output is not None:
+        output.write_text(json.dumps(results, indent=2) + "\n")
+
+    # A step which writes nothing has found nothing to do, so hasn't been run
+    failed = any(
+        result["errors"] > 0 or result["bytes_written"] == 0
+        for result in results.values()
+    )
+    if baseline is not None:
+        expected = json.loads(baseline.read_text())
+        for step, result in results.items():
+            for measure in ["seconds", "bytes_written"]:
+                if step in expected and result[measure] > expected[step][measure] * (
+                    1 + tolerance
+                ):
+                    print(f"{step} regressed: {measure} {result[measure]}")
+                    failed = True
+    if failed:
+        raise Exit(code=1)
+
+
+if __name__ == "__main__":
+    run(main)
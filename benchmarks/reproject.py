@@ -0,0 +1,190 @@
+"""Checks `PlannedOdcLoader` loads WOfLs onto a DEP tile like `odc.stac.load`
+does, and times both.
+
+Synthetic WOfLs from two path/rows in neighbouring UTM zones, each scene
+shifted by a few pixels as real acquisitions are, are written as COGs with
+STAC items and loaded onto a tile in EPSG:3832 with each loader. GDAL's warp,
+which `odc.stac.load` uses, approximates the transform to within
+`EDGE_TOLERANCE` pixels by default, so the two may pick different source
+pixels for tile pixels whose centres fall that close to a source pixel's edge.
+Any other difference, or more than `MAX_MISMATCHED` of the pixels differing
+at all, fails the check.
+
+The gather is also timed against `xr_reproject` on an in-memory stack, which
+leaves out reading the COGs. Run from the root of the repository:
+
+    python benchmarks/reproject.py --n-times 20 --size 1600
+"""
+
+import tempfile
+import time
+from datetime import timezone
+from pathlib import Path
+
+import numpy as np
+import odc.stac
+from odc.geo.geobox import GeoBox
+from odc.geo.geom import point
+from odc.geo.xr import xr_reproject
+from pystac import Asset, Item, MediaType
+from pystac.extensions.projection import ProjectionExtension
+from typer import Exit, run
+
+from dep_wofs.reproject import PlannedOdcLoader, reproject_stack, reprojection_plan
+from fixtures import wofls
+
+NODATA = 1
+
+# The error threshold of GDAL's approximate transformer, in pixels
+EDGE_TOLERANCE = 0.125
+
+# Pixels within EDGE_TOLERANCE of an edge are over 40% of all pixels, but
+# GDAL's error is usually well within its threshold, and about 2% differ
+MAX_MISMATCHED = 0.05
+STAC_CFG = {"dep_ls_wofl": {"assets": {"*": {"nodata": NODATA}}}}
+
+
+def tile(size: int) -> GeoBox:
+    """A DEP tile of `size` pixels near the antimeridian, where path/rows are
+    in UTM zones 59 and 60."""
+    x, y = point(178.5, -17.5, "EPSG:4326").to_crs("EPSG:3832").coords[0]
+    return GeoBox.from_bbox(
+        (x, y - size * 30, x + size * 30, y), "EPSG:3832", resolution=30
+    )
+
+
+def write_wofls(root: Path, area: GeoBox, n_times: int) -> list[Item]:
+    """`n_times` WOfLs covering `area` from each of two path/rows."""
+    rng = np.random.default_rng(42)
+    items = []
+    for path_row, crs in enumerate(["EPSG:32760", "EPSG:32759"]):
+        extent = area.extent.to_crs(crs).buffer(10_000)
+        grid = GeoBox.from_bbox(extent.boundingbox, crs, resolution=30, anchor="center")
+        for i in range(n_times):
+            geobox = grid.translate_pix(*rng.integers(-5, 6, size=2))
+            water = wofls(n_times=1, geobox=geobox, seed=path_row * 1000 + i).water
+            water = water.isel(time=0).odc.assign_crs(crs)
+            id = f"wofl_{path_row}_{i}"
+            cog = root / f"{id}.tif"
+            water.odc.write_cog(cog, overwrite=True, nodata=NODATA)
+            item = Item(
+                id=id,
+                geometry=geobox.extent.to_crs("EPSG:4326").json,
+                bbox=list(geobox.extent.to_crs("EPSG:4326").boundingbox),
+                datetime=(
+                    np.datetime64("2020-01-01T22:00")
+                    + np.timedelta64(2 * i + path_row, "D")
+                )
+                .astype("datetime64[us]")
+                .item()
+                .replace(tzinfo=timezone.utc),
+                properties={
+                    "proj:epsg": geobox.crs.epsg,
+                    "proj:shape": list(geobox.shape),
+                    "proj:transform": list(geobox.affine)[:6],
+                },
+                collection="dep_ls_wofl",
+                stac_extensions=[ProjectionExtension.get_schema_uri()],
+            )
+            item.add_asset(
+                "water", Asset(href=str(cog), media_type=MediaType.COG, roles=["data"])
+            )
+            items.append(item)
+    return items
+
+
+def edge_distance(item: Item, area: GeoBox, rows, cols) -> np.ndarray:
+    """How far the centres of pixels `rows`, `cols` of `area` are from the
+    nearest edge of a pixel of `item`, in pixels."""
+    geobox = odc.stac.parse_item(item).geoboxes()[0]
+    x, y = area.affine * (cols + 0.5, rows + 0.5)
+    x, y = area.crs.transformer_to_crs(geobox.crs)(x, y)
+    col, row = ~geobox.affine * (x, y)
+    return np.minimum(
+        np.minimum(col % 1, 1 - col % 1), np.minimum(row % 1, 1 - row % 1)
+    )
+
+
+def timed(work) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = work()
+    return time.perf_counter() - start, result
+
+
+def main(
+    n_times: int = 20,
+    size: int = 1600,
+    chunks: int = 1024,
+) -> None:
+    area = tile(size)
+    load_kwargs = dict(
+        dtype="uint8", chunks=dict(x=chunks, y=chunks), stac_cfg=STAC_CFG
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        items = write_wofls(Path(tmp), area, n_times)
+        items.sort(key=lambda item: item.datetime)
+        pixels = len(items) * area.shape.x * area.shape.y
+
+        odc_seconds, expected = timed(
+            lambda: odc.stac.load(
+                items, geobox=area, resampling="nearest", **load_kwargs
+            ).compute()
+        )
+        reprojection_plan.cache_clear()
+        cold_seconds, _ = timed(
+            lambda: PlannedOdcLoader(**load_kwargs).load(items, area).compute()
+        )
+        warm_seconds, loaded = timed(
+            lambda: PlannedOdcLoader(**load_kwargs).load(items, area).compute()
+        )
+        print(
+            f"Loading {len(items)} WOfLs onto {size}x{size}: odc.stac.load "
+            f"{odc_seconds:.2f}s, planned {cold_seconds:.2f}s "
+            f"({warm_seconds:.2f}s with the plans cached)"
+        )
+
+        failed = False
+        mismatched = 0
+        for i, item in enumerate(items):
+            rows, cols = np.nonzero(loaded.water.values[i] != expected.water.values[i])
+            mismatched += len(rows)
+            distance = edge_distance(item, area, rows, cols)
+            if (distance > EDGE_TOLERANCE).any():
+                print(
+                    f"{item.id}: {(distance > EDGE_TOLERANCE).sum()} pixels "
+                    "differ from odc.stac.load away from a pixel edge"
+                )
+                failed = True
+        if mismatched / pixels > MAX_MISMATCHED:
+            print(f"More than {MAX_MISMATCHED:.0%} of pixels differ")
+            failed = True
+        print(
+            f"{mismatched / pixels:.2%} of pixels differ from odc.stac.load, "
+            f"all within {EDGE_TOLERANCE} pixels of an edge"
+            if not failed
+            else "Differs from odc.stac.load"
+        )
+
+    # The reprojection alone, on a stack already in memory
+    src = tile(size).extent.to_crs("EPSG:32760").buffer(10_000)
+    src = GeoBox.from_bbox(src.boundingbox, "EPSG:32760", resolution=30)
+    stack = wofls(n_times=n_times, geobox=src).water.odc.assign_crs(src.crs).compute()
+    reprojection_plan.cache_clear()
+    plan_seconds, _ = timed(lambda: reprojection_plan(src, area))
+    gather_seconds, _ = timed(lambda: reproject_stack(stack, area, NODATA))
+    warp_seconds, _ = timed(
+        lambda: xr_reproject(stack, area, resampling="nearest", dst_nodata=NODATA)
+    )
+    pixels = n_times * area.shape.x * area.shape.y
+    print(
+        f"Reprojecting {n_times} in memory: planning {plan_seconds:.2f}s, then "
+        f"{pixels / gather_seconds / 1e6:.0f} Mpixel/s gathered vs "
+        f"{pixels / warp_seconds / 1e6:.0f} Mpixel/s with xr_reproject"
+    )
+
+    if failed:
+        raise Exit(code=1)
+
+
+if __name__ == "__main__":
+    run(main)
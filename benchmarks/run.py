@@ -0,0 +1,216 @@
+"""The benchmark suite: times the classifier, the processors and task
+filtering on synthetic inputs at realistic tile sizes, with no network, and
+compares the results with the tracked baselines in baselines.json.
+
+Each case is timed (the best of `--repeat` runs) and then run once more with
+tracemalloc for its peak memory. A case regresses if it is more than
+`--tolerance` slower, or uses more than `--tolerance` more memory, than its
+baseline. The versions of the libraries most likely to cause a regression are
+recorded with the baselines, so a regression can be traced to a bump.
+
+    python benchmarks/run.py
+    python benchmarks/run.py --cases wofs_processor --cases full_history_processor
+    python benchmarks/run.py --update-baselines
+
+Timings only compare on like hardware, so baselines should be updated from
+the machine the suite is usually run on.
+"""
+
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import dask
+from typer import Exit, Option, run
+from typing_extensions import Annotated
+
+from dep_wofs.processors import (
+    DepWOfSClassifier,
+    WofsFullHistoryProcessor,
+    WofsProcessor,
+    WoflProcessor,
+)
+from dep_wofs.task_state import TaskState
+from fixtures import (
+    StaticDem,
+    annual_summaries,
+    landsat_scenes,
+    patch_upstream_scaling,
+    wofls,
+)
+from task_state import LOG_KEY, grid, log_lines
+
+BASELINES_PATH = Path(__file__).parent / "baselines.json"
+
+# Libraries whose upgrades have changed, or could change, the cost of a run
+TRACKED_PACKAGES = [
+    "dep-tools",
+    "wofs",
+    "odc-stats",
+    "odc-stac",
+    "odc-geo",
+    "xarray",
+    "dask",
+    "numpy",
+]
+
+
+def package_versions() -> dict[str, str | None]:
+    versions = dict()
+    for package in TRACKED_PACKAGES:
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def classifier_case(params: dict, native: bool = True) -> Callable:
+    scenes = landsat_scenes(n_times=params["n_scenes"], shape=params["shape"])
+    classifier = DepWOfSClassifier(dem_cache=StaticDem(), dem_key="", native=native)
+    return lambda: classifier.compute(scenes).compute()
+
+
+def wofl_processor_case(params: dict) -> Callable:
+    scenes = landsat_scenes(n_times=params["n_scenes"], shape=params["shape"])
+    processor = WoflProcessor(dem_cache=StaticDem(), dem_key="")
+    return lambda: processor.process(scenes).compute()
+
+
+def wofs_processor_case(params: dict) -> Callable:
+    daily = wofls(n_times=params["n_wofls"], shape=params["shape"])
+    return lambda: WofsProcessor().process(daily).compute()
+
+
+def full_history_processor_case(params: dict) -> Callable:
+    annuals = annual_summaries(n_years=params["n_years"], shape=params["shape"])
+    return lambda: WofsFullHistoryProcessor().process(annuals).compute()
+
+
+def task_filter_case(params: dict) -> Callable:
+    """Building the task state from a log and filtering the grid with it, as
+    `print_tasks.py` does on a first run."""
+    tiles = grid(params["n_tiles"])
+    log = b"time|index|status|paths|comment\n" + log_lines(
+        params["n_log_lines"], params["n_tiles"]
+    )
+
+    def filter_tasks():
+        with tempfile.TemporaryDirectory() as tmp:
+            state = TaskState(Path(tmp) / "task_state.sqlite")
+            state.update(LOG_KEY, log, len(log))
+            return state.filter(tiles, LOG_KEY)
+
+    return filter_tasks
+
+
+CASES = dict(
+    classifier=classifier_case,
+    classifier_upstream=lambda params: classifier_case(params, native=False),
+    wofl_processor=wofl_processor_case,
+    wofs_processor=wofs_processor_case,
+    full_history_processor=full_history_processor_case,
+    task_filter=task_filter_case,
+)
+
+
+def measure(work: Callable, repeat: int) -> dict:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        work()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    work()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(seconds=round(min(seconds), 3), peak_mib=round(peak / 2**20, 1))
+
+
+def compare(result: dict, baseline: dict | None, tolerance: float) -> list[str]:
+    """The measures of `result` which regressed from `baseline`."""
+    if baseline is None:
+        return []
+    return [
+        measure
+        for measure in ["seconds", "peak_mib"]
+        if result[measure] > baseline[measure] * (1 + tolerance)
+    ]
+
+
+def main(
+    cases: Annotated[
+        Optional[List[str]], Option(help=f"Any of {', '.join(CASES)}, or all")
+    ] = None,
+    size: int = 3200,
+    n_scenes: int = 4,
+    n_wofls: int = 100,
+    n_years: int = 10,
+    n_tiles: int = 5_000,
+    n_log_lines: int = 200_000,
+    repeat: int = 3,
+    tolerance: float = 0.25,
+    update_baselines: bool = False,
+) -> None:
+    patch_upstream_scaling()
+    params = dict(
+        shape=[size, size],
+        n_scenes=n_scenes,
+        n_wofls=n_wofls,
+        n_years=n_years,
+        n_tiles=n_tiles,
+        n_log_lines=n_log_lines,
+    )
+    stored = json.loads(BASELINES_PATH.read_text()) if BASELINES_PATH.exists() else {}
+    baselines = stored.get("cases", {}) if stored.get("params") == params else {}
+    if len(stored) > 0 and len(baselines) == 0:
+        print("Baselines were recorded with other parameters, not comparing")
+    if stored.get("versions", package_versions()) != package_versions():
+        print(f"Baselines were recorded with {stored['versions']}")
+
+    results = dict()
+    regressions = dict()
+    with dask.config.set(scheduler="threads"):
+        for name in cases if cases is not None else CASES:
+            results[name] = measure(CASES[name](params), repeat)
+            baseline = baselines.get(name)
+            regressions[name] = compare(results[name], baseline, tolerance)
+            print(
+                f"{name:>24}: {results[name]['seconds']:7.2f}s, "
+                f"peak {results[name]['peak_mib']:8.1f}MiB"
+                + (
+                    f" (baseline {baseline['seconds']:7.2f}s, "
+                    f"{baseline['peak_mib']:8.1f}MiB)"
+                    if baseline is not None
+                    else " (no baseline)"
+                )
+                + (" REGRESSED" if len(regressions[name]) > 0 else "")
+            )
+
+    if update_baselines:
+        BASELINES_PATH.write_text(
+            json.dumps(
+                dict(
+                    params=params,
+                    machine=dict(platform=platform.platform(), cpus=os.cpu_count()),
+                    versions=package_versions(),
+                    cases={**baselines, **results},
+                ),
+                indent=2,
+            )
+            + "\n"
+        )
+        print(f"Updated {BASELINES_PATH}")
+    elif any(len(regressed) > 0 for regressed in regressions.values()):
+        raise Exit(code=1)
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,55 @@
+"""Finds where a distributed cluster starts to beat the threaded scheduler,
+to set `WOFS_SMALL_WORK_PIXELS` from (see dep_wofs/config.py).
+
+A year of WOfLs is summarized for tiles of each `--size`, once with the
+threaded scheduler and once with a distributed cluster sized as
+`dask_scheduler` sizes it for this machine. Starting the cluster is included
+in its time, as "auto" has to pay for it. Run it on the nodes the tasks run
+on, as the crossover depends on their CPUs and memory:
+
+    python benchmarks/scheduler.py --size 1600 --size 3200 --size 6400
+"""
+
+import time
+from typing import List
+
+from typer import Option, run
+from typing_extensions import Annotated
+
+from dep_wofs.cluster import cluster_settings, dask_scheduler
+from dep_wofs.processors import WofsProcessor
+from fixtures import wofls
+
+
+def timed(scheduler: str, n_times: int, size: int) -> float:
+    daily = wofls(n_times=n_times, shape=(size, size))
+    start = time.perf_counter()
+    with dask_scheduler(scheduler):
+        WofsProcessor().process(daily).compute()
+    return time.perf_counter() - start
+
+
+def main(
+    size: Annotated[List[int], Option()] = [1600, 3200, 6400],
+    n_times: int = 100,
+) -> None:
+    print(f"Cluster settings: {cluster_settings()}")
+    crossover = None
+    for side in sorted(size):
+        threads = timed("threads", n_times, side)
+        distributed = timed("distributed", n_times, side)
+        print(
+            f"{side}x{side} pixels, {n_times} WOfLs: threads {threads:.1f}s, "
+            f"distributed {distributed:.1f}s"
+        )
+        if crossover is None and distributed < threads:
+            crossover = side * side
+
+    if crossover is None:
+        print(f"Threads were faster at every size, up to {max(size)}x{max(size)}")
+    else:
+        print(f"Distributed is faster from {crossover} pixels")
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,68 @@
+"""Checks that importing each entry point does no network I/O and is fast.
+
+Each module is imported in a fresh interpreter with an audit hook that fails on
+any socket connection or DNS lookup, so a regression which reintroduces
+module-level downloads (e.g. of the grids) fails loudly. Run from the root of
+the repository:
+
+    python benchmarks/startup.py --budget 10
+"""
+
+import subprocess
+import sys
+from pathlib import Path
+
+from typer import Option, run
+from typing_extensions import Annotated
+
+ENTRY_POINTS = [
+    "process_wofls_tile",
+    "process_wofs_tile",
+    "process_wofs_full_history_tile",
+    "print_tasks",
+    "worker",
+]
+
+_IMPORT_SCRIPT = """
+import sys, time
+
+def no_network(event, args):
+    if event in ("socket.connect", "socket.getaddrinfo"):
+        raise RuntimeError(f"Network access during import: {{event}} {{args}}")
+
+sys.path.insert(0, {src!r})
+sys.addaudithook(no_network)
+start = time.perf_counter()
+import dep_wofs.{module}
+print(time.perf_counter() - start)
+"""
+
+
+def time_import(module: str, src: Path) -> float:
+    result = subprocess.run(
+        [sys.executable, "-c", _IMPORT_SCRIPT.format(src=str(src), module=module)],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main(
+    budget: Annotated[float, Option(help="Maximum seconds per import")] = 10.0,
+) -> None:
+    src = Path(__file__).parent.parent
+    over_budget = []
+    for module in ENTRY_POINTS:
+        elapsed = time_import(module, src)
+        print(f"{module}: {elapsed:.2f}s")
+        if elapsed > budget:
+            over_budget.append(module)
+
+    if over_budget:
+        sys.exit(f"Over the {budget}s import budget: {', '.join(over_budget)}")
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,60 @@
+"""Compares the single pass WOfS summary in dep_wofs.summaries with the
+`StatsWofs` based summary it replaced, checking they give identical output.
+
+    python benchmarks/summarize.py --n-times 200
+"""
+
+import time
+import tracemalloc
+
+import dask
+import numpy as np
+from odc.stats.plugins.wofs import StatsWofs
+from typer import run
+
+from dep_wofs.summaries import wofs_counts, wofs_summary
+from fixtures import wofls as synthetic_wofls
+
+
+def stats_wofs(wofls):
+    summarizer = StatsWofs()
+    prepped = wofls.groupby("time").apply(lambda ds: summarizer.native_transform(ds))
+    return summarizer.reduce(prepped)
+
+
+def single_pass(wofls):
+    return wofs_summary(wofs_counts(wofls.water))
+
+
+def measure(summarize, wofls):
+    summary = summarize(wofls)
+    graph_size = len(summary.__dask_graph__())
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    summary = summary.compute()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{summarize.__name__:>12}: {graph_size:>7} tasks, {elapsed:7.2f}s, "
+        f"peak {peak / 2**20:8.1f}MiB"
+    )
+    return summary
+
+
+def main(n_times: int = 100, size: int = 3200) -> None:
+    wofls = synthetic_wofls(n_times=n_times, shape=(size, size))
+    with dask.config.set(scheduler="threads"):
+        expected = measure(stats_wofs, wofls)
+        actual = measure(single_pass, wofls)
+
+    for name in ["count_wet", "count_clear", "frequency"]:
+        np.testing.assert_array_equal(actual[name].values, expected[name].values)
+        assert actual[name].dtype == expected[name].dtype
+    print("Outputs are identical")
+
+
+if __name__ == "__main__":
+    run(main)
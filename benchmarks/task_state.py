@@ -0,0 +1,85 @@
+"""Times filtering tasks by a large synthetic log, comparing a full parse of
+the log with pandas (as `CsvLogger.parse_log` does) against the compacted
+state in dep_wofs.task_state, both built from scratch and refreshed with a
+few new lines.
+
+    python benchmarks/task_state.py --n-lines 1000000
+"""
+
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from typer import run
+
+from dep_wofs.task_state import TaskState
+
+LOG_KEY = "logs/wofs_summary_annual_2020_log.csv"
+_STATUSES = np.array(["complete", "error", "no items found"])
+
+
+def grid(n_tiles: int) -> pd.DataFrame:
+    columns = int(np.ceil(np.sqrt(n_tiles)))
+    index = pd.MultiIndex.from_tuples(
+        [(i % columns, i // columns) for i in range(n_tiles)], names=["column", "row"]
+    )
+    return pd.DataFrame(index=index, data=dict(tile=np.arange(n_tiles)))
+
+
+def log_lines(n_lines: int, n_tiles: int, seed: int = 42) -> bytes:
+    rng = np.random.default_rng(seed)
+    tiles = grid(n_tiles).index[rng.integers(0, n_tiles, n_lines)]
+    statuses = _STATUSES[rng.choice(3, n_lines, p=[0.8, 0.15, 0.05])]
+    return "".join(
+        f"2024-01-01 00:00:00|{tile}|{status}|[]|\n"
+        for tile, status in zip(tiles, statuses)
+    ).encode()
+
+
+def pandas_filter(log: bytes, tiles: pd.DataFrame) -> pd.DataFrame:
+    parsed = pd.read_csv(BytesIO(log), sep="|")
+    finished = set(parsed.loc[parsed.status != "error", "index"])
+    return tiles[[str(index) not in finished for index in tiles.index]]
+
+
+def timed(name, f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    print(f"{name:>22}: {time.perf_counter() - start:7.2f}s")
+    return result
+
+
+def main(n_lines: int = 1_000_000, n_tiles: int = 5_000, n_new: int = 1_000) -> None:
+    tiles = grid(n_tiles)
+    header = b"time|index|status|paths|comment\n"
+    log = header + log_lines(n_lines, n_tiles)
+    new_lines = log_lines(n_new, n_tiles, seed=1)
+
+    expected = timed("pandas full parse", pandas_filter, log, tiles)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        state = TaskState(Path(tmp) / "task_state.sqlite")
+
+        def from_scratch():
+            state.update(LOG_KEY, log, len(log))
+            return state.filter(tiles, LOG_KEY)
+
+        actual = timed("task state, new", from_scratch)
+        assert actual.index.equals(expected.index)
+
+        def refreshed():
+            state.update(LOG_KEY, new_lines, len(log) + len(new_lines))
+            return state.filter(tiles, LOG_KEY)
+
+        actual = timed(f"task state, +{n_new} lines", refreshed)
+        expected = pandas_filter(log + new_lines, tiles)
+        assert actual.index.equals(expected.index)
+
+    print("Filtered tasks are identical")
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,214 @@
+"""Persistent running totals for WOfS summaries.
+
+An `Accumulator` holds the un-finalised counts for a tile (e.g. the output of
+`dep_wofs.summaries.wofs_counts`) together with the ids of the STAC items
+which have been folded into them, so a summary can be updated with only the
+items which are new since it was last built. `FoldedAnnuals` keeps a copy of
+each annual summary folded into the all-time totals, so one which changes can
+be subtracted and added again rather than the totals being rebuilt.
+"""
+
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from odc.geo.xr import assign_crs
+from xarray import DataArray, Dataset, align
+
+from dep_wofs.storage import (
+    delete_key,
+    object_version,
+    read_bytes,
+    s3_client,
+    s3_location,
+    write_bytes,
+)
+from dep_wofs.summaries import full_history_counts
+
+# The variables of an annual summary which are summed into all-time totals
+ANNUAL_COUNTS = ["count_clear", "count_wet"]
+
+
+class Accumulator:
+    """Counts for a tile plus the items they were built from, as a mapping of
+    item id to the item's "updated" timestamp (if it has one)."""
+
+    def __init__(self, counts: Dataset | None = None, items: dict | None = None):
+        self.counts = counts
+        self.items = items if items is not None else dict()
+
+    def add(self, counts: Dataset) -> None:
+        """Add `counts` to the running totals. `counts` must be on exactly the
+        same pixel grid as any existing counts."""
+        if self.counts is None:
+            self.counts = counts
+        else:
+            existing, new = align(self.counts, counts, join="exact")
+            self.counts = Dataset(
+                {
+                    name: var + new[name].astype(var.dtype)
+                    for name, var in existing.items()
+                }
+            )
+
+    def subtract(self, counts: Dataset) -> None:
+        """Take `counts`, which were added earlier, away from the running
+        totals."""
+        existing, old = align(self.counts, counts, join="exact")
+        self.counts = Dataset(
+            {name: var - old[name].astype(var.dtype) for name, var in existing.items()}
+        )
+
+    def to_bytes(self) -> bytes:
+        if self.counts is None:
+            raise ValueError("Nothing has been accumulated")
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            y=self.counts.y.values,
+            x=self.counts.x.values,
+            crs=np.array(str(self.counts.odc.crs or "")),
+            items=np.array(json.dumps(self.items)),
+            **{f"var_{name}": var.values for name, var in self.counts.items()},
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Accumulator":
+        with np.load(io.BytesIO(data)) as stored:
+            coords = dict(y=stored["y"], x=stored["x"])
+            counts = Dataset(
+                {
+                    name.removeprefix("var_"): DataArray(
+                        stored[name], coords=coords, dims=("y", "x")
+                    )
+                    for name in stored.files
+                    if name.startswith("var_")
+                }
+            )
+            crs = str(stored["crs"])
+            if crs:
+                counts = assign_crs(counts, crs)
+            return cls(counts, json.loads(str(stored["items"])))
+
+    def save(self, bucket: str, key: str, client=None) -> None:
+        write_bytes(self.to_bytes(), bucket, key, client)
+
+    @classmethod
+    def load(cls, bucket: str, key: str, client=None) -> "Accumulator":
+        """Load the accumulator at `key`, or an empty one if there is none."""
+        data = read_bytes(bucket, key, client)
+        return cls() if data is None else cls.from_bytes(data)
+
+
+def accumulator_path(itempath, item_id) -> str:
+    """Where the accumulator for `item_id` lives, next to its other outputs."""
+    return f"{itempath._folder(item_id)}/{itempath.basename(item_id)}_accumulator.npz"
+
+
+def tile_accumulator_path(itempath, item_id) -> str:
+    """Where the accumulator for `item_id` lives if it isn't tied to the time
+    range of a run, as for all-time summaries: in the tile's folder rather
+    than that of the time range, so a run with a year added carries on from
+    the last one."""
+    folder = f"{itempath._folder_prefix}/{itempath._format_item_id(item_id)}"
+    name = itempath._format_item_id(item_id, join_str="_")
+    return f"{folder}/{itempath.item_prefix}_{name}_accumulator.npz"
+
+
+def item_time(item) -> np.datetime64 | None:
+    """The time of `item` as in the "time" coordinate of the loaded data, or
+    None if it has none."""
+    value = item.properties.get("datetime") or item.properties.get("start_datetime")
+    if value is None:
+        return None
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp.to_datetime64()
+
+
+class FoldedAnnuals:
+    """A copy of each annual summary folded into the all-time totals saved at
+    `accumulator_key`, stored next to it by item id. An annual summary which
+    has changed or been removed since can then be subtracted from the totals.
+    """
+
+    def __init__(self, bucket: str, accumulator_key: str, client=None):
+        self.bucket = bucket
+        self.prefix = f"{accumulator_key.removesuffix('.npz')}_annuals"
+        self._client = client if client is not None else s3_client()
+        self._times = None
+        self._ids = None
+
+    def _key(self, item_id: str) -> str:
+        return f"{self.prefix}/{item_id}.npz"
+
+    def start(self, items) -> None:
+        """Expect the annual summaries of `items` to be saved."""
+        self._times = np.array([item_time(item) for item in items], "datetime64[ns]")
+        self._ids = [item.id for item in items]
+
+    def save(self, annuals: Dataset) -> None:
+        """Save each annual summary in `annuals`, as the item whose time is
+        nearest its own."""
+        for t in annuals.time.values:
+            item_id = self._ids[np.abs(self._times - t).argmin()]
+            annual = Accumulator(annuals.sel(time=t, drop=True)[ANNUAL_COUNTS])
+            annual.save(self.bucket, self._key(item_id), self._client)
+
+    def subtract(self, accumulator: Accumulator, item_ids) -> bool:
+        """Subtract the annual summaries of `item_ids` from `accumulator` and
+        forget them. If any of them wasn't kept, nothing is subtracted and
+        this is False."""
+        keys = [self._key(item_id) for item_id in item_ids]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            stored = list(
+                executor.map(
+                    lambda key: read_bytes(self.bucket, key, self._client), keys
+                )
+            )
+        if None in stored:
+            return False
+        for item_id, data in zip(item_ids, stored):
+            annual = Accumulator.from_bytes(data).counts.expand_dims("time")
+            accumulator.subtract(full_history_counts(annual).compute())
+            del accumulator.items[item_id]
+        return True
+
+    def delete(self, item_ids) -> None:
+        for item_id in item_ids:
+            delete_key(self.bucket, self._key(item_id), self._client)
+
+
+def item_version(item, client=None) -> str | None:
+    """Something which changes whenever `item` is updated: its "updated"
+    timestamp, or failing that the checksums of its assets, or failing that
+    the ETags of its assets in S3. None if there's no way to tell, in which
+    case the item should be treated as changed."""
+    if "updated" in item.properties:
+        return item.properties["updated"]
+    checksums = [
+        asset.extra_fields.get("file:checksum") for asset in item.assets.values()
+    ]
+    if checksums and all(checksums):
+        return ",".join(checksums)
+
+    locations = [s3_location(asset.href) for asset in item.assets.values()]
+    if not locations or None in locations:
+        return None
+    client = client if client is not None else s3_client()
+    etags = [object_version(bucket, key, client) for bucket, key in locations]
+    return None if None in etags else ",".join(etags)
+
+
+def item_versions(items, client=None) -> dict[str, str | None]:
+    """`item_version` of each of `items`, by id. Items which need their
+    assets' ETags are looked up concurrently."""
+    client = client if client is not None else s3_client()
+    items = list(items)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        versions = executor.map(lambda item: item_version(item, client), items)
+        return {item.id: version for item, version in zip(items, versions)}
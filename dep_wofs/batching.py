@@ -0,0 +1,98 @@
+"""Batches of tasks, so that a single pod can process several tiles and
+years while its dask client, grids and caches stay warm.
+
+`print_tasks.py --batch-cost` packs tasks into batches of roughly equal cost
+and the `process_*_tile.py` scripts run a batch with `--batch`. Costs are
+per tile, keyed like "column,row" or "path,row". By default they're the
+seconds earlier runs of each tile took, from their stage records (see
+`stage_record_costs`), but they can be in any unit and read from a JSON
+object instead.
+"""
+
+import heapq
+import json
+import math
+import warnings
+from typing import Callable
+
+from dep_wofs.instrumentation import read_stage_records
+
+
+def read_costs(path: str) -> dict[str, float]:
+    with open(path) as src:
+        return {key: float(cost) for key, cost in json.load(src).items()}
+
+
+def stage_record_costs(bucket: str, prefix: str, client=None) -> dict[str, float]:
+    """Seconds per tile from the stage records under `prefix`: the median
+    time of the tile's completed runs. Tiles with no completed run, but with
+    a count of the items they searched, are estimated from that count at the
+    median seconds per item of the other tiles."""
+    records = read_stage_records(bucket, prefix, client)
+    if len(records) == 0:
+        return dict()
+
+    runs = records.groupby("run").first()
+    seconds = runs[runs.status == "complete"].groupby("task").task_seconds.median()
+    items = records[records.stage == "search"].groupby("task")["items"].max()
+    items = items[items > 0]
+    costs = seconds.to_dict()
+
+    timed = seconds.index.intersection(items.index)
+    if len(timed) > 0:
+        seconds_per_item = (seconds[timed] / items[timed]).median()
+        for task, n_items in items.items():
+            costs.setdefault(task, float(n_items * seconds_per_item))
+    return costs
+
+
+def task_costs(
+    tasks: list[dict], id_names: tuple[str, str], costs: dict[str, float]
+) -> list[float]:
+    """The cost of each of `tasks`, looked up by tile. Tiles without a cost
+    get the mean of the known costs."""
+    default = sum(costs.values()) / len(costs) if len(costs) > 0 else 1.0
+    return [
+        costs.get(",".join(str(task[name]) for name in id_names), default)
+        for task in tasks
+    ]
+
+
+def pack_tasks(
+    tasks: list[dict], costs: list[float], max_batch_cost: float
+) -> list[list[dict]]:
+    """Split `tasks` into as many batches as are needed for each to cost
+    about `max_batch_cost`, balancing the total cost of each batch by
+    assigning the most expensive remaining task to the cheapest batch
+    (longest processing time first)."""
+    if len(tasks) == 0:
+        return []
+
+    n_batches = min(len(tasks), max(1, math.ceil(sum(costs) / max_batch_cost)))
+    # Batch indices break ties so the task lists are never compared
+    batches = [(0.0, i, []) for i in range(n_batches)]
+    for cost, task in sorted(
+        zip(costs, tasks), key=lambda cost_task: cost_task[0], reverse=True
+    ):
+        total, i, batch = heapq.heappop(batches)
+        batch.append(task)
+        heapq.heappush(batches, (total + cost, i, batch))
+
+    return [batch for _, _, batch in sorted(batches, key=lambda b: b[1])]
+
+
+def run_batch(batch: str, process_tile: Callable[..., None], **kwargs) -> None:
+    """Call `process_tile` for each task in `batch`, a JSON list of task
+    parameters as written by `print_tasks.py`, with `kwargs` added to each.
+    Every task is attempted; if any fail the first error is raised once they
+    have all run, so the batch is retried."""
+    errors = []
+    for task in json.loads(batch):
+        try:
+            process_tile(**task, **kwargs)
+        except Exception as e:
+            warnings.warn(f"Task {task} failed: {e}")
+            errors.append(e)
+
+    if len(errors) > 0:
+        raise errors[0]
@@ -0,0 +1,22 @@
+"""Precompute the grids in grid.py and write them to a local artifact. This is
+run when building the docker image so tasks don't need to download and
+intersect the area of interest at startup."""
+
+from typing import Optional
+
+from typer import run
+
+from dep_wofs.config import GRID_CACHE_DIR
+from dep_wofs.grid import build_grid_cache
+from dep_wofs.mask import build_land_masks
+
+
+def main(cache_dir: Optional[str] = GRID_CACHE_DIR, land_masks: bool = False) -> None:
+    build_grid_cache(cache_dir)
+    if land_masks:
+        build_land_masks(cache_dir)
+    print(f"Grid cache written to {cache_dir}")
+
+
+if __name__ == "__main__":
+    run(main)
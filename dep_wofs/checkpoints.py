@@ -0,0 +1,216 @@
+"""Checkpoints for resuming long runs which are interrupted, e.g. when the
+spot instance they're on is reclaimed and Argo retries them.
+
+A `SceneManifest` records which scenes of a path/row are done as they finish,
+so a retried `process_wofls_tile.py` run skips them without listing the
+path/row's outputs or screening those scenes again. An
+`AccumulatorCheckpoint` holds the partial totals of a summary, saved between
+time batches, so a retried summary carries on from the last batch saved
+rather than the start of the tile.
+
+Both are copied to the bucket at most every `CHECKPOINT_INTERVAL` seconds,
+and `checkpointing` copies them once more if the run fails or the process is
+asked to stop. They're deleted when the run completes.
+"""
+
+import json
+import signal
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+from dep_wofs.accumulators import Accumulator, item_time, item_versions
+from dep_wofs.config import CHECKPOINT_DIR, CHECKPOINT_INTERVAL
+from dep_wofs.storage import delete_key, read_bytes, s3_client, write_bytes
+
+
+def manifest_path(log_path: str, task_id) -> str:
+    """Where the scene manifest of a run of `task_id` is, next to the log at
+    `log_path`, e.g. ".../logs/wofl_2020_log_checkpoints/63_20.jsonl"."""
+    log_path = Path(log_path)
+    task = "_".join(str(i) for i in task_id)
+    return str(log_path.parent / f"{log_path.stem}_checkpoints" / f"{task}.jsonl")
+
+
+def checkpoint_path(itempath, item_id) -> str:
+    """Where the accumulator checkpoint for `item_id` is, next to its other
+    outputs."""
+    return f"{itempath._folder(item_id)}/{itempath.basename(item_id)}_checkpoint.npz"
+
+
+class SceneManifest:
+    """The status of each scene of a run which is done: "exists" if its
+    output was already there, "complete" or "skipped". Scenes which failed
+    aren't recorded, so they're tried again.
+
+    Scenes are appended to a local file in `local_dir` as they finish, and
+    the file is copied to s3://`bucket`/`key` every `interval` seconds. If
+    there is a manifest already, locally or in the bucket, the run is being
+    resumed and the manifest carries on from it.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        key: str,
+        local_dir: str = CHECKPOINT_DIR,
+        interval: float = CHECKPOINT_INTERVAL,
+        client=None,
+    ):
+        self.bucket = bucket
+        self.key = key
+        self._path = Path(local_dir) / key
+        self._interval = interval
+        self._client = client if client is not None else s3_client()
+        # Scenes finish on several threads, and checkpointing may flush
+        # from the main thread while it's adding scenes
+        self._lock = threading.RLock()
+
+        if self._path.exists():
+            data = self._path.read_bytes()
+        else:
+            data = read_bytes(bucket, key, self._client)
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._path.write_bytes(data if data is not None else b"")
+        self.resumed = data is not None
+        self.scenes = _parse_manifest(data if data is not None else b"")
+        self._last_flush = time.monotonic()
+
+    def add(self, statuses: dict[str, str]) -> None:
+        """Record the status of each scene in `statuses`."""
+        lines = "".join(
+            json.dumps(dict(id=scene_id, status=status)) + "\n"
+            for scene_id, status in statuses.items()
+        )
+        with self._lock:
+            with open(self._path, "a") as manifest:
+                manifest.write(lines)
+            self.scenes.update(statuses)
+            if time.monotonic() - self._last_flush >= self._interval:
+                self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            write_bytes(self._path.read_bytes(), self.bucket, self.key, self._client)
+            self._last_flush = time.monotonic()
+
+    def delete(self) -> None:
+        with self._lock:
+            self._path.unlink(missing_ok=True)
+            delete_key(self.bucket, self.key, self._client)
+
+
+def _parse_manifest(data: bytes) -> dict[str, str]:
+    scenes = dict()
+    for line in data.decode().splitlines():
+        try:
+            scene = json.loads(line)
+        except json.JSONDecodeError:
+            # The last line, if the process was killed while writing it
+            continue
+        scenes[scene["id"]] = scene["status"]
+    return scenes
+
+
+class AccumulatorCheckpoint:
+    """The partial totals of a summary at s3://`bucket`/`key`, saved at most
+    every `interval` seconds as time batches of its items are folded in."""
+
+    def __init__(
+        self,
+        bucket: str,
+        key: str,
+        interval: float = CHECKPOINT_INTERVAL,
+        client=None,
+    ):
+        self.bucket = bucket
+        self.key = key
+        self._interval = interval
+        self._client = client if client is not None else s3_client()
+        self._accumulator = None
+        self._items = None
+        # What is saved: only ever replaced whole, between batches, so it's
+        # consistent whenever checkpointing flushes it
+        self._state = None
+        self._last_flush = time.monotonic()
+
+    def load(self) -> Accumulator | None:
+        """The totals saved by an earlier attempt of this run, if any."""
+        data = read_bytes(self.bucket, self.key, self._client)
+        return None if data is None else Accumulator.from_bytes(data)
+
+    def start(self, accumulator: Accumulator, items, versions=None) -> None:
+        """Checkpoint `accumulator` as `items` are folded into it. `versions`
+        are the `item_versions` of `items`, which are looked up if not given."""
+        times = [item_time(item) for item in items]
+        if any(t is None for t in times):
+            warnings.warn("Some items have no datetime, so no checkpoints are saved")
+            return
+        if versions is None:
+            versions = item_versions(items, self._client)
+        self._accumulator = accumulator
+        self._items = [(t, item.id, versions[item.id]) for t, item in zip(times, items)]
+
+    def advance(self, until: np.datetime64 | None) -> None:
+        """Record that every item from before `until` has been folded in. If
+        `until` is None, all of them have, and as the run is about to
+        complete nothing is saved."""
+        if self._accumulator is None or until is None:
+            return
+        self._accumulator.items.update(
+            {item_id: version for t, item_id, version in self._items if t < until}
+        )
+        self._state = Accumulator(
+            self._accumulator.counts, dict(self._accumulator.items)
+        )
+        if time.monotonic() - self._last_flush >= self._interval:
+            self.flush()
+
+    def flush(self) -> None:
+        state = self._state
+        if state is not None:
+            state.save(self.bucket, self.key, self._client)
+            self._last_flush = time.monotonic()
+
+    def delete(self) -> None:
+        delete_key(self.bucket, self.key, self._client)
+
+
+def _flush_all(checkpoints) -> None:
+    for checkpoint in checkpoints:
+        try:
+            checkpoint.flush()
+        except Exception as e:
+            warnings.warn(f"Couldn't flush {checkpoint.key}: {e}")
+
+
+@contextmanager
+def checkpointing(*checkpoints) -> Iterator[None]:
+    """Flush each of `checkpoints` (ignoring any which are None) if the
+    enclosed code fails, or if the process gets SIGTERM, e.g. when a spot
+    instance is about to be reclaimed, in which case it then exits. Either
+    way a retry can resume from them. Signal handlers can only be set from
+    the main thread, so elsewhere only failures are handled."""
+    checkpoints = [checkpoint for checkpoint in checkpoints if checkpoint is not None]
+
+    def terminate(signum, frame):
+        _flush_all(checkpoints)
+        raise SystemExit(128 + signum)
+
+    handle_signal = (
+        len(checkpoints) > 0 and threading.current_thread() is threading.main_thread()
+    )
+    previous = signal.signal(signal.SIGTERM, terminate) if handle_signal else None
+    try:
+        yield
+    except Exception:
+        _flush_all(checkpoints)
+        raise
+    finally:
+        if handle_signal:
+            signal.signal(signal.SIGTERM, previous)
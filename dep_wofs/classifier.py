@@ -0,0 +1,190 @@
+"""A DEP native WOfL classifier for Landsat Collection 2 data.
+
+`wofs.virtualproduct.WOfSClassifier` scales the uint16 reflectance to float64
+and back, builds the decision tree inputs for every band of the whole scene,
+and assembles the bit flags from several full-size intermediate DataArrays.
+Here the scaling (via a lookup table), decision tree, nodata and cloud flags
+and the assembly of the output bits happen in one kernel, applied to each
+block of the input with `map_overlap` (cloud shadow is dilated, so blocks
+need a few pixels of their neighbours). Band ratios are float32 and
+thresholds on single bands are compared as integers, which gives identical
+results to the upstream classifier, see `benchmarks/classify.py`.
+
+Terrain masking depends on the whole DEM at once (shadows are ray traced
+across the scene), so it can't be done a block at a time. `terrain_flags`
+runs the upstream `terrain_filter` as one lazy task per time, and the kernel
+takes each block of its output like another band.
+"""
+
+from functools import cache
+
+import dask.array as da
+import numpy as np
+from dask import delayed, is_dask_collection
+from wofs.constants import (
+    MASKED_CLOUD,
+    MASKED_CLOUD_SHADOW,
+    MASKED_NO_CONTIGUITY,
+    NO_DATA,
+    WATER_PRESENT,
+)
+from wofs.filters import (
+    C2_CIRRUS_BITS,
+    C2_CLOUD_BITS,
+    C2_CLOUD_SHADOW_BITS,
+    C2_DILATED_BITS,
+    dilate,
+    terrain_filter,
+)
+from xarray import DataArray, Dataset
+
+# In the order the decision tree expects, i.e. Landsat 5 & 7 bands 1-5 and 7
+SR_BANDS = ["blue", "green", "red", "nir08", "swir16", "swir22"]
+
+# The value `wofs.virtualproduct.scale_and_clip_dataarray` gives missing or
+# out of range reflectance
+_SCALED_NODATA = -999
+
+# The radius of `wofs.filters.dilate`
+_DILATION_DEPTH = 3
+
+
+@cache
+def c2_scaling_table(nodata: int = 0) -> np.ndarray:
+    """The scaled int16 value for every uint16 Collection 2 reflectance
+    value, computed exactly as `wofs.virtualproduct.scale_usgs_collection2`
+    does it."""
+    values = np.arange(2**16, dtype="uint16")
+    scaled = (values * 0.275 + -2000).astype("int16")
+    scaled[values == nodata] = _SCALED_NODATA
+    scaled[(scaled < 0) | (scaled > 10000)] = _SCALED_NODATA
+    return scaled
+
+
+def _band_ratio(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # Sums and differences of int16 are exact in float32, so this matches
+    # the upstream ratio of float32 bands
+    return (a.astype("float32") - b) / (a.astype("float32") + b)
+
+
+def _is_wet(b1, b2, b3, b4, b5, b7) -> np.ndarray:
+    """N. Mueller's decision tree, as in `wofs.classifier._classify`, for int16
+    scaled bands. Thresholds like `b1 <= 2083.5` are written as the equivalent
+    integer comparison, and branches on ratios negate the test rather than
+    flipping it so NaNs go the same way."""
+    ndi_52 = _band_ratio(b5, b2)
+    ndi_43 = _band_ratio(b4, b3)
+    ndi_72 = _band_ratio(b7, b2)
+
+    left = (b1 <= 2083) & (
+        ((b7 <= 323) & (ndi_43 <= 0.61))
+        | (
+            (b7 > 323)
+            & (
+                ((b1 > 1400) & (ndi_43 <= -0.01))
+                | (
+                    (b1 <= 1400)
+                    & (
+                        (~(ndi_72 <= -0.23) & (b1 <= 379))
+                        | ((ndi_72 <= -0.23) & ((ndi_43 <= 0.22) | (b1 <= 473)))
+                    )
+                )
+            )
+        )
+    )
+    right_low = (
+        (b1 <= 334)
+        & (ndi_43 <= 0.54)
+        & ((ndi_52 <= 0.12) | ((b3 <= 364) & (b1 <= 129)) | ((b3 > 364) & (b1 <= 300)))
+    )
+    right_high = (
+        (ndi_52 <= 0.34) & (b1 <= 249) & (ndi_43 <= 0.45) & (b3 <= 364) & (b1 <= 129)
+    )
+    return np.where(
+        ndi_52 <= -0.01, left, np.where(ndi_52 <= 0.23, right_low, right_high)
+    )
+
+
+def _wofl_block(*arrays, band_nodata: int, qa_nodata: int) -> np.ndarray:
+    """WOfLs for a `(time, y, x)` block of the six SR bands, `qa_pixel` and
+    the terrain flags."""
+    *bands, qa, terrain = arrays
+    table = c2_scaling_table(band_nodata)
+    scaled = [table[band] for band in bands]
+
+    water = np.where(_is_wet(*scaled), np.uint8(WATER_PRESENT), np.uint8(0))
+
+    # `wofs.filters.eo_filter`
+    missing = [band == _SCALED_NODATA for band in scaled] + [qa == qa_nodata]
+    water[np.logical_or.reduce(missing)] |= MASKED_NO_CONTIGUITY
+    water[np.logical_and.reduce(missing)] |= NO_DATA
+
+    # `wofs.filters.c2_filter`
+    water[
+        (qa & (C2_DILATED_BITS | C2_CLOUD_BITS | C2_CIRRUS_BITS)) != 0
+    ] |= MASKED_CLOUD
+    for water_layer, qa_layer in zip(water, qa):
+        water_layer[dilate(qa_layer & C2_CLOUD_SHADOW_BITS)] |= MASKED_CLOUD_SHADOW
+
+    water |= terrain
+
+    # `wofs.wofls._fix_nodata_to_single_value`
+    water[(water & NO_DATA) == NO_DATA] = NO_DATA
+    return water
+
+
+def _terrain_flags(dsm: Dataset, time, **kwargs) -> np.ndarray:
+    # `terrain_filter` only uses the time of the scene it's given
+    scene = Dataset(dict(blue=DataArray(0).assign_coords(time=time)))
+    return terrain_filter(dsm, scene, **kwargs).values.astype("uint8")
+
+
+def terrain_flags(dsm: Dataset, times, **kwargs) -> da.Array:
+    """The flags from `wofs.filters.terrain_filter` of the DEM `dsm` for a
+    scene at each of `times`, as a lazy `(time, y, x)` array with a chunk
+    per time. `kwargs` are passed to `terrain_filter`."""
+    shape = dsm.elevation.shape
+    return da.stack(
+        [
+            da.from_delayed(
+                delayed(_terrain_flags)(dsm, time, **kwargs), shape, dtype="uint8"
+            )
+            for time in times
+        ]
+    )
+
+
+def classify_wofls(
+    data: Dataset, terrain: np.ndarray | da.Array | None = None
+) -> Dataset:
+    """WOfLs for a `(time, y, x)` Dataset of Collection 2 SR bands (named as
+    in `SR_BANDS`) and "qa_pixel", with the same "water" output as
+    `WOfSClassifier(c2_scaling=True)`. `terrain`, if given, holds the terrain
+    flags for each time, e.g. from `terrain_flags`."""
+    qa = data.qa_pixel.transpose("time", "y", "x")
+    arrays = [data[band].transpose("time", "y", "x").data for band in SR_BANDS]
+    arrays.append(qa.data)
+    if terrain is None:
+        terrain = np.zeros(qa.shape, dtype="uint8")
+
+    kwargs = dict(
+        band_nodata=data[SR_BANDS[0]].attrs.get("nodata", 0),
+        qa_nodata=qa.attrs.get("nodata", 1),
+    )
+    if is_dask_collection(qa.data):
+        arrays.append(da.asarray(terrain).rechunk(qa.data.chunks))
+        water = da.map_overlap(
+            _wofl_block,
+            *arrays,
+            depth={0: 0, 1: _DILATION_DEPTH, 2: _DILATION_DEPTH},
+            boundary="none",
+            dtype="uint8",
+            **kwargs,
+        )
+    else:
+        arrays.append(terrain)
+        water = _wofl_block(*[np.asarray(a) for a in arrays], **kwargs)
+
+    output = DataArray(water, coords=qa.coords, dims=qa.dims).to_dataset(name="water")
+    output.water.attrs["nodata"] = NO_DATA
+    return output
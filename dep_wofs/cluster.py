@@ -0,0 +1,104 @@
+"""Dask cluster and chunk sizes fitted to the resources of the container.
+
+A bare `Client()` sizes itself from the host rather than the pod, so on a
+shared node it starts too many workers with memory limits the pod can't
+honour. `cluster_settings` instead reads the CPU and memory limits from the
+cgroup (see resources.py) and `dask_scheduler` starts a cluster to match, or
+uses the threaded or synchronous scheduler where a distributed cluster is
+more overhead than help.
+"""
+
+import math
+import os
+import sys
+from contextlib import contextmanager
+from functools import cache
+from typing import Iterator
+
+import dask
+import psutil
+from distributed import Client
+
+from dep_wofs.config import SMALL_WORK_PIXELS
+from dep_wofs.resources import cpu_limit, memory_limit
+
+SCHEDULERS = ["auto", "distributed", "threads", "sync"]
+
+# Room left for the client process, i.e. the script itself
+_CLIENT_MEMORY_FRACTION = 0.15
+# Each worker process should have at least this much memory
+_MIN_WORKER_MEMORY = 4 * 2**30
+
+_SPILL_CONFIG = {
+    "distributed.worker.memory.target": 0.6,
+    "distributed.worker.memory.spill": 0.7,
+    "distributed.worker.memory.pause": 0.85,
+    "distributed.worker.memory.terminate": 0.95,
+}
+
+
+@cache
+def cluster_settings() -> dict:
+    """Workers, threads per worker and memory per worker (in bytes) for the
+    resources of the container. Uses few worker processes with several
+    threads each, as most of the work (reading COGs, numpy) releases the GIL.
+    """
+    cpus = cpu_limit() or len(os.sched_getaffinity(0))
+    memory = memory_limit() or psutil.virtual_memory().total
+    worker_memory = memory * (1 - _CLIENT_MEMORY_FRACTION)
+
+    threads = max(1, math.floor(cpus))
+    n_workers = max(1, min(threads // 2, int(worker_memory // _MIN_WORKER_MEMORY)))
+    return dict(
+        n_workers=n_workers,
+        threads_per_worker=max(1, threads // n_workers),
+        memory_limit=int(worker_memory // n_workers),
+    )
+
+
+def chunk_size(bytes_per_pixel: float, maximum: int = 4096, minimum: int = 1024) -> int:
+    """The side of square spatial chunks such that each thread working on
+    a chunk needs at most half its share of the memory, given the memory
+    `bytes_per_pixel` a task needs (inputs, intermediates and outputs). A
+    multiple of 512, to line up with COG tiles."""
+    settings = cluster_settings()
+    memory_per_thread = settings["memory_limit"] / settings["threads_per_worker"]
+    side = math.sqrt(memory_per_thread / 2 / bytes_per_pixel)
+    return int(min(maximum, max(minimum, side // 512 * 512)))
+
+
+def choose_scheduler(scheduler: str, n_pixels: int | None = None) -> str:
+    if scheduler not in SCHEDULERS:
+        raise ValueError(f"scheduler must be one of {SCHEDULERS}, not {scheduler}")
+    if scheduler != "auto":
+        return scheduler
+    # A cluster of one worker can't do more in parallel than threads can, so
+    # it only adds its startup, about 10s for a year of a DEP tile (see
+    # benchmarks/scheduler.py)
+    if cluster_settings()["n_workers"] == 1:
+        return "threads"
+    if n_pixels is not None and n_pixels <= SMALL_WORK_PIXELS:
+        return "threads"
+    return "distributed"
+
+
+@contextmanager
+def dask_scheduler(
+    scheduler: str = "distributed", n_pixels: int | None = None
+) -> Iterator[str]:
+    """Run the enclosed computations with `scheduler`, one of `SCHEDULERS`.
+    "auto" picks "threads" if the cluster would only have one worker or
+    `n_pixels`, the size of the work, is at most `SMALL_WORK_PIXELS`, and
+    "distributed" otherwise. The choice and cluster settings are printed to
+    stderr."""
+    scheduler = choose_scheduler(scheduler, n_pixels)
+    settings = cluster_settings()
+    print(f"Using the {scheduler} dask scheduler, {settings}", file=sys.stderr)
+
+    if scheduler == "distributed":
+        with dask.config.set(_SPILL_CONFIG), Client(**settings):
+            yield scheduler
+    else:
+        threads = settings["n_workers"] * settings["threads_per_worker"]
+        with dask.config.set(scheduler=scheduler, num_workers=threads):
+            yield scheduler
@@ -4,3 +4,49 @@ BUCKET = os.environ.get("WOFS_BUCKET", "dep-public-data")
 OUTPUT_COLLECTION_ROOT = os.environ.get(
     "OUTPUT_COLLECTION_ROOT", "https://stac.digitalearthpacific.org"
 )
+
+# Location of the prebuilt grid artifact, see build_grid_cache.py
+GRID_CACHE_DIR = os.environ.get("WOFS_GRID_CACHE_DIR", "data/grid_cache")
+
+# Local cache of the DEM used for terrain masking, see dem.py. Set
+# WOFS_DEM_CACHE_S3_PREFIX to also share cached DEMs through the bucket.
+DEM_CACHE_DIR = os.environ.get("WOFS_DEM_CACHE_DIR", "/tmp/dep-wofs/dem")
+DEM_CACHE_MAX_BYTES = int(os.environ.get("WOFS_DEM_CACHE_MAX_BYTES", 4 * 2**30))
+DEM_CACHE_S3_PREFIX = os.environ.get("WOFS_DEM_CACHE_S3_PREFIX")
+
+# Local copy of the compacted task logs, see task_state.py
+TASK_STATE_PATH = os.environ.get(
+    "WOFS_TASK_STATE_PATH", "/tmp/dep-wofs/task_state.sqlite"
+)
+
+# STAC catalogs the inputs are found in. Each may instead be the path or URL
+# of a static catalog (a catalog.json), see searchers.py
+LANDSAT_STAC_URL = os.environ.get(
+    "WOFS_LANDSAT_STAC_URL", "https://landsatlook.usgs.gov/stac-server"
+)
+DEP_STAC_URL = os.environ.get(
+    "WOFS_DEP_STAC_URL", "https://stac.prod.digitalearthpacific.io"
+)
+DEM_STAC_URL = os.environ.get(
+    "WOFS_DEM_STAC_URL", "https://earth-search.aws.element84.com/v1"
+)
+
+# Local cache of STAC API responses, see stac_cache.py. Responses younger
+# than WOFS_STAC_CACHE_TTL seconds are used without asking the server.
+STAC_CACHE_DIR = os.environ.get("WOFS_STAC_CACHE_DIR", "/tmp/dep-wofs/stac")
+STAC_CACHE_TTL = float(os.environ.get("WOFS_STAC_CACHE_TTL", 6 * 60 * 60))
+
+# An S3 compatible object store (e.g. minio, or moto in server mode) to use
+# instead of AWS, like "http://localhost:9000". See storage.py
+S3_ENDPOINT_URL = os.environ.get("WOFS_S3_ENDPOINT_URL")
+
+# Checkpoints of long runs, see checkpoints.py. They're kept locally in
+# WOFS_CHECKPOINT_DIR and copied to the bucket at most every
+# WOFS_CHECKPOINT_INTERVAL seconds, and when the process is terminated.
+CHECKPOINT_DIR = os.environ.get("WOFS_CHECKPOINT_DIR", "/tmp/dep-wofs/checkpoints")
+CHECKPOINT_INTERVAL = float(os.environ.get("WOFS_CHECKPOINT_INTERVAL", 5 * 60))
+
+# With `--scheduler auto`, work of no more than this many pixels is run with
+# the threaded scheduler rather than a distributed cluster, see cluster.py.
+# Measure it for the nodes tasks run on with benchmarks/scheduler.py.
+SMALL_WORK_PIXELS = int(os.environ.get("WOFS_SMALL_WORK_PIXELS", 3200 * 3200))
@@ -0,0 +1,333 @@
+"""Per path/row time series of WOfLs, stored as Zarr.
+
+With `--cube`, `process_wofls_tile.py` also writes the water layer of each
+scene into a Zarr store for its path/row and year: a `(time, y, x)` cube on a
+fixed pixel grid covering the path/row, with the id of each scene along
+time. The annual summaries can then read a year of WOfLs for a DEP tile as a
+handful of large, compressed chunks (see `CubeSearcher` and `CubeLoader`)
+instead of searching for and opening hundreds of small COGs.
+
+A cube is only ever written by the one task for its path/row and year, so
+cubes are created and appended to without coordinating with other tasks.
+Slots are reserved for all of the path/row's scenes in the year, in time
+order, before any are processed, so scenes can be written concurrently and
+in any order. Scenes which already have a COG are copied in from it, and
+scenes which are skipped leave their slot as nodata. Which slots have been
+written is recorded along time, so a later run only fills in the rest.
+"""
+
+import threading
+import warnings
+from itertools import groupby, product
+from typing import Callable
+
+import dask.array as da
+import numpy as np
+import pandas as pd
+import rasterio
+import xarray as xr
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import assign_crs, wrap_xr, xr_coords
+from xarray import DataArray, Dataset
+
+from dep_tools.exceptions import EmptyCollectionError
+from dep_tools.searchers import Searcher
+
+from dep_wofs.grid import landsat_grid
+from dep_wofs.reproject import reproject_stack
+from dep_wofs.searchers import _area_geometry, _datetime_range
+from dep_wofs.storage import s3_storage_options
+
+# The nodata value of the WOfL bitmask
+NODATA = 1
+
+# About 8 scenes, or two months, of a quarter of a path/row per chunk
+CUBE_CHUNKS = dict(time=8, y=2048, x=2048)
+
+RESOLUTION = 30
+
+# Slots per chunk of the record of which slots are written, which is more
+# than a year of scenes
+WRITTEN_CHUNK = 128
+
+# Scenes of a path/row shift by a few pixels between acquisitions, so a new
+# cube extends this many pixels beyond the scenes it was created for
+CUBE_PADDING = 256
+
+_ZARR_KWARGS = dict(zarr_format=3, consolidated=False)
+
+
+def cube_url(itempath, tile_id, year: int) -> str:
+    """Where the cube for `year` of the path/row `tile_id` of the
+    `DailyItemPath` `itempath` is. It's next to the prefix of the daily
+    outputs rather than under it, so listing those doesn't list every chunk."""
+    prefix = itempath.tile_prefix(tile_id).rstrip("/")
+    return f"s3://{itempath.bucket}/{prefix}_{year}.zarr"
+
+
+def read_wofl(href: str) -> DataArray:
+    """The water layer of the daily COG at `href`."""
+    with rasterio.open(href) as src:
+        geobox = GeoBox(src.shape, src.transform, src.crs)
+        return wrap_xr(src.read(1), geobox)
+
+
+def _window(cube: GeoBox, geobox: GeoBox) -> tuple | None:
+    """The slices of `cube` and of `geobox` where they overlap, or None if
+    they don't or aren't on the same pixel grid."""
+    if cube.crs != geobox.crs or cube.resolution != geobox.resolution:
+        return None
+    col, row = ~cube.affine * (geobox.affine.c, geobox.affine.f)
+    if abs(col - round(col)) > 1e-6 or abs(row - round(row)) > 1e-6:
+        return None
+    col, row = round(col), round(row)
+    y0, y1 = max(row, 0), min(row + geobox.shape.y, cube.shape.y)
+    x0, x1 = max(col, 0), min(col + geobox.shape.x, cube.shape.x)
+    if y0 >= y1 or x0 >= x1:
+        return None
+    return (slice(y0, y1), slice(x0, x1)), (
+        slice(y0 - row, y1 - row),
+        slice(x0 - col, x1 - col),
+    )
+
+
+def _open(url: str) -> Dataset | None:
+    try:
+        ds = xr.open_zarr(url, storage_options=s3_storage_options(), **_ZARR_KWARGS)
+    except FileNotFoundError:
+        return None
+    return assign_crs(ds, ds.attrs["crs"])
+
+
+class PathRowCube:
+    """The cube at `url`. If there isn't one yet, it's created on the pixel
+    grid `geobox` when slots are first reserved, e.g. the `footprint_geobox`
+    of the path/row's scenes padded by `CUBE_PADDING`. `written` is the ids
+    of the scenes whose slot has been written."""
+
+    def __init__(self, url: str, geobox: GeoBox | None = None):
+        self.url = url
+        self._lock = threading.Lock()
+        ds = _open(url)
+        if ds is None:
+            self.geobox = geobox
+            self.times = np.array([], dtype="datetime64[ns]")
+            self.scene_ids = np.array([], dtype=object)
+            self.written = set()
+        else:
+            self.geobox = ds.odc.geobox
+            self.times = ds.time.values
+            self.scene_ids = ds.scene_id.values
+            self.written = set(self.scene_ids[ds.written.values.astype(bool)])
+        self._slots = {scene_id: i for i, scene_id in enumerate(self.scene_ids)}
+
+    @property
+    def exists(self) -> bool:
+        return len(self.scene_ids) > 0
+
+    def reserve(self, items) -> None:
+        """Add a slot, in time order, for each of `items` not already in the
+        cube. Only the coordinates are written, and each slot is recorded as
+        not written yet."""
+        new = sorted(
+            (item for item in items if item.id not in self._slots),
+            key=lambda item: item.datetime,
+        )
+        if len(new) == 0:
+            return
+        times = np.array(
+            [np.datetime64(item.datetime.replace(tzinfo=None), "ns") for item in new]
+        )
+        scene_ids = np.array([item.id for item in new], dtype=object)
+        shape = (len(new),) + self.geobox.shape.yx
+        chunks = (CUBE_CHUNKS["time"], CUBE_CHUNKS["y"], CUBE_CHUNKS["x"])
+        ds = Dataset(
+            dict(
+                water=(
+                    ("time", "y", "x"),
+                    da.full(shape, NODATA, dtype="uint8", chunks=chunks),
+                ),
+                written=("time", np.zeros(len(new), dtype="uint8")),
+            ),
+            coords=dict(time=times, scene_id=("time", scene_ids)),
+            # Given with every append, as appending replaces the attributes
+            attrs=dict(crs=str(self.geobox.crs)),
+        )
+        # The water layer is never computed, so none of its chunks are
+        # written and reading them gives the fill value
+        if self.exists:
+            ds.to_zarr(
+                self.url,
+                append_dim="time",
+                compute=False,
+                storage_options=s3_storage_options(),
+                **_ZARR_KWARGS,
+            )
+        else:
+            ds = ds.assign_coords(xr_coords(self.geobox, crs_coord_name=None))
+            ds.to_zarr(
+                self.url,
+                mode="w-",
+                compute=False,
+                encoding=dict(
+                    water=dict(chunks=chunks, fill_value=NODATA),
+                    # Small enough to read whole when the cube is opened
+                    written=dict(chunks=(WRITTEN_CHUNK,)),
+                ),
+                storage_options=s3_storage_options(),
+                **_ZARR_KWARGS,
+            )
+        self._slots.update(
+            {scene_id: len(self.scene_ids) + i for i, scene_id in enumerate(scene_ids)}
+        )
+        self.times = np.concatenate([self.times, times])
+        self.scene_ids = np.concatenate([self.scene_ids, scene_ids])
+
+    def write(self, scene_id: str, water: DataArray) -> bool:
+        """Write `water`, the WOfL of `scene_id`, into its slot. Returns False
+        without writing if the scene has no slot or `water` isn't on the
+        cube's pixel grid."""
+        if "time" in water.dims:
+            water = water.isel(time=0)
+        index = self._slots.get(scene_id)
+        window = None if index is None else _window(self.geobox, water.odc.geobox)
+        if window is None:
+            return False
+
+        (rows, cols), (scene_rows, scene_cols) = window
+        data = np.asarray(water.transpose("y", "x").values[scene_rows, scene_cols])
+        region = dict(time=slice(index, index + 1), y=rows, x=cols)
+        ds = Dataset(
+            dict(
+                water=(("time", "y", "x"), data[np.newaxis]),
+                written=("time", np.ones(1, dtype="uint8")),
+            )
+        )
+        # Chunks are shared by several scenes, and each write reads, updates
+        # and rewrites them
+        with self._lock:
+            ds.to_zarr(
+                self.url,
+                region=region,
+                storage_options=s3_storage_options(),
+                **_ZARR_KWARGS,
+            )
+            self.written.add(scene_id)
+        return True
+
+
+class PathRowCubes:
+    """The cubes of a path/row, one per year, at `url(year)`. Cubes which
+    don't exist yet are created on the pixel grid `geobox` (see
+    `PathRowCube`)."""
+
+    def __init__(self, url: Callable[[int], str], geobox: GeoBox):
+        self._url = url
+        self._geobox = geobox
+        self._cubes = dict()
+        self._lock = threading.Lock()
+
+    def for_year(self, year: int) -> PathRowCube:
+        with self._lock:
+            if year not in self._cubes:
+                self._cubes[year] = PathRowCube(self._url(year), self._geobox)
+            return self._cubes[year]
+
+    def for_item(self, item) -> PathRowCube:
+        return self.for_year(item.datetime.year)
+
+    def reserve(self, items) -> None:
+        """Reserve a slot for each of `items` in the cube for its year."""
+        by_year = groupby(
+            sorted(items, key=lambda item: item.datetime),
+            key=lambda item: item.datetime.year,
+        )
+        for year, year_items in by_year:
+            self.for_year(year).reserve(list(year_items))
+
+    def unwritten(self, items) -> list:
+        """Those of `items` whose slot hasn't been written."""
+        return [item for item in items if item.id not in self.for_item(item).written]
+
+
+class CubeWriter:
+    """Wraps the writer of a scene's task so the water layer of its output is
+    written to `cube` too. The output is loaded first, so the scene is only
+    computed once."""
+
+    def __init__(self, writer, cube: PathRowCube, scene_id: str):
+        self._writer = writer
+        self._cube = cube
+        self._scene_id = scene_id
+
+    def write(self, ds: Dataset, item_id):
+        ds = ds.load()
+        if not self._cube.write(self._scene_id, ds.water):
+            warnings.warn(f"{self._scene_id} couldn't be added to {self._cube.url}")
+        return self._writer.write(ds, item_id)
+
+
+class CubeScene:
+    """A scene in a cube, standing in for its STAC item."""
+
+    def __init__(self, id: str, datetime: np.datetime64, url: str, index: int):
+        self.id = id
+        self.properties = dict(datetime=str(datetime))
+        self.assets = dict()
+        self.url = url
+        self.index = index
+
+
+class CubeSearcher(Searcher):
+    """Finds the scenes within `datetime` in the cubes of the path/rows which
+    intersect the area. `url` gives the url of the cube for a path/row and
+    year."""
+
+    def __init__(self, url: Callable[[tuple, int], str], datetime: str):
+        self._url = url
+        self._datetime = datetime
+
+    def search(self, area) -> list[CubeScene]:
+        geometry = _area_geometry(area)
+        path_rows = landsat_grid()
+        path_rows = path_rows[path_rows.intersects(geometry.geom)]
+        start, end = _datetime_range(self._datetime)
+
+        scenes = []
+        years = range(start.year, end.year + 1)
+        for path_row, year in product(path_rows.index, years):
+            url = self._url(path_row, year)
+            cube = PathRowCube(url)
+            times = pd.DatetimeIndex(cube.times).tz_localize("UTC")
+            scenes += [
+                CubeScene(str(cube.scene_ids[i]), cube.times[i], url, int(i))
+                for i in np.flatnonzero((times >= start) & (times <= end))
+            ]
+        if len(scenes) == 0:
+            raise EmptyCollectionError()
+        return scenes
+
+
+class CubeLoader:
+    """Loads the WOfLs of `CubeScene`s onto the area's pixel grid, like
+    `OdcLoader` does from their COGs. Only the chunks of each cube covering
+    the area are read, and they're gathered onto the area with a cached
+    `ReprojectionPlan` (see reproject.py)."""
+
+    def __init__(self, chunks: dict | None = None):
+        self._chunks = chunks
+
+    def load(self, scenes: list[CubeScene], area: GeoBox) -> Dataset:
+        stacks = []
+        for url, cube_scenes in groupby(
+            sorted(scenes, key=lambda scene: (scene.url, scene.index)),
+            key=lambda scene: scene.url,
+        ):
+            water = _open(url).water
+            water = water.isel(time=[scene.index for scene in cube_scenes])
+            bbox = area.extent.to_crs(water.odc.crs).buffer(2 * RESOLUTION).boundingbox
+            water = water.sel(
+                y=slice(bbox.top, bbox.bottom), x=slice(bbox.left, bbox.right)
+            )
+            stacks.append(reproject_stack(water, area, NODATA, self._chunks))
+        return Dataset(dict(water=xr.concat(stacks, dim="time").sortby("time")))
@@ -0,0 +1,238 @@
+"""The Copernicus 30m DEM used for WOfS terrain masking, with a persistent
+cache.
+
+Loading the DEM means a search against earth-search, which can get overloaded
+and refuse connections when running with many parallel pods (say 100+), and
+reading and reprojecting the DEM COGs. `DemCache` instead keeps the DEM for
+each Landsat path/row and CRS already reprojected onto a padded superset of
+the scene's pixel grid, on local disk and optionally in S3. Scenes of the same
+path/row are then served by cropping the cached superset, or resampling it if
+the pixel grids don't line up.
+"""
+
+import hashlib
+import json
+import os
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+from affine import Affine
+from odc.geo.geobox import GeoBox
+from odc.geo.geom import Geometry, box, unary_union
+from odc.geo.xr import wrap_xr
+from odc.stac import load
+from xarray import DataArray
+
+from dep_wofs.config import (
+    BUCKET,
+    DEM_CACHE_DIR,
+    DEM_CACHE_MAX_BYTES,
+    DEM_CACHE_S3_PREFIX,
+    DEM_STAC_URL,
+)
+from dep_wofs.searchers import catalog_searcher
+from dep_wofs.storage import read_bytes, s3_client, write_bytes
+
+# Scenes of the same path/row shift by a few pixels between acquisitions, so
+# the cached DEM extends this many pixels beyond the scene it was loaded for
+DEM_PADDING = 256
+
+
+def load_dem(geobox: GeoBox) -> DataArray:
+    """Search for and load the DEM on `geobox`."""
+    # Use a dep-tools searcher instead of just searching to be OK across -180
+    items = catalog_searcher(
+        # Note that earth-search can get overloaded and refuse connections
+        # when running with many parallel pods (say 100+)
+        DEM_STAC_URL,
+        collections=["cop-dem-glo-30"],
+    ).search(geobox)
+    return load(items, geobox=geobox)["data"].squeeze(drop=True)
+
+
+def _item_crs(item) -> str | None:
+    if "proj:epsg" in item.properties:
+        return f"EPSG:{item.properties['proj:epsg']}"
+    return item.properties.get("proj:code")
+
+
+def _projection(item, name: str):
+    """The projection field `name` of `item`, or of any of its assets."""
+    if name in item.properties:
+        return item.properties[name]
+    for asset in item.assets.values():
+        if name in asset.extra_fields:
+            return asset.extra_fields[name]
+    return None
+
+
+def _item_extent(item, crs: str) -> Geometry:
+    """The extent of `item`'s rasters in its own CRS, `crs`, from its
+    projection fields. Failing those, its footprint, which only covers the
+    valid data and so can fall short of the rasters."""
+    bbox = _projection(item, "proj:bbox")
+    if bbox is not None and len(bbox) == 4:
+        return box(*bbox, crs)
+    shape = _projection(item, "proj:shape")
+    transform = _projection(item, "proj:transform")
+    if shape is not None and transform is not None:
+        return GeoBox(shape, Affine(*transform[:6]), crs).extent
+    return Geometry(item.geometry, "EPSG:4326").to_crs(crs)
+
+
+def footprint_geobox(items, resolution: float = 30) -> GeoBox | None:
+    """A geobox covering the rasters of all `items` in the most common CRS
+    among them, on the pixel grid `odc.stac.load(..., anchor="center")` uses.
+    None if the items don't record their CRS."""
+    crs, _ = Counter(_item_crs(item) for item in items).most_common(1)[0]
+    if crs is None:
+        return None
+
+    footprint = unary_union(
+        [_item_extent(item, crs) for item in items if _item_crs(item) == crs]
+    )
+    return GeoBox.from_geopolygon(
+        footprint, resolution=resolution, crs=crs, anchor="center"
+    )
+
+
+def is_aligned(superset: GeoBox, geobox: GeoBox) -> bool:
+    """Whether `geobox` is exactly a window of `superset`."""
+    return (
+        superset.crs == geobox.crs and superset[superset.overlap_roi(geobox)] == geobox
+    )
+
+
+def covers(superset: GeoBox, geobox: GeoBox) -> bool:
+    return superset.crs == geobox.crs and superset.extent.contains(geobox.extent)
+
+
+class DemCache:
+    """A content addressed cache of DEM supersets. Entries are keyed by a
+    caller supplied `key` (the Landsat path/row), the CRS and the pixel grid,
+    and stored as `.npy` files so crops can be read with a memory map. Local
+    files beyond `max_bytes` are evicted, least recently used first. If
+    `s3_prefix` is set, entries are also shared through the output bucket.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path | str = DEM_CACHE_DIR,
+        max_bytes: int = DEM_CACHE_MAX_BYTES,
+        s3_prefix: str | None = DEM_CACHE_S3_PREFIX,
+        bucket: str = BUCKET,
+    ):
+        self._cache_dir = Path(cache_dir)
+        self._max_bytes = max_bytes
+        self._s3_prefix = s3_prefix
+        self._bucket = bucket
+
+    def get(self, geobox: GeoBox, key: str) -> DataArray:
+        """The DEM on `geobox`, from the cache if possible."""
+        entry = self._entry_name(geobox, key)
+        superset = self._read_geobox(entry)
+        if superset is None:
+            superset = geobox.pad(DEM_PADDING)
+            self._write(entry, superset, load_dem(superset).values)
+        elif not covers(superset, geobox):
+            # Grow the existing entry, on the same pixel grid
+            superset = superset.enclosing(
+                superset.extent | geobox.pad(DEM_PADDING).extent
+            )
+            self._write(entry, superset, load_dem(superset).values)
+
+        data_path = self._cache_dir / f"{entry}.npy"
+        os.utime(data_path)  # Marks it as recently used
+        dem = np.load(data_path, mmap_mode="r")
+        if is_aligned(superset, geobox):
+            return wrap_xr(np.array(dem[superset.overlap_roi(geobox)]), geobox)
+
+        roi = superset.overlap_roi(geobox.pad(1))
+        return (
+            wrap_xr(np.array(dem[roi]), superset[roi])
+            .odc.reproject(geobox, resampling="nearest")
+            .compute()
+        )
+
+    def _entry_name(self, geobox: GeoBox, key: str) -> str:
+        # Pixel grids with the same resolution and phase can share an entry
+        affine = geobox.affine
+        grid = dict(
+            key=key,
+            crs=geobox.crs.to_wkt(),
+            resolution=[affine.a, affine.e],
+            phase=[affine.c % affine.a, affine.f % affine.e],
+        )
+        return hashlib.sha256(json.dumps(grid, sort_keys=True).encode()).hexdigest()
+
+    def _read_geobox(self, entry: str) -> GeoBox | None:
+        geobox_path = self._cache_dir / f"{entry}.json"
+        if not geobox_path.exists() and not self._download(entry):
+            return None
+        stored = json.loads(geobox_path.read_text())
+        return GeoBox(stored["shape"], Affine(*stored["affine"]), stored["crs"])
+
+    def _write(self, entry: str, geobox: GeoBox, data: np.ndarray) -> None:
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        geobox_json = json.dumps(
+            dict(
+                shape=list(geobox.shape),
+                affine=list(geobox.affine)[:6],
+                crs=geobox.crs.to_wkt(),
+            )
+        )
+        # Written to temporary files and renamed so readers in other processes
+        # never see a partial entry. The geobox goes last as it marks the
+        # entry as present.
+        for suffix, write in [
+            (".npy", lambda path: np.save(path, data)),
+            (".json", lambda path: path.write_text(geobox_json)),
+        ]:
+            tmp_path = self._cache_dir / f"{entry}.tmp{suffix}"
+            write(tmp_path)
+            tmp_path.replace(self._cache_dir / f"{entry}{suffix}")
+
+        if self._s3_prefix is not None:
+            client = s3_client()
+            for suffix in [".npy", ".json"]:
+                path = self._cache_dir / f"{entry}{suffix}"
+                write_bytes(path.read_bytes(), self._bucket, self._s3_key(path), client)
+
+        self._evict(keep=entry)
+
+    def _download(self, entry: str) -> bool:
+        if self._s3_prefix is None:
+            return False
+        client = s3_client()
+        contents = dict()
+        for suffix in [".npy", ".json"]:
+            path = self._cache_dir / f"{entry}{suffix}"
+            contents[path] = read_bytes(self._bucket, self._s3_key(path), client)
+            if contents[path] is None:
+                return False
+
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        for path, data in contents.items():
+            tmp_path = path.with_suffix(".tmp" + path.suffix)
+            tmp_path.write_bytes(data)
+            tmp_path.replace(path)
+        return True
+
+    def _s3_key(self, path: Path) -> str:
+        return f"{self._s3_prefix}/{path.name}"
+
+    def _evict(self, keep: str) -> None:
+        entries = sorted(
+            (path for path in self._cache_dir.glob("*.npy") if ".tmp" not in path.name),
+            key=lambda path: path.stat().st_mtime,
+        )
+        total = sum(path.stat().st_size for path in entries)
+        for path in entries:
+            if total <= self._max_bytes:
+                break
+            if path.stem == keep:
+                continue
+            total -= path.stat().st_size
+            path.with_suffix(".json").unlink(missing_ok=True)
+            path.unlink(missing_ok=True)
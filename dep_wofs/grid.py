@@ -1,37 +1,218 @@
+"""Grids used to define processing tasks.
+
+Building the DEP grid means downloading the GADM area of interest and
+intersecting the full gridspec with it, which is slow. The results are
+written once to a versioned artifact (see `build_grid_cache.py`) which is
+baked into the docker image and read lazily, and only once, by the accessor
+functions below. If the artifact is missing or was built from different
+inputs, everything is recomputed from the source data.
+"""
+
+import hashlib
+import json
+import shutil
+import warnings
+from functools import cache
+from importlib.metadata import PackageNotFoundError, version
 from pathlib import Path
+
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+from affine import Affine
+from dep_tools import grids
+from odc.geo.geobox import GeoBox
 
-from dep_tools.grids import grid
-
-# Replace this when the grid gymnastics have passed
-GADM = gpd.read_file(
-    "https://dep-public-staging.s3.us-west-2.amazonaws.com/aoi/aoi.gpkg", layer="aoi"
-)
+from dep_wofs.config import GRID_CACHE_DIR
 
-# This needs to be addressed. The intersection code for the gridspec is just
-# too slow because it needs to do the buffer. So either fix that, or cache
-# this grid like coastlines
-grid_gpdf = grid(intersect_with=GADM, return_type="GeoDataFrame")
-grid_gs = grid()
-# Use for wofs, i.e. summary products
-grid = pd.DataFrame(
-    index=grid_gpdf.index,
-    data=dict(geobox=[grid_gs.tile_geobox(i) for i in grid_gpdf.index]),
-)
+GADM_URL = "https://dep-public-staging.s3.us-west-2.amazonaws.com/aoi/aoi.gpkg"
+WRS2_URL = "https://d9-wret.s3.us-west-2.amazonaws.com/assets/palladium/production/s3fs-public/atoms/files/WRS2_descending_0.zip"
 
+# Bump this whenever the layout of the cache or the way any of its contents
+# are derived changes.
+GRID_CACHE_VERSION = 1
 
-# Used for wofls, i.e. daily products
 ls_grid_path = Path("data/ls_grid.gpkg")
-if not ls_grid_path.exists():
-    landsat_pathrows = gpd.read_file(
-        "https://d9-wret.s3.us-west-2.amazonaws.com/assets/palladium/production/s3fs-public/atoms/files/WRS2_descending_0.zip"
+
+_MANIFEST = "manifest.json"
+_GADM_FILE = "aoi.gpkg"
+_DEP_GRID_FILE = "dep_grid.gpkg"
+_GEOBOXES_FILE = "geoboxes.npz"
+_LS_GRID_FILE = "ls_grid.gpkg"
+
+
+def grid_cache_key() -> str:
+    """A hash of everything the cached grids are derived from. A cache built
+    with a different key is considered stale."""
+    try:
+        dep_tools_version = version("dep-tools")
+    except PackageNotFoundError:
+        dep_tools_version = None
+
+    inputs = dict(
+        cache_version=GRID_CACHE_VERSION,
+        gadm_url=GADM_URL,
+        wrs2_url=WRS2_URL,
+        dep_tools_version=dep_tools_version,
+    )
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def _read_gadm() -> gpd.GeoDataFrame:
+    return gpd.read_file(GADM_URL, layer="aoi")
+
+
+def _compute_dep_grid(gadm: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    # The intersection code for the gridspec is just too slow because it needs
+    # to do the buffer, which is why the result is cached.
+    return grids.grid(intersect_with=gadm, return_type="GeoDataFrame")
+
+
+def _compute_geoboxes(index: pd.Index, gridspec) -> pd.DataFrame:
+    return pd.DataFrame(
+        index=index, data=dict(geobox=[gridspec.tile_geobox(i) for i in index])
     )
-    ls_grid = landsat_pathrows.loc[
+
+
+def _compute_ls_grid(gadm: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    if ls_grid_path.exists():
+        return gpd.read_file(ls_grid_path)
+
+    landsat_pathrows = gpd.read_file(WRS2_URL)
+    gadm_union = gpd.GeoDataFrame(geometry=[gadm.unary_union], crs=gadm.crs)
+    return landsat_pathrows.loc[
         landsat_pathrows.sjoin(
             gadm_union.to_crs(landsat_pathrows.crs), how="inner"
-        ).index
+        ).index.unique()
     ]
-    ls_grid.to_file(ls_grid_path)
 
-ls_grid = gpd.read_file(ls_grid_path).set_index(["PATH", "ROW"])
+
+def _geoboxes_to_arrays(geoboxes: pd.DataFrame) -> dict:
+    """Pack a DataFrame of geoboxes into plain arrays: the index, one row of
+    affine coefficients and one (height, width) shape per tile, and the single
+    CRS shared by all tiles."""
+    crs = {str(g.crs) for g in geoboxes.geobox}
+    if len(crs) != 1:
+        raise ValueError(f"Expected all tiles to share a CRS, found {crs}")
+
+    index = geoboxes.index.to_frame(index=False)
+    return dict(
+        index=index.to_numpy(dtype="int64"),
+        index_names=np.array(index.columns, dtype=str),
+        affine=np.array([tuple(g.affine)[:6] for g in geoboxes.geobox]),
+        shape=np.array([tuple(g.shape) for g in geoboxes.geobox], dtype="int64"),
+        crs=np.array(crs.pop()),
+    )
+
+
+def _geoboxes_from_arrays(arrays) -> pd.DataFrame:
+    index = pd.MultiIndex.from_arrays(
+        arrays["index"].T, names=arrays["index_names"].tolist()
+    )
+    crs = str(arrays["crs"])
+    return pd.DataFrame(
+        index=index,
+        data=dict(
+            geobox=[
+                GeoBox(tuple(shape), Affine(*affine), crs)
+                for shape, affine in zip(arrays["shape"], arrays["affine"])
+            ]
+        ),
+    )
+
+
+def build_grid_cache(cache_dir: Path | str = GRID_CACHE_DIR) -> Path:
+    """Compute all grids from their source data and write them to `cache_dir`."""
+    cache_dir = Path(cache_dir)
+    # Start clean so nothing derived from an older version is left behind
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    cache_dir.mkdir(parents=True)
+
+    gadm = _read_gadm()
+    dep_grid = _compute_dep_grid(gadm)
+    geoboxes = _compute_geoboxes(dep_grid.index, grids.grid())
+    ls_grid = _compute_ls_grid(gadm)
+
+    gadm.to_file(cache_dir / _GADM_FILE, layer="aoi")
+    dep_grid.to_file(cache_dir / _DEP_GRID_FILE)
+    np.savez(cache_dir / _GEOBOXES_FILE, **_geoboxes_to_arrays(geoboxes))
+    ls_grid.to_file(cache_dir / _LS_GRID_FILE)
+
+    # Written last so a partially written cache is never considered valid
+    manifest = dict(version=GRID_CACHE_VERSION, key=grid_cache_key())
+    (cache_dir / _MANIFEST).write_text(json.dumps(manifest))
+
+    return cache_dir
+
+
+def _cache_is_valid(cache_dir: Path) -> bool:
+    manifest_path = cache_dir / _MANIFEST
+    if not manifest_path.exists():
+        return False
+    manifest = json.loads(manifest_path.read_text())
+    if manifest.get("key") != grid_cache_key():
+        warnings.warn(f"Grid cache at {cache_dir} is stale, recomputing grids")
+        return False
+    return True
+
+
+def _cached_gadm(cache_dir: Path) -> gpd.GeoDataFrame:
+    return gpd.read_file(cache_dir / _GADM_FILE, layer="aoi")
+
+
+def _cached_geoboxes(cache_dir: Path) -> pd.DataFrame:
+    with np.load(cache_dir / _GEOBOXES_FILE) as arrays:
+        return _geoboxes_from_arrays(arrays)
+
+
+def grid_cache_dir() -> Path | None:
+    """The directory of the grid artifact, or None if it is missing or stale."""
+    cache_dir = Path(GRID_CACHE_DIR)
+    return cache_dir if _cache_is_valid(cache_dir) else None
+
+
+@cache
+def gadm() -> gpd.GeoDataFrame:
+    """The area of interest, used to mask out ocean."""
+    cache_dir = grid_cache_dir()
+    if cache_dir is not None:
+        return _cached_gadm(cache_dir)
+    return _read_gadm()
+
+
+@cache
+def gridspec():
+    """The gridspec the DEP grid is based on."""
+    return grids.grid()
+
+
+@cache
+def dep_grid() -> pd.DataFrame:
+    """Used for wofs, i.e. summary products. A DataFrame of tile geoboxes
+    indexed by (column, row)."""
+    cache_dir = grid_cache_dir()
+    if cache_dir is not None:
+        return _cached_geoboxes(cache_dir)
+    return _compute_geoboxes(_compute_dep_grid(gadm()).index, gridspec())
+
+
+@cache
+def landsat_grid() -> gpd.GeoDataFrame:
+    """Used for wofls, i.e. daily products. Landsat WRS-2 path/rows indexed by
+    (PATH, ROW)."""
+    cache_dir = grid_cache_dir()
+    if cache_dir is not None:
+        ls_grid = gpd.read_file(cache_dir / _LS_GRID_FILE)
+    else:
+        ls_grid = _compute_ls_grid(gadm())
+    return ls_grid.set_index(["PATH", "ROW"])
+
+
+_ACCESSORS = dict(GADM=gadm, grid=dep_grid, grid_gs=gridspec, ls_grid=landsat_grid)
+
+
+def __getattr__(name: str):
+    # Kept so the old module level names still work, e.g. `grid.ls_grid`
+    if name in _ACCESSORS:
+        return _ACCESSORS[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
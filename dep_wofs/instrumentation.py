@@ -0,0 +1,312 @@
+"""Timings and resource use for each stage of a task, written as JSON next to
+the task's log.
+
+The log written by `CsvLogger` only says whether a task finished. `Stages`
+also records, for each stage of the task (search, load, classify or
+summarize, write, stac creation and so on), how often it ran and in total the
+wall time, bytes received over the network, items handled and dask tasks run,
+along with the most memory the container used while it ran (sampled every
+`MEMORY_SAMPLE_INTERVAL` seconds). A record
+is written for each run of each task (see `stages_path`), so the records of a
+whole run can be gathered with `read_stage_records` to find where the time
+goes.
+
+Loads and most processing return lazy dask arrays, so for tasks which aren't
+computed until written, their time shows up in "write". Network bytes and
+dask tasks are counted for the whole process (or cluster), so they overlap
+between stages which run at the same time.
+"""
+
+import json
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import cache, wraps
+from pathlib import Path
+from itertools import count
+from threading import Lock, Thread
+from typing import Iterator
+
+import pandas as pd
+import psutil
+from dask.callbacks import Callback
+from distributed import SchedulerPlugin, get_client
+
+from dep_wofs.resources import memory_usage
+from dep_wofs.storage import list_keys, read_bytes, s3_client, write_bytes
+
+# How often memory is sampled while a stage runs, in seconds
+MEMORY_SAMPLE_INTERVAL = 0.25
+
+# Components of a dep_tools Task, the method of each which does its work, and
+# the stage it is recorded as unless named otherwise
+TASK_STAGES = {
+    "searcher": ("search", "search"),
+    "loader": ("load", "load"),
+    "processor": ("process", "process"),
+    "post_processor": ("process", "post_process"),
+    "writer": ("write", "write"),
+    "stac_creator": ("process", "stac"),
+    "stac_writer": ("write", "stac_write"),
+}
+
+
+class _LocalTaskCounter(Callback):
+    """Counts tasks run by the local (threaded or synchronous) schedulers."""
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def _posttask(self, key, result, dsk, state, id):
+        self.count += 1
+
+
+@cache
+def _local_task_counter() -> _LocalTaskCounter:
+    counter = _LocalTaskCounter()
+    counter.register()
+    return counter
+
+
+class _SchedulerTaskCounter(SchedulerPlugin):
+    """Counts tasks run by the distributed scheduler, i.e. which went from
+    processing to memory."""
+
+    name = "dep-wofs-task-counter"
+
+    def __init__(self):
+        self.count = 0
+
+    def transition(self, key, start, finish, *args, **kwargs):
+        if start == "processing" and finish == "memory":
+            self.count += 1
+
+
+def _scheduler_task_count(dask_scheduler) -> int:
+    # Added the first time it's asked for, so counts from the start of the
+    # first stage
+    counter = dask_scheduler.plugins.get(_SchedulerTaskCounter.name)
+    if counter is None:
+        counter = _SchedulerTaskCounter()
+        dask_scheduler.add_plugin(counter)
+    return counter.count
+
+
+def dask_tasks_run() -> int:
+    """How many dask tasks have been run, by the distributed cluster if there
+    is one, and the local schedulers."""
+    count = _local_task_counter().count
+    try:
+        client = get_client()
+    except ValueError:
+        return count
+    return count + client.run_on_scheduler(_scheduler_task_count)
+
+
+def memory_used() -> int:
+    """The memory used by the container, or by this process and its children
+    (e.g. dask workers) if that isn't available, in bytes."""
+    usage = memory_usage()
+    if usage is not None:
+        return usage
+    process = psutil.Process()
+    usage = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            usage += child.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return usage
+
+
+class _MemorySampler:
+    """Samples `memory_used` on a background thread while any stage is
+    running, keeping the most seen during each."""
+
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._peaks = dict()
+        self._tokens = count()
+        self._lock = Lock()
+        self._thread = None
+
+    def start(self) -> int:
+        """Start watching, returning the token to `stop` with."""
+        usage = memory_used()
+        with self._lock:
+            token = next(self._tokens)
+            self._peaks[token] = usage
+            if self._thread is None:
+                self._thread = Thread(target=self._sample, daemon=True)
+                self._thread.start()
+            return token
+
+    def stop(self, token: int) -> int:
+        """The most memory used since `start` returned `token`."""
+        usage = memory_used()
+        with self._lock:
+            return max(self._peaks.pop(token), usage)
+
+    def _sample(self) -> None:
+        while True:
+            time.sleep(self._interval)
+            usage = memory_used()
+            with self._lock:
+                # Stopped when nothing is being watched, and started again
+                # by the next stage
+                if len(self._peaks) == 0:
+                    self._thread = None
+                    return
+                for token, peak in self._peaks.items():
+                    self._peaks[token] = max(peak, usage)
+
+
+@cache
+def _memory_sampler() -> _MemorySampler:
+    return _MemorySampler(MEMORY_SAMPLE_INTERVAL)
+
+
+def _counters() -> tuple[float, int, int]:
+    return time.perf_counter(), psutil.net_io_counters().bytes_recv, dask_tasks_run()
+
+
+class Stages:
+    """Per stage measurements for the task `task_id`. Stages may be entered
+    any number of times, from any thread, and are summed. `fields` are added
+    to the record as they are, e.g. the datetime of the task."""
+
+    def __init__(self, task_id, **fields):
+        self.task_id = task_id
+        self.fields = fields
+        self.stages = dict()
+        self._start = time.perf_counter()
+        self._lock = Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[dict]:
+        """Measure the enclosed code as stage `name`. The count of items it
+        handled can be set on the dict this yields, as "items"."""
+        counts = dict(items=0)
+        start = _counters()
+        token = _memory_sampler().start()
+        try:
+            yield counts
+        finally:
+            peak = _memory_sampler().stop(token)
+            end = _counters()
+            with self._lock:
+                stage = self.stages.setdefault(
+                    name,
+                    dict(calls=0, seconds=0.0, bytes_read=0, items=0, dask_tasks=0),
+                )
+                stage["calls"] += 1
+                stage["seconds"] += end[0] - start[0]
+                stage["bytes_read"] += end[1] - start[1]
+                stage["items"] += counts["items"]
+                stage["dask_tasks"] += end[2] - start[2]
+                stage["peak_memory"] = max(stage.get("peak_memory", 0), peak)
+
+    def record(self, status: str) -> dict:
+        return dict(
+            task=list(self.task_id),
+            status=status,
+            time=datetime.now(timezone.utc).isoformat(),
+            seconds=time.perf_counter() - self._start,
+            peak_memory=max(
+                (stage["peak_memory"] for stage in self.stages.values()),
+                default=memory_used(),
+            ),
+            **self.fields,
+            stages=self.stages,
+        )
+
+    def save(self, status: str, bucket: str, key: str, client=None) -> None:
+        """Write the record to s3://`bucket`/`key`. As this is only
+        diagnostic, failures are warned about rather than raised."""
+        try:
+            write_bytes(json.dumps(self.record(status)).encode(), bucket, key, client)
+        except Exception as e:
+            warnings.warn(f"Couldn't write stage timings to {key}: {e}")
+
+
+class _Timed:
+    """`target`, with calls to its `method` measured as stage `name`."""
+
+    def __init__(self, target, method: str, name: str, stages: Stages):
+        self._target = target
+        self._method = method
+        self._name = name
+        self._stages = stages
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if attr != self._method:
+            return value
+
+        @wraps(value)
+        def timed(*args, **kwargs):
+            with self._stages.stage(self._name) as counts:
+                result = value(*args, **kwargs)
+                if self._method == "search":
+                    counts["items"] = len(result)
+            return result
+
+        return timed
+
+
+def instrument(task, stages: Stages, **names: str):
+    """Measure each stage of `task`, a dep_tools Task, in `stages`. Stages are
+    named as in `TASK_STAGES` unless given in `names`, e.g.
+    `processor="classify"`."""
+    for component, (method, name) in TASK_STAGES.items():
+        target = getattr(task, component, None)
+        if target is not None:
+            setattr(
+                task,
+                component,
+                _Timed(target, method, names.get(component, name), stages),
+            )
+    return task
+
+
+def stages_path(log_path: str, task_id) -> str:
+    """Where the stage record of a run of `task_id` is written, next to the
+    log at `log_path`, e.g. ".../logs/wofl_2020_log_stages/63_20_<time>.json"."""
+    log_path = Path(log_path)
+    task = "_".join(str(i) for i in task_id)
+    now = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    return str(log_path.parent / f"{log_path.stem}_stages" / f"{task}_{now}.json")
+
+
+def read_stage_records(
+    bucket: str, prefix: str, client=None, max_workers: int = 32
+) -> pd.DataFrame:
+    """Every stage of every record under `prefix`, one row each. "run" is the
+    key of the record and "task_seconds" the time the whole run took."""
+    client = client if client is not None else s3_client()
+    keys = sorted(
+        key
+        for key in list_keys(bucket, prefix, client)
+        if "_stages/" in key and key.endswith(".json")
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        records = executor.map(
+            lambda key: json.loads(read_bytes(bucket, key, client)), keys
+        )
+        rows = [
+            dict(
+                run=key,
+                task=",".join(str(i) for i in record["task"]),
+                dataset_id=record.get("dataset_id"),
+                status=record["status"],
+                task_seconds=record["seconds"],
+                stage=name,
+                **stage,
+            )
+            for key, record in zip(keys, records)
+            for name, stage in record["stages"].items()
+        ]
+    return pd.DataFrame(rows)
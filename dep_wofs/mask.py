@@ -0,0 +1,112 @@
+"""Land masks for DEP tiles, used to mask out ocean waters which are poorly
+classified by the WOfS algorithm.
+
+Masking a tile used to mean reprojecting the whole GADM layer and taking the
+union of every geometry for each task. Instead, GADM is reprojected once per
+CRS and indexed with an STRtree, so only the geometries which touch a tile are
+unioned, and the clipped result is kept in an LRU cache. Rasterized masks for
+every tile can also be precomputed alongside the grid artifact (see
+`build_grid_cache.py`), in which case masking is just a boolean `where`.
+"""
+
+from functools import cache, lru_cache
+from pathlib import Path
+
+import numpy as np
+from odc.geo.geobox import GeoBox
+from odc.geo.geom import Geometry
+from odc.geo.xr import rasterize
+from shapely import STRtree, box, intersection, unary_union
+from xarray import DataArray
+
+from dep_wofs.grid import (
+    _cached_gadm,
+    _cached_geoboxes,
+    dep_grid,
+    gadm,
+    grid_cache_dir,
+)
+
+LAND_MASKS_DIR = "land_masks"
+
+
+@cache
+def _gadm_index(crs: str) -> tuple[np.ndarray, STRtree]:
+    geometries = gadm().to_crs(crs).geometry.values
+    return geometries, STRtree(geometries)
+
+
+def _clip_land(area: GeoBox, geometries: np.ndarray, tree: STRtree) -> Geometry:
+    bbox = box(*area.boundingbox)
+    candidates = geometries[tree.query(bbox, predicate="intersects")]
+    return Geometry(intersection(bbox, unary_union(candidates)), crs=area.crs)
+
+
+@lru_cache(maxsize=64)
+def land_geometry(area: GeoBox) -> Geometry:
+    """The land within the bounding box of `area`, in the CRS of `area`."""
+    return _clip_land(area, *_gadm_index(str(area.crs)))
+
+
+@cache
+def _tile_ids() -> dict[GeoBox, tuple]:
+    return {geobox: id for id, geobox in dep_grid().geobox.items()}
+
+
+def _land_mask_path(cache_dir: Path, id: tuple) -> Path:
+    return cache_dir / LAND_MASKS_DIR / f"{'_'.join(str(i) for i in id)}.npz"
+
+
+@lru_cache(maxsize=4)
+def precomputed_land_mask(area: GeoBox) -> np.ndarray | None:
+    """The rasterized land mask for `area` from the grid artifact, if `area` is
+    a DEP tile and masks were built."""
+    cache_dir = grid_cache_dir()
+    id = _tile_ids().get(area)
+    if cache_dir is None or id is None:
+        return None
+
+    path = _land_mask_path(cache_dir, id)
+    if not path.exists():
+        return None
+
+    with np.load(path) as stored:
+        shape = tuple(stored["shape"])
+        bits = np.unpackbits(stored["bits"], count=shape[0] * shape[1])
+    return bits.reshape(shape).astype(bool)
+
+
+def mask_to_land(xx: DataArray, area: GeoBox) -> DataArray:
+    """Set everything in `xx` which is not on land to NaN. `xx` must be on the
+    same pixel grid as `area`. NaN is then the only nodata, so any "nodata"
+    attribute is dropped."""
+    mask = precomputed_land_mask(area)
+    if mask is None or mask.shape != xx.shape:
+        # all_touched=True to match the precomputed masks
+        mask = rasterize(land_geometry(area), xx.odc.geobox, all_touched=True).values
+
+    masked = xx.where(mask)
+    masked.attrs.pop("nodata", None)
+    return masked
+
+
+def build_land_masks(cache_dir: Path | str) -> None:
+    """Rasterize and store the land mask for every DEP tile in the grid cache
+    at `cache_dir` (see `build_grid_cache`), from the tiles and GADM in it."""
+    cache_dir = Path(cache_dir)
+    (cache_dir / LAND_MASKS_DIR).mkdir(parents=True, exist_ok=True)
+
+    geoboxes = _cached_geoboxes(cache_dir).geobox
+    # The tiles all share a CRS, see `_geoboxes_to_arrays`
+    crs = geoboxes.iloc[0].crs
+    geometries = _cached_gadm(cache_dir).to_crs(crs).geometry.values
+    tree = STRtree(geometries)
+    for id, geobox in geoboxes.items():
+        land = _clip_land(geobox, geometries, tree)
+        # all_touched=True to match the default of `.odc.mask`
+        mask = rasterize(land, geobox, all_touched=True).values
+        np.savez_compressed(
+            _land_mask_path(cache_dir, id),
+            bits=np.packbits(mask, axis=None),
+            shape=np.array(mask.shape),
+        )
@@ -0,0 +1,21 @@
+"""Where outputs are written, for those which don't follow the layout of
+dep-tools' `S3ItemPath`."""
+
+from datetime import datetime
+
+from dep_tools.namers import S3ItemPath
+
+
+class DailyItemPath(S3ItemPath):
+    def __init__(self, time: datetime | None = None, **kwargs):
+        super().__init__(time=time, **kwargs)
+
+    def tile_prefix(self, item_id) -> str:
+        """The prefix shared by the outputs for `item_id` at every time."""
+        return f"{self._folder_prefix}/{self._format_item_id(item_id)}/"
+
+    def _folder(self, item_id) -> str:
+        return f"{self.tile_prefix(item_id)}{self.time:%Y/%m/%d}"
+
+    def basename(self, item_id) -> str:
+        return f"{self.item_prefix}_{self._format_item_id(item_id, join_str='_')}_{self.time:%Y-%m-%d}"
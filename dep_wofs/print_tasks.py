@@ -1,22 +1,35 @@
+import io
 import json
 import sys
-from itertools import product
-from typing import Annotated, Optional
+import time
+from itertools import count, islice, product
+from pathlib import Path
+from typing import Annotated, Iterable, Iterator, Optional, TextIO
 
 import typer
-from cloud_logger import CsvLogger, filter_by_log, S3Handler
+from cloud_logger import CsvLogger, S3Handler
 from dep_tools.namers import S3ItemPath
 
-import grid as wofs_grid
-from config import BUCKET
-
-
-def parse_datetime(datetime):
+from dep_wofs.batching import (
+    pack_tasks,
+    read_costs,
+    stage_record_costs,
+    task_costs,
+)
+import dep_wofs.grid as wofs_grid
+from dep_wofs.config import BUCKET
+from dep_wofs.storage import configure_s3_endpoint, write_bytes
+from dep_wofs.task_state import TaskState
+
+
+def parse_datetime(datetime) -> list[str]:
+    """The years in `datetime`, e.g. ["1984", ..., "1994"] for "1984_1994".
+    Years stay strings, as that's what `process_tile` expects in a task."""
     years = datetime.split("_")
     if len(years) == 2:
-        years = range(int(years[0]), int(years[1]) + 1)
+        years = [str(year) for year in range(int(years[0]), int(years[1]) + 1)]
     elif len(years) > 2:
-        ValueError(f"{datetime} is not a valid value for --datetime")
+        raise ValueError(f"{datetime} is not a valid value for --datetime")
     return years
 
 
@@ -24,6 +37,43 @@ def bool_parser(raw: str):
     return False if raw == "False" else True
 
 
+def write_tasks(tasks: Iterable[dict], dsts: list[TextIO], ndjson: bool) -> None:
+    """Write `tasks` to each of `dsts` as they are generated, either as one
+    JSON list or as newline delimited JSON."""
+
+    def write(text):
+        for dst in dsts:
+            dst.write(text)
+
+    if ndjson:
+        for task in tasks:
+            write(json.dumps(task) + "\n")
+        return
+
+    write("[")
+    for i, task in enumerate(tasks):
+        write((", " if i > 0 else "") + json.dumps(task))
+    write("]")
+
+
+def write_shards(
+    tasks: Iterable[dict], shard_size: int, prefix: str, file_path: Path, ndjson: bool
+) -> Iterator[str]:
+    """Write `tasks` to objects of `shard_size` tasks each under `prefix` in
+    the bucket, named after `file_path` with a shard number, and yield the
+    S3 URI of each, so workers on any node can read them."""
+    tasks = iter(tasks)
+    for i in count():
+        shard = list(islice(tasks, shard_size))
+        if len(shard) == 0:
+            return
+        key = f"{prefix}/{file_path.stem}_{i:05d}{file_path.suffix}"
+        with io.StringIO() as dst:
+            write_tasks(shard, [dst], ndjson)
+            write_bytes(dst.getvalue().encode(), BUCKET, key)
+        yield f"s3://{BUCKET}/{key}"
+
+
 def main(
     datetime: Annotated[str, typer.Option()],
     version: Annotated[str, typer.Option()],
@@ -34,51 +84,119 @@ def main(
     overwrite_existing_log: Annotated[str, typer.Option(parser=bool_parser)] = "False",
     save_to_file: Annotated[str, typer.Option(parser=bool_parser)] = "False",
     file_path: Optional[str] = "/tmp/tasks.txt",
+    ndjson: Annotated[
+        str,
+        typer.Option(
+            parser=bool_parser, help="Write one JSON task per line, not a list"
+        ),
+    ] = "False",
+    shard_size: Annotated[
+        Optional[int],
+        typer.Option(
+            help="Write tasks to the bucket in shards of this many tasks each, "
+            "named after --file-path, and output their S3 URIs instead"
+        ),
+    ] = None,
+    batch_cost: Annotated[
+        Optional[float],
+        typer.Option(
+            help="Pack tasks into batches costing about this much each, "
+            "output as {'batch': <JSON list of tasks>}"
+        ),
+    ] = None,
+    costs_path: Annotated[
+        Optional[str],
+        typer.Option(
+            help='A JSON file of costs per tile, keyed like "column,row". If '
+            "not given, costs are the seconds earlier runs took, from their "
+            "stage records"
+        ),
+    ] = None,
 ) -> None:
+    configure_s3_endpoint()
     years = parse_datetime(datetime)
-    this_grid = wofs_grid.grid if grid == "dep" else wofs_grid.ls_grid
+    this_grid = wofs_grid.dep_grid() if grid == "dep" else wofs_grid.landsat_grid()
     first_name = dict(dep="column", ls="path")
     second_name = dict(dep="row", ls="row")
 
-    params = list()
-    for year in years:
-        itempath = S3ItemPath(
+    itempaths = {
+        year: S3ItemPath(
             bucket=BUCKET,
             sensor="ls",
             dataset_id=dataset_id,
             version=version,
-            time=str(year).replace("/", "_"),
+            time=year.replace("/", "_"),
         )
-
-        logger = CsvLogger(
-            name=dataset_id,
-            path=f"{itempath.bucket}/{itempath.log_path()}",
-            overwrite=overwrite_existing_log,
-            header="time|index|status|paths|comment\n",
-            cloud_handler=S3Handler,
-        )
-
-        grid_subset = filter_by_log(this_grid, logger.parse_log(), retry_errors)
-
-        these_params = [
-            {
-                # we could take fromthe grid if we name the dep_grid multiindex
-                first_name[grid]: region[0][0],
-                second_name[grid]: region[0][1],
-                "datetime": region[1],
-            }
-            for region in product(grid_subset.index, [year])
-        ]
-        params += these_params
-
+        for year in years
+    }
+    log_keys = {year: itempath.log_path() for year, itempath in itempaths.items()}
+
+    # The logs for all years are read at once, and only what was appended
+    # since the last run
+    log_dir = Path(log_keys[years[0]]).parent
+    state_key = f"{log_dir}/{dataset_id}_task_state.sqlite"
+    task_state = TaskState.download(BUCKET, state_key)
+    if overwrite_existing_log:
+        for year, itempath in itempaths.items():
+            # Creating the logger is what clears the log
+            CsvLogger(
+                name=dataset_id,
+                path=f"{itempath.bucket}/{itempath.log_path()}",
+                overwrite=True,
+                header="time|index|status|paths|comment\n",
+                cloud_handler=S3Handler,
+            )
+            task_state.reset(log_keys[year])
+    task_state.refresh(BUCKET, list(log_keys.values()))
+    task_state.upload(BUCKET, state_key)
+
+    def tasks() -> Iterator[dict]:
+        # Generated lazily, a year at a time, so the full list of tasks is
+        # never held in memory
+        for year in years:
+            grid_subset = task_state.filter(this_grid, log_keys[year], retry_errors)
+            for region in product(grid_subset.index, [year]):
+                yield {
+                    # we could take fromthe grid if we name the dep_grid multiindex
+                    first_name[grid]: region[0][0],
+                    second_name[grid]: region[0][1],
+                    "datetime": region[1],
+                }
+
+    params = tasks()
     if limit is not None:
-        params = params[0 : int(limit)]
+        params = islice(params, int(limit))
+
+    if batch_cost is not None:
+        # Packing needs every task at once
+        params = list(params)
+        if costs_path is not None:
+            costs = read_costs(costs_path)
+        else:
+            # The stage records of every year's runs, next to the logs
+            costs = stage_record_costs(BUCKET, f"{log_dir}/")
+        id_names = (first_name[grid], second_name[grid])
+        batches = pack_tasks(params, task_costs(params, id_names, costs), batch_cost)
+        params = (dict(batch=json.dumps(batch)) for batch in batches)
+
+    if shard_size is not None:
+        # A prefix per run, so shards still being read by the workers of an
+        # earlier run aren't overwritten
+        shard_prefix = (
+            f"{log_dir}/shards/{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}"
+        )
+        params = (
+            dict(shard=uri)
+            for uri in write_shards(
+                params, shard_size, shard_prefix, Path(file_path), ndjson
+            )
+        )
 
-    if save_to_file:
+    if save_to_file and shard_size is None:
         with open(str(file_path), "w") as dst:
-            json.dump(params, dst)
-
-    json.dump(params, sys.stdout)
+            write_tasks(params, [dst, sys.stdout], ndjson)
+    else:
+        write_tasks(params, [sys.stdout], ndjson)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,21 @@
-from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from copy import copy
+from functools import cache, partial
 from pathlib import Path
 import traceback
+from typing import Callable, Optional
 from typing_extensions import Annotated
 import warnings
 
-import boto3
-from distributed import Client
+from odc.geo.geobox import GeoBox
 from odc.stac import configure_s3_access
 import odc.stac
-from pystac import ItemCollection, read_dict
+from pystac import ItemCollection
 import pystac_client
 from typer import Option, run
 
 from cloud_logger import CsvLogger
-from dep_tools.aws import object_exists, s3_dump
+from dep_tools.aws import s3_dump
 from dep_tools.exceptions import EmptyCollectionError
 from dep_tools.loaders import StacLoader
 from dep_tools.namers import S3ItemPath
@@ -22,85 +24,273 @@ from dep_tools.searchers import LandsatPystacSearcher, Searcher
 from dep_tools.stac_utils import StacCreator
 from dep_tools.task import AwsStacTask
 
-from config import BUCKET, OUTPUT_COLLECTION_ROOT
-from grid import ls_grid
-from processors import WoflProcessor
+from dep_wofs.batching import run_batch
+from dep_wofs.checkpoints import SceneManifest, checkpointing, manifest_path
+from dep_wofs.cluster import SCHEDULERS, chunk_size, dask_scheduler
+from dep_wofs.config import BUCKET, LANDSAT_STAC_URL, OUTPUT_COLLECTION_ROOT
+from dep_wofs.cube import CUBE_PADDING, CubeWriter, PathRowCubes, cube_url, read_wofl
+from dep_wofs.dem import DemCache, footprint_geobox
+from dep_wofs.grid import landsat_grid
+from dep_wofs.instrumentation import Stages, instrument, stages_path
+from dep_wofs.namers import DailyItemPath
+from dep_wofs.processors import WoflProcessor
+from dep_wofs.resources import memory_fraction_used
+from dep_wofs.screening import useful_region
+from dep_wofs.searchers import (
+    StaticCatalogSearcher,
+    WindowedSearcher,
+    is_static_catalog,
+    use_alternate_s3_href,
+)
+from dep_wofs.stac_cache import CachingStacApiIO
+from dep_wofs.storage import configure_s3_endpoint, list_keys, s3_client
+
+# Memory needed per pixel of a chunk by the classifier: the uint16 bands,
+# float32 ratios and intermediate masks
+BYTES_PER_PIXEL = 50
+
+
+def bool_parser(raw: str):
+    return False if raw == "False" else True
+
+
+@cache
+def setup() -> None:
+    """Configuration which only needs doing once per process, however many
+    path/rows it runs."""
+    configure_s3_endpoint()
+    configure_s3_access(cloud_defaults=True, requester_pays=True)
 
 
-def use_alternate_s3_href(modifiable: pystac_client.Modifiable) -> None:
-    if isinstance(modifiable, dict):
-        if modifiable["type"] == "FeatureCollection":
-            new_features = list()
-            for item_dict in modifiable["features"]:
-                use_alternate_s3_href(item_dict)
-                new_features.append(item_dict)
-            modifiable["features"] = new_features
-        else:
-            stac_object = read_dict(modifiable)
-            use_alternate_s3_href(stac_object)
-            modifiable.update(stac_object.to_dict())
-    else:
-        for _, asset in modifiable.assets.items():
-            asset_dict = asset.to_dict()
-            if "alternate" in asset_dict.keys():
-                asset.href = asset.to_dict()["alternate"]["s3"]["href"]
+@cache
+def landsatlook_client() -> pystac_client.Client:
+    # Opened once per process, as opening fetches the root catalog. Responses
+    # are cached on disk, see stac_cache.py
+    return pystac_client.Client.open(
+        LANDSAT_STAC_URL,
+        modifier=use_alternate_s3_href,
+        stac_io=CachingStacApiIO(),
+    )
 
 
 class MultiItemTask:
+    """Runs an AwsStacTask for each of `items`, skipping those whose output
+    already exists (found with a single listing of the path/row's prefix).
+    Up to `concurrency` scenes are processed at once, and no new scene is
+    started while the container is using more than `max_memory_fraction` of
+    its memory limit.
+
+    Before each scene is run, `loader.for_item` is asked for a loader for just
+    that scene, which may crop the load or skip the scene entirely. Skipped
+    scenes are logged with the reason.
+
+    If `stages` is given, each stage of each scene is measured in it, summed
+    over the scenes.
+
+    If `prepare_dsm` is given, it's called with the footprint of the scenes
+    to be run before any are, so their DEM can be loaded once. It isn't
+    called if every scene's output already exists.
+
+    If `cubes` is given, slots are reserved in them for all the scenes, each
+    scene's WOfL is written to the cube for its year as well as to its COG,
+    and scenes which already have a COG but aren't in their cube yet are
+    copied in from it.
+
+    If `manifest` is given, each scene which is done is recorded in it, and if
+    it's being resumed the scenes already in it are skipped without listing
+    the outputs again. Otherwise the scenes found by the listing are recorded
+    in it first.
+
+    Each scene gets its own item path, searcher, post processor and stac
+    creator (made by calling `stac_creator` with the item path), so nothing is
+    shared between concurrently running scenes except the loader and
+    processor.
+    """
+
     def __init__(
         self,
         tile_id,
         items: ItemCollection,
         itempath,
-        searcher,
+        loader,
         post_processor,
+        logger,
+        stac_creator: Callable[..., StacCreator],
+        concurrency: int = 1,
+        max_memory_fraction: float = 0.8,
+        stages: Stages | None = None,
+        prepare_dsm: Callable[[GeoBox], None] | None = None,
+        cubes: PathRowCubes | None = None,
+        manifest: SceneManifest | None = None,
         **kwargs,
     ):
         self._tile_id = tile_id
         self._items = items
         self._itempath = itempath
-        self._searcher = searcher
+        self._loader = loader
         self._post_processor = post_processor
+        self._logger = logger
+        self._stac_creator = stac_creator
+        self._concurrency = concurrency
+        self._max_memory_fraction = max_memory_fraction
+        self._stages = stages if stages is not None else Stages(tile_id)
+        self._prepare_dsm = prepare_dsm
+        self._cubes = cubes
+        self._manifest = manifest
         self._kwargs = kwargs
         self._task_class = AwsStacTask
+        # Clients are thread safe, but creating them isn't
+        self._s3_client = s3_client()
+
+    def _scene_itempath(self, item):
+        itempath = copy(self._itempath)
+        itempath.time = item.get_datetime()
+        return itempath
+
+    def _run_scene(self, item, itempath) -> list:
+        post_processor = copy(self._post_processor)
+        post_processor.properties = item.properties
+        try:
+            with self._stages.stage("screen"):
+                loader, reason = self._loader.for_item(item)
+            if loader is None:
+                self._logger.info(
+                    [self._tile_id, "skipped", [], f'"{item.id}: {reason}"']
+                )
+                self._record(item, "skipped")
+                return []
+
+            task = self._task_class(
+                itempath,
+                id=self._tile_id,
+                searcher=IS(item),
+                loader=loader,
+                post_processor=post_processor,
+                logger=self._logger,
+                stac_creator=self._stac_creator(itempath=itempath),
+                **self._kwargs,
+            )
+            if self._cubes is not None:
+                cube = self._cubes.for_item(item)
+                task.writer = CubeWriter(task.writer, cube, item.id)
+            paths = instrument(task, self._stages, processor="classify").run()
+            self._record(item, "complete")
+            return paths
+        except Exception:
+            warnings.warn("Error from one of the dailies, check the output logs")
+            daily_log_path = Path(itempath.log_path()).with_suffix(".error.txt")
+            s3_dump(
+                data=traceback.format_exc(),
+                bucket=BUCKET,
+                key=str(daily_log_path),
+                client=self._s3_client,
+            )
+            return []
+
+    def _record(self, item, status: str) -> None:
+        if self._manifest is not None:
+            self._manifest.add({item.id: status})
+
+    def _must_wait(self, in_flight) -> bool:
+        if len(in_flight) >= self._concurrency:
+            return True
+        memory_used = memory_fraction_used()
+        return (
+            len(in_flight) > 0
+            and memory_used is not None
+            and memory_used > self._max_memory_fraction
+        )
+
+    def _scenes_to_run(self) -> list:
+        if self._manifest is not None and self._manifest.resumed:
+            return [
+                (item, self._scene_itempath(item))
+                for item in self._items
+                if item.id not in self._manifest.scenes
+            ]
+
+        # One listing of everything already written for this path/row, rather
+        # than checking for each scene's output separately
+        with self._stages.stage("list_outputs"):
+            existing_keys = list_keys(
+                BUCKET, self._itempath.tile_prefix(self._tile_id), self._s3_client
+            )
+
+        scenes = []
+        existing = dict()
+        for item in self._items:
+            itempath = self._scene_itempath(item)
+            if itempath.stac_path(self._tile_id) in existing_keys:
+                existing[item.id] = "exists"
+            else:
+                scenes.append((item, itempath))
+        if self._manifest is not None:
+            self._manifest.add(existing)
+            self._manifest.flush()
+        return scenes
+
+    def _backfill_scene(self, item) -> None:
+        key = self._scene_itempath(item).path(self._tile_id, "water")
+        href = f"s3://{BUCKET}/{key}"
+        try:
+            if not self._cubes.for_item(item).write(item.id, read_wofl(href)):
+                warnings.warn(f"{item.id} couldn't be copied into its cube")
+        except Exception as e:
+            warnings.warn(f"{item.id} couldn't be copied into its cube: {e}")
+
+    def _backfill_cubes(self, scenes) -> None:
+        """Copy the scenes which already have a COG, i.e. aren't in `scenes`
+        and weren't skipped, into their cubes if they aren't there yet."""
+        to_run = {item.id for item, _ in scenes}
+        skipped = set()
+        if self._manifest is not None:
+            skipped = {
+                scene_id
+                for scene_id, status in self._manifest.scenes.items()
+                if status == "skipped"
+            }
+        existing = [
+            item
+            for item in self._items
+            if item.id not in to_run and item.id not in skipped
+        ]
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            list(executor.map(self._backfill_scene, self._cubes.unwritten(existing)))
 
     def run(self):
+        scenes = self._scenes_to_run()
+        if self._cubes is not None:
+            with self._stages.stage("reserve_cube"):
+                self._cubes.reserve(self._items)
+            with self._stages.stage("backfill_cube"):
+                self._backfill_cubes(scenes)
+        if self._prepare_dsm is not None and len(scenes) > 0:
+            footprint = footprint_geobox([item for item, _ in scenes])
+            if footprint is not None:
+                with self._stages.stage("dem"):
+                    self._prepare_dsm(footprint)
+
         paths = []
-        for item in self._items:
-            self._itempath.time = item.get_datetime()
-            self._searcher.item = item
-            self._post_processor.properties = item.properties
-            if not object_exists(
-                bucket=BUCKET, key=self._itempath.stac_path(self._tile_id)
-            ):
-                try:
-                    paths += self._task_class(
-                        self._itempath,
-                        id=self._tile_id,
-                        searcher=self._searcher,
-                        post_processor=self._post_processor,
-                        **self._kwargs,
-                    ).run()
-                except Exception as e:
-                    warnings.warn(
-                        "Error from one of the dailies, check the output logs"
-                    )
-                    daily_log_path = Path(self._itempath.log_path()).with_suffix(
-                        ".error.txt"
-                    )
-                    boto3_client = boto3.client("s3")
-
-                    s3_dump(
-                        data=traceback.format_exc(),
-                        bucket=BUCKET,
-                        key=str(daily_log_path),
-                        client=boto3_client,
-                    )
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            for item, itempath in scenes:
+                while self._must_wait(in_flight):
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        paths += future.result()
+
+                in_flight.add(executor.submit(self._run_scene, item, itempath))
+
+            for future in as_completed(in_flight):
+                paths += future.result()
 
         return paths
 
 
 class IS(Searcher):
+    def __init__(self, item):
+        self.item = item
+
     def search(self, area):
         return [self.item]
 
@@ -131,23 +321,17 @@ class DailyPostProcessor(XrPostProcessor):
         return ds
 
 
-class DailyItemPath(S3ItemPath):
-    def __init__(self, time: datetime | None = None, **kwargs):
-        super().__init__(time=time, **kwargs)
-
-    def _folder(self, item_id) -> str:
-        return f"{self._folder_prefix}/{self._format_item_id(item_id)}/{self.time:%Y/%m/%d}"
-
-    def basename(self, item_id) -> str:
-        return f"{self.item_prefix}_{self._format_item_id(item_id, join_str='_')}_{self.time:%Y-%m-%d}"
-
-
 class PassThroughOdcLoader(StacLoader):
     """Just loads the items"""
 
     def __init__(self, **kwargs):
         self._kwargs = kwargs
 
+    def for_item(self, item) -> tuple[StacLoader | None, str | None]:
+        """The loader to use for `item` alone, or None and the reason if it
+        should be skipped."""
+        return self, None
+
     def load(self, items, _):
         return odc.stac.load(
             items,
@@ -156,17 +340,47 @@ class PassThroughOdcLoader(StacLoader):
         )
 
 
-def main(
-    path: Annotated[str, Option(parser=int)],
-    row: Annotated[str, Option(parser=int)],
-    datetime: Annotated[str, Option()],
-    version: Annotated[str, Option()],
+class CloudFirstOdcLoader(PassThroughOdcLoader):
+    """Checks the coarse `qa_pixel` band of each scene against the land mask
+    first (see screening.py), then skips the scene if nothing is usable or
+    crops the load to the usable area. Cropping keeps the pixel grid of the
+    full scene, as the load is still anchored on pixel centres.
+
+    Nothing is written for a skipped scene or outside a crop, so those pixels
+    count as unobserved in the summaries rather than as cloud or ocean. Land
+    which is cloudy in every scene of a year then has a nodata count_clear
+    rather than 0, and ocean more than `CROP_MARGIN` from clear land is
+    nodata. Clear and wet counts over land are unchanged, short of any clear
+    pixels the coarse read misses."""
+
+    def for_item(self, item) -> tuple[StacLoader | None, str | None]:
+        region, reason = useful_region(item)
+        if region is None:
+            return None, reason
+        return PassThroughOdcLoader(geopolygon=region, **self._kwargs), None
+
+
+def process_tile(
+    path: int,
+    row: int,
+    datetime: str,
+    version: str,
     dataset_id: str = "wofl",
+    concurrency: int = 1,
+    cube: bool = False,
+    checkpoint: bool = False,
+    screen: bool = False,
 ) -> None:
-    configure_s3_access(cloud_defaults=True, requester_pays=True)
+    """If `cube` is True, the WOfLs are also written to the path/row's cubes,
+    see cube.py. If `checkpoint` is True, the scenes which are done are
+    recorded in a manifest as they finish, and a retry of an interrupted run
+    carries on from it (see checkpoints.py). If `screen` is True, only the
+    land and cloud free part of each scene is loaded and written, see
+    `CloudFirstOdcLoader`."""
+    setup()
 
     id = (path, row)
-    cell = ls_grid.loc[[id]]
+    cell = landsat_grid().loc[[id]]
 
     itempath = S3ItemPath(
         bucket=BUCKET,
@@ -176,20 +390,28 @@ def main(
         time=datetime,
     )
 
-    client = pystac_client.Client.open(
-        "https://landsatlook.usgs.gov/stac-server",
-        modifier=use_alternate_s3_href,
-    )
-
-    searcher = LandsatPystacSearcher(
-        client=client,
-        query={
-            "landsat:wrs_row": dict(eq=str(row).zfill(3)),
-            "landsat:wrs_path": dict(eq=str(path).zfill(3)),
-        },
-        datetime=datetime,
-        collections=["landsat-c2l2-sr"],
-    )
+    query = {
+        "landsat:wrs_row": dict(eq=str(row).zfill(3)),
+        "landsat:wrs_path": dict(eq=str(path).zfill(3)),
+    }
+    if is_static_catalog(LANDSAT_STAC_URL):
+        searcher = StaticCatalogSearcher(
+            LANDSAT_STAC_URL,
+            query=query,
+            datetime=datetime,
+            collections=["landsat-c2l2-sr"],
+        )
+    else:
+        # A search per year, run concurrently
+        searcher = WindowedSearcher(
+            lambda window: LandsatPystacSearcher(
+                client=landsatlook_client(),
+                query=query,
+                datetime=window,
+                collections=["landsat-c2l2-sr"],
+            ),
+            datetime,
+        )
 
     logger = CsvLogger(
         name=dataset_id,
@@ -197,20 +419,28 @@ def main(
         overwrite=False,
         header="time|index|status|paths|comment\n",
     )
+    stages = Stages(id, datetime=datetime, dataset_id=dataset_id)
+    stages_key = stages_path(itempath.log_path(), id)
 
     try:
-        items = searcher.search(cell)
+        with stages.stage("search") as counts:
+            items = searcher.search(cell)
+            counts["items"] = len(items)
     except EmptyCollectionError as e:
         logger.error([id, "no items found", e])
+        stages.save("no items found", BUCKET, stages_key)
         warnings.warn("No stac items found, exiting")
         # Don't reraise, it just means there's no data
         return None
 
     SR_BANDS = ["blue", "green", "red", "nir08", "swir16", "swir22"]
-    stacloader = PassThroughOdcLoader(
+    loader_class = CloudFirstOdcLoader if screen else PassThroughOdcLoader
+    stacloader = loader_class(
         dtype="uint16",
         bands=SR_BANDS + ["qa_pixel"],
-        chunks=dict(band=1, time=1, x=4096, y=4096),
+        chunks=dict(
+            band=1, time=1, x=chunk_size(BYTES_PER_PIXEL), y=chunk_size(BYTES_PER_PIXEL)
+        ),
         stac_cfg={
             "landsat-c2l2-sr": {
                 "assets": {"*": {"nodata": 0}, "qa_pixel": {"nodata": 1}}
@@ -218,7 +448,10 @@ def main(
         },
     )
 
-    processor = WoflProcessor()
+    # The DEM for every scene of this path/row comes from one cached superset,
+    # loaded once up front for the footprint of the scenes to be run
+    processor = WoflProcessor(dem_cache=DemCache(), dem_key=f"{path:03d}{row:03d}")
+    footprint = footprint_geobox(items)
     post_processor = DailyPostProcessor(
         convert_to_int16=False,
         output_nodata=1,
@@ -232,34 +465,120 @@ def main(
         version=version,
         time=None,
     )
-    item_searcher = IS()
+    path_row_cubes = None
+    if cube and footprint is not None:
+        path_row_cubes = PathRowCubes(
+            partial(cube_url, daily_itempath, id), footprint.pad(CUBE_PADDING)
+        )
+    elif cube:
+        warnings.warn("The scenes don't record their CRS, so no cube is written")
+
+    manifest = None
+    if checkpoint:
+        with stages.stage("load_manifest"):
+            manifest = SceneManifest(BUCKET, manifest_path(itempath.log_path(), id))
 
     try:
-        paths = MultiItemTask(
+        task = MultiItemTask(
             tile_id=id,
             items=items,
             itempath=daily_itempath,
             area=cell,
-            searcher=item_searcher,
             loader=stacloader,
             processor=processor,
             post_processor=post_processor,
             logger=logger,
-            stac_creator=StacCreator(
-                itempath=daily_itempath,
+            stac_creator=partial(
+                StacCreator,
                 collection_url_root=OUTPUT_COLLECTION_ROOT,
                 with_raster=True,
                 with_eo=True,
             ),
-        ).run()
+            concurrency=concurrency,
+            stages=stages,
+            prepare_dsm=processor.classifier.prepare_dsm,
+            cubes=path_row_cubes,
+            manifest=manifest,
+        )
+        with checkpointing(manifest):
+            paths = task.run()
     except Exception as e:
         # Quoting string here to escape newlines
         logger.error([id, "error", [], f'"{e}"'])
+        stages.save("error", BUCKET, stages_key)
         raise e
 
-    logger.info([id, "complete", paths])
+    logger.info(
+        [
+            id,
+            "complete",
+            paths,
+            f'"dsm cache hit rate: {processor.classifier.dsm_cache_hit_rate}"',
+        ]
+    )
+    if manifest is not None:
+        manifest.delete()
+    stages.save("complete", BUCKET, stages_key)
+
+
+def main(
+    version: Annotated[str, Option()],
+    path: Annotated[Optional[str], Option(parser=int)] = None,
+    row: Annotated[Optional[str], Option(parser=int)] = None,
+    datetime: Annotated[Optional[str], Option()] = None,
+    dataset_id: str = "wofl",
+    concurrency: Annotated[int, Option(help="Scenes processed at once")] = 1,
+    cube: Annotated[
+        str,
+        Option(
+            parser=bool_parser,
+            help="Also write the WOfLs to a Zarr cube for the path/row",
+        ),
+    ] = "False",
+    checkpoint: Annotated[
+        str,
+        Option(
+            parser=bool_parser,
+            help="Record the scenes which are done, so a retry resumes from them",
+        ),
+    ] = "False",
+    screen: Annotated[
+        str,
+        Option(
+            parser=bool_parser,
+            help="Skip scenes, and crop the rest, to the clear land in their "
+            "qa_pixel band. Pixels left out are nodata in the WOfLs",
+        ),
+    ] = "False",
+    batch: Annotated[
+        Optional[str],
+        Option(
+            help="A JSON list of tasks from print_tasks.py --batch-cost, each "
+            "with path, row and datetime, to run instead of a single path/row"
+        ),
+    ] = None,
+    scheduler: Annotated[
+        str,
+        Option(help=f"The dask scheduler, one of {', '.join(SCHEDULERS)}"),
+    ] = "distributed",
+) -> None:
+    kwargs = dict(
+        version=version,
+        dataset_id=dataset_id,
+        concurrency=concurrency,
+        cube=cube,
+        checkpoint=checkpoint,
+        screen=screen,
+    )
+    # Before the cluster starts, so its workers get the same configuration
+    setup()
+    # Path/rows are always large enough for "auto" to pick a distributed cluster
+    with dask_scheduler(scheduler):
+        if batch is not None:
+            run_batch(batch, process_tile, **kwargs)
+        else:
+            process_tile(path=path, row=row, datetime=datetime, **kwargs)
 
 
 if __name__ == "__main__":
-    with Client():
-        run(main)
+    run(main)
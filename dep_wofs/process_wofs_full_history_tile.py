@@ -1,32 +1,94 @@
+import math
+from functools import cache
+from typing import Optional
 from typing_extensions import Annotated
+import warnings
 
 import boto3
-from distributed import Client
+import numpy as np
 from typer import Option, run
 
 from cloud_logger import CsvLogger, S3Handler
+from dep_tools.exceptions import EmptyCollectionError
 from dep_tools.loaders import OdcLoader
 from dep_tools.namers import S3ItemPath
 from dep_tools.processors import XrPostProcessor
-from dep_tools.searchers import PystacSearcher
 from dep_tools.stac_utils import StacCreator
 from dep_tools.task import AwsStacTask as Task
 
-from config import BUCKET, OUTPUT_COLLECTION_ROOT
-from grid import grid
-from processors import WofsFullHistoryProcessor
+from dep_wofs.accumulators import (
+    Accumulator,
+    FoldedAnnuals,
+    item_versions,
+    tile_accumulator_path,
+)
+from dep_wofs.batching import run_batch
+from dep_wofs.checkpoints import AccumulatorCheckpoint, checkpoint_path, checkpointing
+from dep_wofs.cluster import SCHEDULERS, chunk_size, dask_scheduler
+from dep_wofs.config import BUCKET, DEP_STAC_URL, OUTPUT_COLLECTION_ROOT
+from dep_wofs.grid import dep_grid
+from dep_wofs.instrumentation import Stages, instrument, stages_path
+from dep_wofs.processors import (
+    IncrementalWofsFullHistoryProcessor,
+    WofsFullHistoryProcessor,
+)
+from dep_wofs.searchers import ItemsSearcher, catalog_searcher
+from dep_wofs.storage import configure_s3_endpoint
+from dep_wofs.summaries import full_history_summary
 
+# Memory needed per pixel of a chunk: the int16 annual counts and totals
+BYTES_PER_PIXEL = 16
 
-def main(
-    row: Annotated[str, Option(parser=int)],
-    column: Annotated[str, Option(parser=int)],
-    datetime: Annotated[str, Option()],
-    version: Annotated[str, Option()],
+
+def bool_parser(raw: str):
+    return False if raw == "False" else True
+
+
+@cache
+def setup() -> None:
+    """Configuration which only needs doing once per process, however many
+    tiles it runs."""
+    configure_s3_endpoint()
+    boto3.setup_default_session()
+
+
+def verify_summary(output, expected) -> list[str]:
+    """The names of variables which differ between `output` and `expected`."""
+    return [
+        name
+        for name in ["count_clear", "count_wet", "frequency"]
+        if not np.array_equal(
+            output[name].values, expected[name].values, equal_nan=True
+        )
+    ]
+
+
+def process_tile(
+    row: int,
+    column: int,
+    datetime: str,
+    version: str,
     dataset_id: str = "wofs_summary_alltime",
+    incremental: bool = False,
+    verify: bool = False,
+    time_batch: int | None = None,
+    checkpoint: bool = False,
 ) -> None:
-    boto3.setup_default_session()
+    """If `incremental` is True, the totals from the last run for this tile
+    are loaded and only annual summaries which are new since then are added to
+    them. The totals are kept per tile, whatever the time range, so a run with
+    a year added carries on from the last one. Any annual summary which was
+    already added but has changed (based on its "updated" timestamp,
+    checksums or ETags) or is no longer in the time range is subtracted from
+    them, using the copy kept when it was added (see `FoldedAnnuals`), and
+    changed ones are added again. If `verify` is also True, the result is
+    compared with a full recompute. If `time_batch` is given, the annual
+    summaries are added that many at a time, and if `checkpoint` is True the
+    totals are checkpointed between batches so a retry of an interrupted run
+    resumes from them (see checkpoints.py)."""
+    setup()
     id = (column, row)
-    cell = grid.loc[id].geobox.tolist()[0]
+    cell = dep_grid().loc[id].geobox.tolist()[0]
 
     itempath = S3ItemPath(
         bucket=BUCKET,
@@ -36,8 +98,8 @@ def main(
         time=datetime.replace("/", "_"),
     )
 
-    searcher = PystacSearcher(
-        catalog=f"https://stac.prod.digitalearthpacific.io",
+    searcher = catalog_searcher(
+        DEP_STAC_URL,
         datetime=datetime,
         collections=["dep_ls_wofs_summary_annual"],
     )
@@ -45,16 +107,10 @@ def main(
     stacloader = OdcLoader(
         bands=["count_clear", "count_wet"],
         dtype="int16",
-        chunks=dict(x=4096, y=4096),
+        chunks=dict(x=chunk_size(BYTES_PER_PIXEL), y=chunk_size(BYTES_PER_PIXEL)),
         fail_on_error=False,
     )
 
-    processor = WofsFullHistoryProcessor(send_area_to_processor=True)
-    post_processor = XrPostProcessor(
-        convert_to_int16=False,
-        extra_attrs=dict(dep_version=version),
-    )
-
     logger = CsvLogger(
         name=dataset_id,
         path=f"{itempath.bucket}/{itempath.log_path()}",
@@ -62,9 +118,87 @@ def main(
         header="time|index|status|paths|comment\n",
         cloud_handler=S3Handler,
     )
+    stages = Stages(id, datetime=datetime, dataset_id=dataset_id)
+    stages_key = stages_path(itempath.log_path(), id)
+
+    processor = WofsFullHistoryProcessor(send_area_to_processor=True)
+    checkpointer = None
+    folded = None
+    if incremental or checkpoint:
+        accumulator = Accumulator()
+        if incremental:
+            accumulator_key = tile_accumulator_path(itempath, id)
+            folded = FoldedAnnuals(BUCKET, accumulator_key)
+            with stages.stage("load_accumulator"):
+                accumulator = Accumulator.load(BUCKET, accumulator_key)
+        if checkpoint:
+            if time_batch is None:
+                warnings.warn("Checkpoints are only saved between time batches")
+            checkpointer = AccumulatorCheckpoint(BUCKET, checkpoint_path(itempath, id))
+            with stages.stage("load_checkpoint"):
+                # The totals as of the last batch an earlier attempt saved
+                accumulator = checkpointer.load() or accumulator
+        try:
+            with stages.stage("search") as counts:
+                all_items = searcher.search(cell)
+                counts["items"] = len(all_items)
+        except EmptyCollectionError:
+            all_items = []
+
+        # An annual summary which was folded in without a version can't be
+        # shown to be unchanged, so it's treated as changed too
+        versions = item_versions(all_items)
+        changed = [
+            item_id
+            for item_id, folded_version in accumulator.items.items()
+            if folded_version is None
+            or versions.get(item_id, "removed") != folded_version
+        ]
+        removed = [item_id for item_id in changed if item_id not in versions]
+        if len(changed) > 0:
+            with stages.stage("subtract_changed") as counts:
+                counts["items"] = len(changed)
+                subtracted = folded is not None and folded.subtract(
+                    accumulator, changed
+                )
+            if not subtracted:
+                warnings.warn(
+                    "Annual summaries have changed and no copies of them were "
+                    "kept, rebuilding totals"
+                )
+                accumulator = Accumulator()
+
+        items = [item for item in all_items if item.id not in accumulator.items]
+        if len(items) == 0 and len(changed) > 0:
+            # Annual summaries were only removed, which leaves nothing to load
+            # the output alongside
+            accumulator = Accumulator()
+            items = all_items
+        if incremental and len(items) == 0 and accumulator.counts is not None:
+            logger.info([id, "complete", [], '"no new items"'])
+            stages.save("complete", BUCKET, stages_key)
+            return None
+
+        searcher = ItemsSearcher(items)
+        if checkpointer is not None:
+            checkpointer.start(accumulator, items, versions)
+        if folded is not None:
+            folded.start(items)
+        processor = IncrementalWofsFullHistoryProcessor(
+            accumulator,
+            send_area_to_processor=True,
+            time_batch=time_batch,
+            checkpoint=checkpointer,
+            folded=folded,
+        )
+
+    post_processor = XrPostProcessor(
+        convert_to_int16=False,
+        extra_attrs=dict(dep_version=version),
+    )
 
     try:
-        paths = Task(
+        task = Task(
             itempath=itempath,
             id=id,
             area=cell,
@@ -79,14 +213,95 @@ def main(
                 with_raster=True,
                 with_eo=True,
             ),
-        ).run()
+        )
+        with checkpointing(checkpointer):
+            paths = instrument(task, stages, processor="summarize").run()
     except Exception as e:
         logger.error([id, "error", e])
+        stages.save("error", BUCKET, stages_key)
         raise e
 
+    if incremental:
+        if verify:
+            with stages.stage("verify"):
+                expected = WofsFullHistoryProcessor().process(
+                    stacloader.load(all_items, cell)
+                )
+                mismatched = verify_summary(
+                    full_history_summary(accumulator.counts), expected
+                )
+            if len(mismatched) > 0:
+                logger.error([id, "error", [], f'"verification failed: {mismatched}"'])
+                stages.save("error", BUCKET, stages_key)
+                raise ValueError(
+                    f"Incremental summary differs from full recompute: {mismatched}"
+                )
+
+        accumulator.items.update({item.id: versions[item.id] for item in items})
+        with stages.stage("save_accumulator"):
+            accumulator.save(BUCKET, accumulator_key)
+            # Only once the totals no longer include them
+            folded.delete(removed)
+    if checkpointer is not None:
+        checkpointer.delete()
+
     logger.info([id, "complete", paths])
+    stages.save("complete", BUCKET, stages_key)
+
+
+def main(
+    version: Annotated[str, Option()],
+    row: Annotated[Optional[str], Option(parser=int)] = None,
+    column: Annotated[Optional[str], Option(parser=int)] = None,
+    datetime: Annotated[Optional[str], Option()] = None,
+    dataset_id: str = "wofs_summary_alltime",
+    incremental: Annotated[str, Option(parser=bool_parser)] = "False",
+    verify: Annotated[str, Option(parser=bool_parser)] = "False",
+    time_batch: Annotated[
+        Optional[int],
+        Option(help="Add the annual summaries this many at a time"),
+    ] = None,
+    checkpoint: Annotated[
+        str,
+        Option(
+            parser=bool_parser,
+            help="Checkpoint the totals between time batches, so a retry "
+            "resumes from them",
+        ),
+    ] = "False",
+    batch: Annotated[
+        Optional[str],
+        Option(
+            help="A JSON list of tasks from print_tasks.py --batch-cost, each "
+            "with row, column and datetime, to run instead of a single tile"
+        ),
+    ] = None,
+    scheduler: Annotated[
+        str,
+        Option(help=f"The dask scheduler, one of {', '.join(SCHEDULERS)}"),
+    ] = "distributed",
+) -> None:
+    kwargs = dict(
+        version=version,
+        dataset_id=dataset_id,
+        incremental=incremental,
+        verify=verify,
+        time_batch=time_batch,
+        checkpoint=checkpoint,
+    )
+    n_pixels = (
+        None
+        if batch is not None
+        else math.prod(dep_grid().loc[(column, row)].geobox.tolist()[0].shape)
+    )
+    # Before the cluster starts, so its workers get the same configuration
+    setup()
+    with dask_scheduler(scheduler, n_pixels):
+        if batch is not None:
+            run_batch(batch, process_tile, **kwargs)
+        else:
+            process_tile(row=row, column=column, datetime=datetime, **kwargs)
 
 
 if __name__ == "__main__":
-    with Client():
-        run(main)
+    run(main)
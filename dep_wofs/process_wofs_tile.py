@@ -1,36 +1,72 @@
+import math
+from functools import cache, partial
+from typing import Optional
 from typing_extensions import Annotated
+import warnings
 
 import boto3
-from distributed import Client
 from typer import Option, run
 
 from cloud_logger import CsvLogger, S3Handler
-from dep_tools.loaders import OdcLoader
+from dep_tools.exceptions import EmptyCollectionError
 from dep_tools.namers import S3ItemPath
 from dep_tools.processors import XrPostProcessor
-from dep_tools.searchers import PystacSearcher
 from dep_tools.stac_utils import StacCreator
 from dep_tools.task import AwsStacTask as Task
 
-from config import BUCKET, OUTPUT_COLLECTION_ROOT
-from grid import grid
-from processors import WofsProcessor
+from dep_wofs.accumulators import Accumulator, accumulator_path
+from dep_wofs.batching import run_batch
+from dep_wofs.checkpoints import AccumulatorCheckpoint, checkpoint_path, checkpointing
+from dep_wofs.cluster import SCHEDULERS, chunk_size, dask_scheduler
+from dep_wofs.config import BUCKET, DEP_STAC_URL, OUTPUT_COLLECTION_ROOT
+from dep_wofs.cube import CubeLoader, CubeSearcher, cube_url
+from dep_wofs.grid import dep_grid
+from dep_wofs.instrumentation import Stages, instrument, stages_path
+from dep_wofs.namers import DailyItemPath
+from dep_wofs.processors import IncrementalWofsProcessor, WofsProcessor
+from dep_wofs.reproject import PlannedOdcLoader
+from dep_wofs.searchers import ItemsSearcher, catalog_searcher
+from dep_wofs.storage import configure_s3_endpoint
+
+# Memory needed per pixel of a chunk: the uint8 WOfLs, and the int16 counts
+# and intermediates of the reduction over time
+BYTES_PER_PIXEL = 16
 
 
 def bool_parser(raw: str):
     return False if raw == "False" else True
 
 
-def main(
-    row: Annotated[str, Option(parser=int)],
-    column: Annotated[str, Option(parser=int)],
-    datetime: Annotated[str, Option()],
-    version: Annotated[str, Option()],
+@cache
+def setup() -> None:
+    """Configuration which only needs doing once per process, however many
+    tiles it runs."""
+    configure_s3_endpoint()
+    boto3.setup_default_session()
+
+
+def process_tile(
+    row: int,
+    column: int,
+    datetime: str,
+    version: str,
     dataset_id: str = "wofs_summary_annual",
+    incremental: bool = False,
+    cube_version: str | None = None,
+    time_batch: int | None = None,
+    checkpoint: bool = False,
 ) -> None:
-    boto3.setup_default_session()
+    """If `incremental` is True, the counts from the last run for this tile
+    are loaded and only WOfLs which weren't part of that run are added to
+    them. If `cube_version` is given, the WOfLs are read from the cubes of
+    that version of the WOfLs (see cube.py) rather than their COGs. If
+    `time_batch` is given, the WOfLs are counted that many at a time, so
+    memory doesn't grow with the number of them. If `checkpoint` is also
+    True, the counts are checkpointed between batches and a retry of an
+    interrupted run resumes from the last checkpoint (see checkpoints.py)."""
+    setup()
     id = (column, row)
-    cell = grid.loc[id].geobox.tolist()[0]
+    cell = dep_grid().loc[id].geobox.tolist()[0]
 
     itempath = S3ItemPath(
         bucket=BUCKET,
@@ -40,23 +76,26 @@ def main(
         time=datetime,
     )
 
-    searcher = PystacSearcher(
-        catalog=f"https://stac.prod.digitalearthpacific.io",
-        datetime=datetime,
-        collections=["dep_ls_wofl"],
-    )
-
-    stacloader = OdcLoader(
-        dtype="uint8",
-        chunks=dict(x=4096, y=4096),
-        fail_on_error=False,
-    )
-
-    processor = WofsProcessor(send_area_to_processor=True)
-    post_processor = XrPostProcessor(
-        convert_to_int16=False,
-        extra_attrs=dict(dep_version=version),
-    )
+    chunks = dict(x=chunk_size(BYTES_PER_PIXEL), y=chunk_size(BYTES_PER_PIXEL))
+    if cube_version is not None:
+        wofl_itempath = DailyItemPath(
+            bucket=BUCKET,
+            sensor="ls",
+            dataset_id="wofl",
+            version=cube_version,
+            time=None,
+        )
+        searcher = CubeSearcher(partial(cube_url, wofl_itempath), datetime)
+        stacloader = CubeLoader(chunks=chunks)
+    else:
+        searcher = catalog_searcher(
+            DEP_STAC_URL,
+            datetime=datetime,
+            collections=["dep_ls_wofl"],
+        )
+        # Each path/row's pixel grid is reprojected onto the tile once, rather
+        # than once per WOfL
+        stacloader = PlannedOdcLoader(dtype="uint8", chunks=chunks, fail_on_error=False)
 
     logger = CsvLogger(
         name=dataset_id,
@@ -65,9 +104,60 @@ def main(
         header="time|index|status|paths|comment\n",
         cloud_handler=S3Handler,
     )
+    stages = Stages(id, datetime=datetime, dataset_id=dataset_id)
+    stages_key = stages_path(itempath.log_path(), id)
+
+    processor = WofsProcessor(send_area_to_processor=True, time_batch=time_batch)
+    checkpointer = None
+    if incremental or checkpoint:
+        accumulator = Accumulator()
+        if incremental:
+            accumulator_key = accumulator_path(itempath, id)
+            with stages.stage("load_accumulator"):
+                accumulator = Accumulator.load(BUCKET, accumulator_key)
+        if checkpoint:
+            if time_batch is None:
+                warnings.warn("Checkpoints are only saved between time batches")
+            checkpointer = AccumulatorCheckpoint(BUCKET, checkpoint_path(itempath, id))
+            with stages.stage("load_checkpoint"):
+                # The accumulator as of the last batch an earlier attempt saved
+                accumulator = checkpointer.load() or accumulator
+        try:
+            with stages.stage("search") as counts:
+                items = [
+                    item
+                    for item in searcher.search(cell)
+                    if item.id not in accumulator.items
+                ]
+                counts["items"] = len(items)
+        except EmptyCollectionError:
+            items = []
+
+        if incremental and len(items) == 0 and accumulator.counts is not None:
+            logger.info([id, "complete", [], '"no new items"'])
+            stages.save("complete", BUCKET, stages_key)
+            return None
+
+        searcher = ItemsSearcher(items)
+        # WOfLs are only ever added, so only their ids are recorded: looking
+        # up versions would take a request per asset of each WOfL
+        versions = {item.id: None for item in items}
+        if checkpointer is not None:
+            checkpointer.start(accumulator, items, versions)
+        processor = IncrementalWofsProcessor(
+            accumulator,
+            send_area_to_processor=True,
+            time_batch=time_batch,
+            checkpoint=checkpointer,
+        )
+
+    post_processor = XrPostProcessor(
+        convert_to_int16=False,
+        extra_attrs=dict(dep_version=version),
+    )
 
     try:
-        paths = Task(
+        task = Task(
             itempath=itempath,
             id=id,
             area=cell,
@@ -82,14 +172,87 @@ def main(
                 with_raster=True,
                 with_eo=True,
             ),
-        ).run()
+        )
+        with checkpointing(checkpointer):
+            paths = instrument(task, stages, processor="summarize").run()
     except Exception as e:
         logger.error([id, "error", e])
+        stages.save("error", BUCKET, stages_key)
         raise e
 
+    if incremental:
+        accumulator.items.update(versions)
+        with stages.stage("save_accumulator"):
+            accumulator.save(BUCKET, accumulator_key)
+    if checkpointer is not None:
+        checkpointer.delete()
+
     logger.info([id, "complete", paths])
+    stages.save("complete", BUCKET, stages_key)
+
+
+def main(
+    version: Annotated[str, Option()],
+    row: Annotated[Optional[str], Option(parser=int)] = None,
+    column: Annotated[Optional[str], Option(parser=int)] = None,
+    datetime: Annotated[Optional[str], Option()] = None,
+    dataset_id: str = "wofs_summary_annual",
+    incremental: Annotated[str, Option(parser=bool_parser)] = "False",
+    cube_version: Annotated[
+        Optional[str],
+        Option(
+            help="Read the WOfLs from the cubes of this version, written by "
+            "process_wofls_tile.py --cube, rather than from their COGs"
+        ),
+    ] = None,
+    time_batch: Annotated[
+        Optional[int],
+        Option(
+            help="Count the WOfLs this many at a time, bounding memory by the "
+            "batch rather than the number of WOfLs in the year"
+        ),
+    ] = None,
+    checkpoint: Annotated[
+        str,
+        Option(
+            parser=bool_parser,
+            help="Checkpoint the counts between time batches, so a retry "
+            "resumes from them",
+        ),
+    ] = "False",
+    batch: Annotated[
+        Optional[str],
+        Option(
+            help="A JSON list of tasks from print_tasks.py --batch-cost, each "
+            "with row, column and datetime, to run instead of a single tile"
+        ),
+    ] = None,
+    scheduler: Annotated[
+        str,
+        Option(help=f"The dask scheduler, one of {', '.join(SCHEDULERS)}"),
+    ] = "distributed",
+) -> None:
+    kwargs = dict(
+        version=version,
+        dataset_id=dataset_id,
+        incremental=incremental,
+        cube_version=cube_version,
+        time_batch=time_batch,
+        checkpoint=checkpoint,
+    )
+    n_pixels = (
+        None
+        if batch is not None
+        else math.prod(dep_grid().loc[(column, row)].geobox.tolist()[0].shape)
+    )
+    # Before the cluster starts, so its workers get the same configuration
+    setup()
+    with dask_scheduler(scheduler, n_pixels):
+        if batch is not None:
+            run_batch(batch, process_tile, **kwargs)
+        else:
+            process_tile(row=row, column=column, datetime=datetime, **kwargs)
 
 
 if __name__ == "__main__":
-    with Client():
-        run(main)
+    run(main)
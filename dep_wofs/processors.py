@@ -1,13 +1,24 @@
+from threading import Lock
+
 from odc.geo.geobox import GeoBox
-from odc.geo.geom import Geometry, unary_intersection
-from odc.stac import load
-from odc.stats.plugins.wofs import StatsWofs, StatsWofsFullHistory
+from odc.stats.plugins.wofs import StatsWofsFullHistory
 from wofs.virtualproduct import WOfSClassifier
 from xarray import Dataset
 
 from dep_tools.processors import Processor
-from dep_tools.searchers import PystacSearcher
-from dep_wofs.grid import GADM
+from dep_wofs.accumulators import Accumulator, FoldedAnnuals
+from dep_wofs.checkpoints import AccumulatorCheckpoint
+from dep_wofs.classifier import classify_wofls, terrain_flags
+from dep_wofs.dem import DEM_PADDING, DemCache, covers, is_aligned, load_dem
+from dep_wofs.mask import mask_to_land
+from dep_wofs.summaries import (
+    batched_wofs_counts,
+    full_history_counts,
+    full_history_summary,
+    time_batches,
+    wofs_counts,
+    wofs_summary,
+)
 
 
 def wofl(ls_c2_ds: Dataset) -> Dataset:
@@ -23,10 +34,16 @@ class WoflProcessor(Processor):
     to the DEP scaling abstractions in dep-tools.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        dem_cache: DemCache | None = None,
+        dem_key: str | None = None,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
         # Init this separately to accommodate dsm caching
-        self.classifier = DepWOfSClassifier()
+        self.classifier = DepWOfSClassifier(dem_cache=dem_cache, dem_key=dem_key)
 
     def process(self, ls_c2_ds):
         output = self.classifier.compute(ls_c2_ds)
@@ -39,59 +56,154 @@ class WofsFullHistoryProcessor(Processor):
         summarizer = StatsWofsFullHistory()
         output = summarizer.reduce(wofs_annuals)
         if area is not None:
+            output["frequency_masked"] = mask_to_land(output.frequency, area)
+        return output
+
+
+class IncrementalWofsFullHistoryProcessor(WofsFullHistoryProcessor):
+    """Adds the annual summaries it is given to the int32 totals in
+    `accumulator`, rather than re-summing every year. Output matches that of
+    WofsFullHistoryProcessor for the same set of annual summaries. If
+    `time_batch` is given, the annual summaries are added that many at a time,
+    and `checkpoint`, if given, is advanced after each batch. If `folded` is
+    given, a copy of each annual summary added is saved in it, and each batch
+    is loaded into memory once for both.
+    """
+
+    def __init__(
+        self,
+        accumulator: Accumulator,
+        *args,
+        time_batch: int | None = None,
+        checkpoint: AccumulatorCheckpoint | None = None,
+        folded: FoldedAnnuals | None = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.accumulator = accumulator
+        self.time_batch = time_batch
+        self.checkpoint = checkpoint
+        self.folded = folded
 
-            geom = unary_intersection(
-                [
-                    area.boundingbox.polygon,
-                    Geometry(GADM.to_crs(area.crs).geometry.unary_union, crs=area.crs),
-                ]
-            )
-            output["frequency_masked"] = output.frequency.odc.mask(geom)
+    def process(self, wofs_annuals, area=None) -> Dataset:
+        if self.time_batch is None:
+            batches = [(wofs_annuals, None)]
+        else:
+            batches = time_batches(wofs_annuals, self.time_batch)
+        for batch, until in batches:
+            if self.folded is not None:
+                batch = batch.load()
+                self.folded.save(batch)
+            self.accumulator.add(full_history_counts(batch).compute())
+            if self.checkpoint is not None:
+                self.checkpoint.advance(until)
+        output = full_history_summary(self.accumulator.counts)
+        if area is not None:
+            output["frequency_masked"] = mask_to_land(output.frequency, area)
         return output
 
 
 class WofsProcessor(Processor):
-    """A wrapper around `odc.stats.plugins.wofs.StatsWofs`. Accepts a time
-    series of WOfS feature layers indexed by a "time" coordinate. In addition
+    """Summarizes a time series of WOfS feature layers indexed by a "time"
+    coordinate, producing the same output as `odc.stats.plugins.wofs.StatsWofs`
+    in a single pass (see `dep_wofs.summaries`). In addition
     to "count_wet", "count_clear" and "frequency" variables, optionally creates
-    a masked version of frequency if a mask is provided. Useful for additional
+    a masked version of frequency if an area is provided. Useful for additional
     area filtering. In the DEP workflow, it is used to mask out ocean waters
-    which are poorly classified by the WOfS algorithm.
+    which are poorly classified by the WOfS algorithm. If `time_batch` is
+    given, the WOfLs are counted that many time steps at a time (see
+    `batched_wofs_counts`), which bounds memory for long time series.
     """
 
+    def __init__(self, *args, time_batch: int | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.time_batch = time_batch
+
     def process(self, wofls: Dataset, area=None) -> Dataset:
-        summarizer = StatsWofs()
-        prepped = wofls.groupby("time").apply(
-            lambda ds: summarizer.native_transform(ds)
-        )
-        output = summarizer.reduce(prepped)
-        if area is not None:
+        return self.summarize(self.count(wofls), area)
+
+    def count(self, wofls: Dataset) -> Dataset:
+        if self.time_batch is None:
+            return wofs_counts(wofls.water)
+        return batched_wofs_counts(wofls.water, self.time_batch)
 
-            geom = unary_intersection(
-                [
-                    area.boundingbox.polygon,
-                    Geometry(GADM.to_crs(area.crs).geometry.unary_union, crs=area.crs),
-                ]
-            )
-            output["frequency_masked"] = output.frequency.odc.mask(geom)
+    def summarize(self, counts: Dataset, area=None) -> Dataset:
+        output = wofs_summary(counts)
+        if area is not None:
+            output["frequency_masked"] = mask_to_land(output.frequency, area)
         return output
 
 
+class IncrementalWofsProcessor(WofsProcessor):
+    """A WofsProcessor which adds the counts from the WOfLs it is given to
+    those in `accumulator` before summarizing. This means only WOfLs which are
+    not already part of the accumulated counts need to be loaded. If
+    `checkpoint` is given, it's advanced after each time batch.
+    """
+
+    def __init__(
+        self,
+        accumulator: Accumulator,
+        *args,
+        checkpoint: AccumulatorCheckpoint | None = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.accumulator = accumulator
+        self.checkpoint = checkpoint
+
+    def process(self, wofls: Dataset, area=None) -> Dataset:
+        # Computed here so the accumulator can be saved without recomputing
+        if self.time_batch is None:
+            self.accumulator.add(wofs_counts(wofls.water).compute())
+        else:
+            for batch, until in time_batches(wofls, self.time_batch):
+                self.accumulator.add(batched_wofs_counts(batch.water, self.time_batch))
+                if self.checkpoint is not None:
+                    self.checkpoint.advance(until)
+        return self.summarize(self.accumulator.counts, area)
+
+
 class DepWOfSClassifier(WOfSClassifier):
     """A wrapper around wofs.virtualproduct.WOfSClassifier. Allows the use of
     input data with band names "blue", "green", "red", "nir08", "swir16",
     "swir22" and "qa_pixel", rather than "nbart_blue", "nbart_green",
     "nbart_red", "nbart_nir", "nbart_swir_1", "nbart_swir_2", and "fmask".
     Also uses the Copernicus 30-meter dem loaded from the stac catalog rather
-    than a datacube loaded DEM.
+    than a datacube loaded DEM. If a `dem_cache` is given, the DEM is read
+    through it, with `dem_key` (e.g. the Landsat path/row) identifying the
+    area the scenes come from. Unless `native` is False, classification is
+    done by `dep_wofs.classifier.classify_wofls` rather than the upstream
+    code, with identical output.
     """
 
-    def __init__(self, **kwargs):
+    def __init__(
+        self,
+        dem_cache: DemCache | None = None,
+        dem_key: str | None = None,
+        native: bool = True,
+        **kwargs,
+    ):
         # Placeholder needed here so _load_dsm is called
         super().__init__(c2_scaling=True, dsm_path="this_is_a_placeholder", **kwargs)
+        self._dem_cache = dem_cache
+        self._dem_key = dem_key
+        self._native = native
+        # The DEM for an area containing the scenes, which each scene's DEM is
+        # sliced from when possible
         self._dsm = None
+        # The DEM of the last scene outside that area, which is kept apart
+        # so it doesn't replace it
+        self._miss_dsm = None
+        self.dsm_cache_hits = 0
+        self.dsm_cache_misses = 0
+        # Scenes may be classified concurrently, see MultiItemTask
+        self._dsm_lock = Lock()
 
     def compute(self, data) -> Dataset:
+        if self._native:
+            return self._compute_native(data)
+
         data = data.rename(
             {
                 "blue": "nbart_blue",
@@ -105,27 +217,61 @@ class DepWOfSClassifier(WOfSClassifier):
         ).assign_attrs(crs=data.rio.crs)
         return super().compute(data)
 
+    def _compute_native(self, data) -> Dataset:
+        terrain = terrain_flags(
+            self._load_dsm(data.odc.geobox),
+            data.time.values,
+            no_data=self.dsm_no_data,
+            ignore_dsm_no_data=self.ignore_dsm_no_data,
+        )
+        return classify_wofls(data, terrain).assign_attrs(crs=data.rio.crs)
+
+    @property
+    def dsm_cache_hit_rate(self) -> float | None:
+        requests = self.dsm_cache_hits + self.dsm_cache_misses
+        return self.dsm_cache_hits / requests if requests > 0 else None
+
+    def _read_dsm(self, geobox: GeoBox) -> Dataset:
+        if self._dem_cache is not None and self._dem_key is not None:
+            elevation = self._dem_cache.get(geobox, self._dem_key)
+        else:
+            elevation = load_dem(geobox)
+
+        return (
+            elevation.to_dataset(name="elevation")  # named for wofs functionality
+            .assign_attrs(crs=geobox.crs)
+            .persist()
+        )
+
+    def prepare_dsm(self, geobox: GeoBox) -> None:
+        """Load the DEM for `geobox`, so that scenes within it are served from
+        memory. Usually `geobox` covers all the scenes of a path/row. It's
+        padded by `DEM_PADDING`, as scenes shift by a few pixels."""
+        dsm = self._read_dsm(geobox.pad(DEM_PADDING))
+        with self._dsm_lock:
+            self._dsm = dsm
+
     def _load_dsm(self, gbox):
         # This comes in as a datacube.utils.geometry._base.GeoBox, which fails
         # instance type tests downstream in odc.stac.load (also in dep_tools.utils).
         realgeobox = GeoBox(gbox.shape, gbox.affine, gbox.crs)
-        # cache dsm for multiple dates in the same aoi.
-        if self._dsm is None or (self._realgeobox and (self._realgeobox != realgeobox)):
-            self._realgeobox = realgeobox
-
-            # Use PystacSearcher instead of just searching to be OK across -180
-            items = PystacSearcher(
-                # Note that this server can get overloaded and refuse connections
-                # when running with many parallel pods (say 100+)
-                catalog="https://earth-search.aws.element84.com/v1",
-                collections=["cop-dem-glo-30"],
-            ).search(self._realgeobox)
-
-            self._dsm = (
-                load(items, geobox=self._realgeobox)
-                .rename(dict(data="elevation"))  # renamed for wofs functionality
-                .squeeze()
-                .assign_attrs(crs=self._realgeobox.crs)
-                .persist()
-            )
-        return self._dsm
+        # cache dsm for multiple dates in the same aoi. Scenes of the same
+        # path/row differ by a few pixels, so compare by footprint rather than
+        # equality.
+        with self._dsm_lock:
+            for dsm in [self._dsm, self._miss_dsm]:
+                if (
+                    dsm is not None
+                    and covers(dsm.odc.geobox, realgeobox)
+                    and is_aligned(dsm.odc.geobox, realgeobox)
+                ):
+                    self.dsm_cache_hits += 1
+                    y, x = dsm.odc.geobox.overlap_roi(realgeobox)
+                    return dsm.isel(y=y, x=x)
+            self.dsm_cache_misses += 1
+
+        # Read without holding the lock, so other scenes are still served
+        dsm = self._read_dsm(realgeobox)
+        with self._dsm_lock:
+            self._miss_dsm = dsm
+        return dsm
@@ -0,0 +1,213 @@
+"""Nearest neighbour reprojection of stacks of WOfLs onto DEP tiles.
+
+Loading a year of WOfLs for a tile with `odc.stac.load` reprojects each of
+them separately, recomputing the same coordinate transform hundreds of times,
+although all the WOfLs of a path/row share one pixel grid. Here the mapping
+from each pixel of the tile to the pixel of a source grid containing its
+centre is computed once per (source grid, tile), cached, and applied to a
+whole stack at once as a gather. Nearest neighbour is all the WOfL bitmask
+can be resampled with anyway.
+
+`PlannedOdcLoader` loads WOfL COGs this way, reading each pixel grid natively
+before gathering it onto the tile, and `CubeLoader` (see cube.py) loads from
+the cubes with `reproject_stack`.
+"""
+
+from functools import lru_cache
+
+import dask.array as da
+import numpy as np
+import odc.stac
+import xarray as xr
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import xr_coords
+from xarray import DataArray, Dataset
+
+# Destination rows transformed at a time when planning, to bound the memory
+# used by the coordinates
+_PLAN_ROWS = 256
+
+# A plan takes 4 bytes per pixel of the tile, about 40MB for a DEP tile, and
+# is only reused for the same tile, which has a plan per pixel grid of the
+# path/rows covering it (usually one or two). Tiles are run one at a time, so
+# this is enough for the tile being run.
+_CACHED_PLANS = 4
+
+
+class ReprojectionPlan:
+    """For each pixel of `dst`, the pixel of `src` containing its centre, if
+    any, as a flat index into the window of `src` which is needed (-1 where
+    there is none)."""
+
+    def __init__(self, src: GeoBox, dst: GeoBox):
+        self.src = src
+        self.dst = dst
+        to_src = dst.crs.transformer_to_crs(src.crs)
+        src_rows = np.empty(dst.shape.yx, dtype="int32")
+        src_cols = np.empty(dst.shape.yx, dtype="int32")
+        cols = np.arange(dst.shape.x) + 0.5
+        for start in range(0, dst.shape.y, _PLAN_ROWS):
+            rows = np.arange(start, min(start + _PLAN_ROWS, dst.shape.y)) + 0.5
+            x, y = dst.affine * np.meshgrid(cols, rows)
+            x, y = to_src(x, y)
+            col, row = ~src.affine * (x, y)
+            src_rows[start : start + len(rows)] = np.floor(row)
+            src_cols[start : start + len(rows)] = np.floor(col)
+        valid = (
+            (src_rows >= 0)
+            & (src_rows < src.shape.y)
+            & (src_cols >= 0)
+            & (src_cols < src.shape.x)
+        )
+        self.window, self.index = _window_index(src_rows, src_cols, valid)
+
+    @property
+    def valid(self) -> np.ndarray:
+        """Whether each pixel of `dst` has a source pixel."""
+        return self.index >= 0
+
+    def block(self, rows: slice, cols: slice) -> "ReprojectionPlan":
+        """The plan for just the pixels `rows` and `cols` of `dst`."""
+        block = object.__new__(ReprojectionPlan)
+        block.src = self.src
+        block.dst = self.dst[rows, cols]
+        # Indices of the block within the full window
+        width = self.window[1].stop - self.window[1].start
+        index = self.index[rows, cols]
+        window, block.index = _window_index(index // width, index % width, index >= 0)
+        block.window = tuple(
+            slice(outer.start + inner.start, outer.start + inner.stop)
+            for outer, inner in zip(self.window, window)
+        )
+        return block
+
+    def apply(self, data: np.ndarray, nodata) -> np.ndarray:
+        """Gather `data`, of shape `(..., y, x)` on `src` or on the window of
+        `src` the plan needs, onto `dst`, with `nodata` where there is no
+        source pixel."""
+        if data.shape[-2:] == self.src.shape.yx:
+            data = data[..., self.window[0], self.window[1]]
+        flat = data.reshape(data.shape[:-2] + (-1,))
+        valid = self.valid
+        output = np.take(flat, np.where(valid, self.index, 0), axis=-1)
+        output[..., ~valid] = nodata
+        return output
+
+
+def _window_index(
+    rows: np.ndarray, cols: np.ndarray, valid: np.ndarray
+) -> tuple[tuple[slice, slice], np.ndarray]:
+    """The window of the source containing all the valid `rows` and `cols`,
+    and the flat index of each within it (-1 where not `valid`)."""
+    if not valid.any():
+        return (slice(0, 0), slice(0, 0)), np.full(valid.shape, -1, dtype="int32")
+    row0, row1 = rows[valid].min(), rows[valid].max() + 1
+    col0, col1 = cols[valid].min(), cols[valid].max() + 1
+    index = np.where(valid, (rows - row0) * (col1 - col0) + (cols - col0), -1)
+    window = (slice(int(row0), int(row1)), slice(int(col0), int(col1)))
+    return window, index.astype("int32")
+
+
+@lru_cache(maxsize=_CACHED_PLANS)
+def reprojection_plan(src: GeoBox, dst: GeoBox) -> ReprojectionPlan:
+    return ReprojectionPlan(src, dst)
+
+
+def reproject_stack(
+    stack: DataArray, dst: GeoBox, nodata, chunks: dict | None = None
+) -> DataArray:
+    """`stack`, with dimensions `(time, y, x)`, on `dst` by nearest neighbour.
+    If `stack` is a dask array, so is the output, in chunks of `chunks` (by
+    default those of `stack`) on `dst`."""
+    plan = reprojection_plan(stack.odc.geobox, dst)
+    data = stack.transpose("time", *stack.odc.spatial_dims).data
+    coords = dict(time=stack.time, **xr_coords(dst))
+    dims = ("time",) + dst.dimensions
+    if not isinstance(data, da.Array):
+        return DataArray(plan.apply(np.asarray(data), nodata), coords=coords, dims=dims)
+
+    chunks = chunks if chunks is not None else dict()
+    y_chunks = _chunks(dst.shape.y, chunks.get(dims[1], data.chunksize[1]))
+    x_chunks = _chunks(dst.shape.x, chunks.get(dims[2], data.chunksize[2]))
+    blocks = []
+    for rows in y_chunks:
+        blocks.append([])
+        for cols in x_chunks:
+            block = plan.block(rows, cols)
+            shape = (block.dst.shape.y, block.dst.shape.x)
+            if not block.valid.any():
+                blocks[-1].append(
+                    da.full(
+                        (data.shape[0],) + shape,
+                        nodata,
+                        dtype=data.dtype,
+                        chunks=(data.chunks[0],) + shape,
+                    )
+                )
+                continue
+            source = data[:, block.window[0], block.window[1]].rechunk({1: -1, 2: -1})
+            blocks[-1].append(
+                source.map_blocks(
+                    block.apply,
+                    nodata,
+                    dtype=data.dtype,
+                    chunks=(data.chunks[0],) + shape,
+                )
+            )
+    return DataArray(da.block(blocks), coords=coords, dims=dims)
+
+
+def _chunks(size: int, chunk: int) -> list[slice]:
+    return [slice(start, min(start + chunk, size)) for start in range(0, size, chunk)]
+
+
+def _grid_key(geobox: GeoBox) -> tuple:
+    """What geoboxes on the same pixel grid, i.e. with the same CRS,
+    resolution and alignment, have in common."""
+    return geobox.crs, geobox.resolution, geobox.alignment
+
+
+class PlannedOdcLoader:
+    """Loads items onto the area like `OdcLoader`, with nearest neighbour
+    resampling, but reads each pixel grid among the items natively (which
+    needs no warping) and gathers them onto the area with a cached
+    `ReprojectionPlan`. Items which don't record their pixel grid are loaded
+    by `odc.stac.load` directly. `kwargs` are passed to `odc.stac.load`."""
+
+    def __init__(self, nodata=1, **kwargs):
+        self._nodata = nodata
+        self._kwargs = kwargs
+
+    def load(self, items, area: GeoBox) -> Dataset:
+        grids = dict()
+        ungridded = []
+        for item in items:
+            geoboxes = odc.stac.parse_item(item).geoboxes()
+            if len(geoboxes) == 0:
+                ungridded.append(item)
+                continue
+            grids.setdefault(_grid_key(geoboxes[0]), (geoboxes[0], []))[1].append(item)
+
+        stacks = []
+        if len(ungridded) > 0:
+            stacks.append(
+                odc.stac.load(
+                    ungridded, geobox=area, resampling="nearest", **self._kwargs
+                )
+            )
+        for geobox, grid_items in grids.values():
+            src = geobox.enclosing(
+                area.extent.to_crs(geobox.crs).buffer(abs(geobox.resolution.x))
+            )
+            native = odc.stac.load(grid_items, geobox=src, **self._kwargs)
+            stacks.append(
+                Dataset(
+                    {
+                        name: reproject_stack(
+                            var, area, self._nodata, self._kwargs.get("chunks")
+                        )
+                        for name, var in native.data_vars.items()
+                    }
+                )
+            )
+        return xr.concat(stacks, dim="time").sortby("time")
@@ -0,0 +1,59 @@
+"""Resource limits and usage of the current container, read from cgroups.
+
+Both cgroup v2 and v1 are supported. Everything returns None when the value
+isn't available, e.g. when not running in a container.
+"""
+
+from pathlib import Path
+
+_CGROUP = Path("/sys/fs/cgroup")
+
+
+def _read_int(*paths: Path) -> int | None:
+    for path in paths:
+        try:
+            value = path.read_text().strip()
+        except OSError:
+            continue
+        # "max" in cgroup v2 and very large numbers in v1 both mean no limit
+        if value.isdigit() and int(value) < 2**60:
+            return int(value)
+    return None
+
+
+def memory_limit() -> int | None:
+    """The memory limit of the container, in bytes."""
+    return _read_int(
+        _CGROUP / "memory.max", _CGROUP / "memory" / "memory.limit_in_bytes"
+    )
+
+
+def memory_usage() -> int | None:
+    """Memory currently used by everything in the container, in bytes."""
+    return _read_int(
+        _CGROUP / "memory.current", _CGROUP / "memory" / "memory.usage_in_bytes"
+    )
+
+
+def memory_fraction_used() -> float | None:
+    limit = memory_limit()
+    usage = memory_usage()
+    if limit is None or usage is None:
+        return None
+    return usage / limit
+
+
+def cpu_limit() -> float | None:
+    """The number of CPUs the container may use, which may be fractional."""
+    try:
+        quota, period = (_CGROUP / "cpu.max").read_text().split()
+        if quota != "max":
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    quota = _read_int(_CGROUP / "cpu" / "cpu.cfs_quota_us")
+    period = _read_int(_CGROUP / "cpu" / "cpu.cfs_period_us")
+    if quota is None or period is None:
+        return None
+    return quota / period
@@ -0,0 +1,108 @@
+"""Cheap checks of a Landsat scene before its reflectance bands are loaded.
+
+Most of a Pacific path/row is ocean, and many scenes are mostly cloud, so
+loading every band at full extent reads a lot of data which is masked out
+later anyway. `useful_region` instead reads just the `qa_pixel` band at a
+coarse resolution (from the COG overviews) and finds the area that is both
+on land and not obscured, which the full load can then be cropped to.
+
+Overviews hold one sample per block of 30m pixels, which can miss the clear
+pixels over a small island or reef. Skipping or cropping away those pixels
+would leave nodata in the summaries where there were observations, so the
+coarse mask errs towards keeping pixels. A coarse pixel counts as clear if
+it or any of its neighbours is, and crops keep a margin. A scene is only
+skipped once its `qa_pixel` at full resolution, read over just its land,
+confirms it has no clear pixels there.
+"""
+
+import math
+
+import numpy as np
+import odc.stac
+from odc.geo.geobox import GeoBox
+from odc.geo.geom import Geometry
+from odc.geo.xr import rasterize
+
+from dep_wofs.mask import land_geometry
+
+# 16x the native 30m, so only overviews are read
+COARSE_RESOLUTION = 480
+
+# A scene which looks unusable at COARSE_RESOLUTION is checked again at the
+# native resolution, over just its land, before it's skipped
+CONFIRM_RESOLUTION = 30
+
+# How far beyond the useful area a crop extends, in metres
+CROP_MARGIN = 2 * COARSE_RESOLUTION
+
+# Collection 2 QA_PIXEL bits which mean a pixel can't be classified
+_FILL = 1 << 0
+_DILATED_CLOUD = 1 << 1
+_CLOUD = 1 << 3
+_CLOUD_SHADOW = 1 << 4
+_UNUSABLE = _FILL | _DILATED_CLOUD | _CLOUD | _CLOUD_SHADOW
+
+
+def _dilate(mask: np.ndarray) -> np.ndarray:
+    """`mask`, with every neighbour (including diagonals) of a True pixel
+    True too."""
+    padded = np.pad(mask, 1)
+    dilated = np.zeros_like(mask)
+    rows, cols = mask.shape
+    for dy in range(3):
+        for dx in range(3):
+            dilated |= padded[dy : dy + rows, dx : dx + cols]
+    return dilated
+
+
+def _useful_mask(
+    item, resolution: float, geopolygon: Geometry | None = None
+) -> tuple[np.ndarray | None, GeoBox]:
+    """Which pixels of `item` (within `geopolygon`, if given) at `resolution`
+    are on land and may be clear, and their geobox. The mask is None if
+    there's no land in the scene."""
+    qa = odc.stac.load(
+        [item],
+        bands=["qa_pixel"],
+        resolution=resolution,
+        geopolygon=geopolygon,
+        anchor="center",
+        dtype="uint16",
+        stac_cfg={"landsat-c2l2-sr": {"assets": {"qa_pixel": {"nodata": 1}}}},
+    ).qa_pixel.isel(time=0)
+    geobox = qa.odc.geobox
+
+    land = land_geometry(geobox)
+    if land.is_empty:
+        return None, geobox
+
+    # all_touched=True to match the land mask applied to the summaries
+    clear = _dilate((qa.values & _UNUSABLE) == 0)
+    return rasterize(land, geobox, all_touched=True).values & clear, geobox
+
+
+def useful_region(
+    item,
+    resolution: float = COARSE_RESOLUTION,
+    confirm_resolution: float = CONFIRM_RESOLUTION,
+) -> tuple[Geometry | None, str | None]:
+    """The area of `item` which is on land and may not be fill, cloud or
+    cloud shadow, padded by `CROP_MARGIN`, in the CRS of the scene. If there
+    is no such area, None and the reason why."""
+    useful, geobox = _useful_mask(item, resolution)
+    if useful is None:
+        return None, "no land in scene"
+    if not useful.any() and confirm_resolution < resolution:
+        land = land_geometry(geobox)
+        useful, geobox = _useful_mask(item, confirm_resolution, land)
+    if not useful.any():
+        return None, "no clear pixels over land"
+
+    rows = np.flatnonzero(useful.any(axis=1))
+    cols = np.flatnonzero(useful.any(axis=0))
+    margin = math.ceil(CROP_MARGIN / abs(geobox.resolution.x))
+    window = geobox[
+        max(rows[0] - margin, 0) : rows[-1] + margin + 1,
+        max(cols[0] - margin, 0) : cols[-1] + margin + 1,
+    ]
+    return window.extent, None
@@ -0,0 +1,172 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from typing import Callable
+
+import pandas as pd
+from odc.geo.geobox import GeoBox
+from odc.geo.geom import Geometry, unary_union
+from pystac import Catalog, ItemCollection
+from pystac_client import Modifiable
+
+from dep_tools.exceptions import EmptyCollectionError
+from dep_tools.searchers import PystacSearcher, Searcher
+
+
+class ItemsSearcher(Searcher):
+    """Returns items which were already found rather than searching."""
+
+    def __init__(self, items):
+        self._items = items
+
+    def search(self, area):
+        return self._items
+
+
+def is_static_catalog(catalog: str) -> bool:
+    """Whether `catalog` is a static catalog rather than a STAC API."""
+    return catalog.endswith(".json") or not catalog.startswith(("http://", "https://"))
+
+
+def _datetime_range(datetime: str) -> tuple[pd.Timestamp, pd.Timestamp]:
+    """The first and last instants of `datetime`, e.g. "2020" or
+    "2015/2020-06", in UTC."""
+    start, _, end = datetime.partition("/")
+    return (
+        pd.Period(start).start_time.tz_localize("UTC"),
+        pd.Period(end or start).end_time.tz_localize("UTC"),
+    )
+
+
+def _area_geometry(area) -> Geometry:
+    """`area`, a GeoBox or GeoDataFrame, in EPSG:4326. An area which crosses
+    the antimeridian is split there, rather than spanning every longitude."""
+    if isinstance(area, GeoBox):
+        return area.extent.to_crs("EPSG:4326", wrapdateline=True)
+    return unary_union(
+        [
+            Geometry(geometry, area.crs).to_crs("EPSG:4326", wrapdateline=True)
+            for geometry in area.geometry
+        ]
+    )
+
+
+def use_alternate_s3_href(modifiable: Modifiable) -> None:
+    """Replace the href of each asset with its S3 alternate. Responses are
+    modified as plain dicts, without building pystac objects from them."""
+    if isinstance(modifiable, dict):
+        if modifiable.get("type") == "FeatureCollection":
+            features = modifiable["features"]
+        else:
+            features = [modifiable]
+        for feature in features:
+            for asset in feature.get("assets", {}).values():
+                href = asset.get("alternate", {}).get("s3", {}).get("href")
+                if href is not None:
+                    asset["href"] = href
+    else:
+        for _, asset in modifiable.assets.items():
+            asset_dict = asset.to_dict()
+            if "alternate" in asset_dict.keys():
+                asset.href = asset.to_dict()["alternate"]["s3"]["href"]
+
+
+class StaticCatalogSearcher(Searcher):
+    """Searches a static catalog (the path or URL of a catalog.json) the way
+    PystacSearcher searches a STAC API, by collection, datetime, intersection
+    with the area and a `query` of `{property: {"eq": value}}`. Every item is
+    read, so this is only suitable for small catalogs, like those made for
+    local runs. Areas which cross the antimeridian aren't handled."""
+
+    def __init__(
+        self,
+        catalog: str,
+        collections: list[str] | None = None,
+        datetime: str | None = None,
+        query: dict | None = None,
+    ):
+        self._catalog = catalog
+        self._collections = collections
+        self._datetime = datetime
+        self._query = query if query is not None else dict()
+
+    @cached_property
+    def _items(self) -> list:
+        return list(Catalog.from_file(self._catalog).get_items(recursive=True))
+
+    def _matches(self, item, area: Geometry) -> bool:
+        if (
+            self._collections is not None
+            and item.collection_id not in self._collections
+        ):
+            return False
+        if self._datetime is not None:
+            start, end = _datetime_range(self._datetime)
+            item_start = item.datetime or item.common_metadata.start_datetime
+            item_end = item.datetime or item.common_metadata.end_datetime
+            if item_end < start or item_start > end:
+                return False
+        if any(
+            item.properties.get(name) != condition["eq"]
+            for name, condition in self._query.items()
+        ):
+            return False
+        return Geometry(item.geometry, "EPSG:4326").intersects(area)
+
+    def search(self, area) -> ItemCollection:
+        area = _area_geometry(area)
+        items = [item for item in self._items if self._matches(item, area)]
+        if len(items) == 0:
+            raise EmptyCollectionError()
+        return ItemCollection(items)
+
+
+def catalog_searcher(catalog: str, **kwargs) -> Searcher:
+    """A PystacSearcher for `catalog`, or a StaticCatalogSearcher if it's a
+    static catalog."""
+    if is_static_catalog(catalog):
+        return StaticCatalogSearcher(catalog, **kwargs)
+    return PystacSearcher(catalog=catalog, **kwargs)
+
+
+def year_windows(datetime: str) -> list[str]:
+    """`datetime` split into whole years, e.g. "2013/2015" into "2013", "2014"
+    and "2015". Anything but a year or range of years is left as it is."""
+    start, _, end = datetime.partition("/")
+    end = end or start
+    if not all(len(year) == 4 and year.isdigit() for year in [start, end]):
+        return [datetime]
+    return [str(year) for year in range(int(start), int(end) + 1)]
+
+
+class WindowedSearcher(Searcher):
+    """Splits a search over `datetime` into a search per year (see
+    `year_windows`), each made by `make_searcher(window)`, and runs them
+    concurrently. Long ranges then take about as long as a single year rather
+    than paging through every result in turn."""
+
+    def __init__(
+        self,
+        make_searcher: Callable[[str], Searcher],
+        datetime: str,
+        max_workers: int = 8,
+    ):
+        self._make_searcher = make_searcher
+        self._windows = year_windows(datetime)
+        self._max_workers = max_workers
+
+    def search(self, area) -> ItemCollection:
+        def search_window(window: str) -> list:
+            try:
+                return list(self._make_searcher(window).search(area))
+            except EmptyCollectionError:
+                return []
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            results = list(executor.map(search_window, self._windows))
+
+        # Windows don't overlap, but items are deduplicated in case a
+        # searcher pads its window
+        items = {item.id: item for window_items in results for item in window_items}
+        if len(items) == 0:
+            raise EmptyCollectionError()
+        return ItemCollection(items.values())
@@ -0,0 +1,132 @@
+"""A local cache of STAC API responses.
+
+Every path/row and year searches landsatlook afresh, although the results for
+past years hardly ever change, and the same searches are repeated by retries
+and by each of the pods of a run which share a node. `CachingStacApiIO`
+keeps each response on disk, keyed by the request (so by collection, query,
+datetime window and page), and serves it while it's younger than `ttl`
+seconds. Older responses are revalidated with their ETag, if the server gave
+one, rather than downloaded again.
+
+The cache is an HTTPAdapter mounted on the StacApiIO's session, so requests
+are still made and checked by `StacApiIO.request` itself.
+"""
+
+import hashlib
+import io
+import json
+import time
+from pathlib import Path
+
+from pystac_client.stac_api_io import StacApiIO
+from requests import PreparedRequest, Response
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+
+from dep_wofs.config import STAC_CACHE_DIR, STAC_CACHE_TTL
+
+
+def request_key(request: PreparedRequest) -> str:
+    body = request.body.decode() if isinstance(request.body, bytes) else request.body
+    return hashlib.sha256(
+        json.dumps([request.method, request.url, body]).encode()
+    ).hexdigest()
+
+
+class CachingAdapter(HTTPAdapter):
+    """An HTTPAdapter which caches successful responses in `cache_dir`."""
+
+    def __init__(
+        self,
+        cache_dir: Path | str = STAC_CACHE_DIR,
+        ttl: float = STAC_CACHE_TTL,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self._cache_dir = Path(cache_dir)
+        self._ttl = ttl
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    def _read(self, key: str) -> dict | None:
+        try:
+            return json.loads((self._cache_dir / f"{key}.json").read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key: str, entry: dict) -> None:
+        # Written to a temporary file and renamed so readers in other
+        # processes never see a partial entry
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._cache_dir / f"{key}.{time.monotonic_ns()}.tmp"
+        tmp_path.write_text(json.dumps(entry))
+        tmp_path.replace(self._cache_dir / f"{key}.json")
+
+    def _cached(self, request: PreparedRequest, entry: dict) -> Response:
+        raw = HTTPResponse(
+            body=io.BytesIO(entry["body"].encode("utf-8")),
+            headers={"Content-Type": entry.get("content_type") or "application/json"},
+            status=200,
+            preload_content=False,
+        )
+        return self.build_response(request, raw)
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        key = request_key(request)
+        entry = self._read(key)
+        if entry is not None and time.time() - entry["fetched"] < self._ttl:
+            self.hits += 1
+            return self._cached(request, entry)
+
+        if entry is not None and entry.get("etag") is not None:
+            request.headers["If-None-Match"] = entry["etag"]
+        response = super().send(request, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.revalidations += 1
+            entry["fetched"] = time.time()
+            self._write(key, entry)
+            return self._cached(request, entry)
+        if response.status_code == 200:
+            self.misses += 1
+            self._write(
+                key,
+                dict(
+                    body=response.content.decode("utf-8"),
+                    etag=response.headers.get("ETag"),
+                    content_type=response.headers.get("Content-Type"),
+                    fetched=time.time(),
+                ),
+            )
+        # Errors are left to StacApiIO to raise
+        return response
+
+
+class CachingStacApiIO(StacApiIO):
+    """A StacApiIO whose session caches responses in `cache_dir`. Pass it to
+    `pystac_client.Client.open` as `stac_io`."""
+
+    def __init__(
+        self,
+        cache_dir: Path | str = STAC_CACHE_DIR,
+        ttl: float = STAC_CACHE_TTL,
+        max_retries: int | None = 5,
+        **kwargs,
+    ):
+        super().__init__(max_retries=max_retries, **kwargs)
+        self.cache = CachingAdapter(cache_dir, ttl, max_retries=max_retries or 0)
+        self.session.mount("http://", self.cache)
+        self.session.mount("https://", self.cache)
+
+    @property
+    def hits(self) -> int:
+        return self.cache.hits
+
+    @property
+    def revalidations(self) -> int:
+        return self.cache.revalidations
+
+    @property
+    def misses(self) -> int:
+        return self.cache.misses
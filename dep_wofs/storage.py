@@ -0,0 +1,123 @@
+"""Small helpers for reading and writing objects in the output bucket.
+
+If `S3_ENDPOINT_URL` is set, everything goes to that object store instead of
+AWS: clients made here use it directly, and `configure_s3_endpoint` points
+the clients made by dep-tools, cloud-logger and GDAL at it too.
+"""
+
+import os
+import re
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+from dep_wofs.config import S3_ENDPOINT_URL
+
+# Virtual hosted style URLs of objects in S3, e.g.
+# https://dep-public-data.s3.us-west-2.amazonaws.com/dep_ls_wofs/...
+_S3_HTTPS_HREF = re.compile(r"https://([^./]+)\.s3[.\w-]*\.amazonaws\.com/(.+)")
+
+
+def s3_client():
+    return boto3.client("s3", endpoint_url=S3_ENDPOINT_URL)
+
+
+def s3_storage_options() -> dict | None:
+    """Options for fsspec (s3fs) to reach the bucket, e.g. for Zarr stores."""
+    return None if S3_ENDPOINT_URL is None else dict(endpoint_url=S3_ENDPOINT_URL)
+
+
+def configure_s3_endpoint() -> None:
+    """Send all S3 requests made in this process (and its dask workers) to
+    `S3_ENDPOINT_URL`, if it's set."""
+    if S3_ENDPOINT_URL is None:
+        return
+    endpoint = urlparse(S3_ENDPOINT_URL)
+    os.environ["AWS_ENDPOINT_URL_S3"] = S3_ENDPOINT_URL
+    # GDAL, for reading and writing COGs
+    os.environ["AWS_S3_ENDPOINT"] = endpoint.netloc
+    os.environ["AWS_HTTPS"] = "YES" if endpoint.scheme == "https" else "NO"
+    os.environ["AWS_VIRTUAL_HOSTING"] = "FALSE"
+
+
+def read_bytes(bucket: str, key: str, client=None) -> bytes | None:
+    """The contents of s3://`bucket`/`key`, or None if it doesn't exist."""
+    client = client if client is not None else s3_client()
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        raise e
+    return response["Body"].read()
+
+
+def write_bytes(data: bytes, bucket: str, key: str, client=None) -> None:
+    client = client if client is not None else s3_client()
+    client.put_object(Bucket=bucket, Key=key, Body=data)
+
+
+def s3_location(href: str) -> tuple[str, str] | None:
+    """The bucket and key of `href`, an s3:// URL or a virtual hosted style
+    https URL, or None if it isn't in S3."""
+    parsed = urlparse(href)
+    if parsed.scheme == "s3":
+        return parsed.netloc, parsed.path.lstrip("/")
+    match = _S3_HTTPS_HREF.fullmatch(href)
+    return None if match is None else (match[1], match[2])
+
+
+def object_version(bucket: str, key: str, client=None) -> str | None:
+    """Something which changes whenever s3://`bucket`/`key` is rewritten: its
+    ETag, or failing that when it was last modified. None if it doesn't
+    exist."""
+    client = client if client is not None else s3_client()
+    try:
+        response = client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        raise e
+    if "ETag" in response:
+        return response["ETag"]
+    return response["LastModified"].isoformat()
+
+
+def delete_key(bucket: str, key: str, client=None) -> None:
+    """Delete s3://`bucket`/`key`, if it exists."""
+    client = client if client is not None else s3_client()
+    client.delete_object(Bucket=bucket, Key=key)
+
+
+def list_keys(bucket: str, prefix: str, client=None) -> set[str]:
+    """All keys under `prefix`, from a single paginated listing."""
+    client = client if client is not None else s3_client()
+    paginator = client.get_paginator("list_objects_v2")
+    return {
+        object["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for object in page.get("Contents", [])
+    }
+
+
+def read_bytes_from(
+    bucket: str, key: str, start: int, client=None, etag: str | None = None
+) -> tuple[bytes, int, str | None] | None:
+    """The contents of s3://`bucket`/`key` from byte `start` on, the size of
+    the object and its ETag, or None if it doesn't exist. If the object is no
+    longer than `start`, or its ETag is still `etag`, the contents are
+    empty."""
+    client = client if client is not None else s3_client()
+    try:
+        head = client.head_object(Bucket=bucket, Key=key)
+        size, current = head["ContentLength"], head.get("ETag")
+        if size <= start or (etag is not None and current == etag):
+            return b"", size, current
+        response = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-")
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        raise e
+    data = response["Body"].read()
+    return data, start + len(data), response.get("ETag")
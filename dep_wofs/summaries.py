@@ -0,0 +1,178 @@
+"""Summaries of WOfS feature layers (WOfLs).
+
+These produce the same output as `odc.stats.plugins.wofs.StatsWofs`, but do it
+in a single pass over the `(time, y, x)` stack of WOfLs. `StatsWofs` needs its
+`native_transform` applied to each time step before `reduce` is called, which
+builds a separate graph per time step and several full-size boolean
+intermediates per WOfL. Here each block of WOfLs is decoded straight into
+int16 counts.
+
+The counts are kept separately from the final summary so they can be summed,
+e.g. when folding new WOfLs into an existing summary, or when a long time
+series is counted in batches (`batched_wofs_counts`). The same split is used
+for all-time summaries built from annual ones, which are accumulated as int32
+so adding years can't overflow.
+"""
+
+import warnings
+
+import dask.array as da
+import numpy as np
+from dask import is_dask_collection
+from xarray import DataArray, Dataset, where
+
+WOFS_NODATA = -999
+
+# Values of the WOfL bitmask, see `StatsWofs.native_transform`
+_WET = 128
+_NODATA_BIT = 1
+_NOT_WET_BITS = 127
+
+COUNTS = ["count_wet", "count_clear", "count_some"]
+
+
+def _count_block(water: np.ndarray) -> np.ndarray:
+    """Wet, clear and "some" (anything but nodata) counts for a
+    `(time, y, x)` block of WOfLs, as a `(1, 3, y, x)` array. Time steps are
+    folded in one at a time so intermediates are never larger than one layer."""
+    counts = np.zeros((1, len(COUNTS)) + water.shape[1:], dtype="int16")
+    count_wet, count_clear, count_some = counts[0]
+    for layer in water:
+        # wet is 128 exactly, dry is 0 exactly, anything else with the nodata
+        # bit unset is "bad", i.e. obscured by cloud, shadow, terrain etc.
+        count_wet += layer == _WET
+        count_clear += (layer & _NOT_WET_BITS) == 0
+        count_some += (layer & _NODATA_BIT) == 0
+    return counts
+
+
+def wofs_counts(water: DataArray) -> Dataset:
+    """Count wet, clear and observed ("some") pixels in a time series of WOfL
+    bitmasks. Counts are int16, with no nodata value."""
+    water = water.transpose("time", ...)
+    data = water.data
+    if is_dask_collection(data):
+        partial_counts = da.map_blocks(
+            _count_block,
+            data,
+            dtype="int16",
+            new_axis=1,
+            chunks=((1,) * data.numblocks[0], (len(COUNTS),), *data.chunks[1:]),
+        )
+        counts = partial_counts.sum(axis=0, dtype="int16")
+    else:
+        counts = _count_block(np.asarray(data))[0]
+
+    template = water.isel(time=0, drop=True)
+    return Dataset(
+        {
+            name: DataArray(counts[i], coords=template.coords, dims=template.dims)
+            for i, name in enumerate(COUNTS)
+        }
+    )
+
+
+def time_batches(data, time_batch: int):
+    """Consecutive batches of `time_batch` time steps of `data`, each with
+    the first time of the next batch (None for the last one), which
+    everything in the batch comes before."""
+    times = data.time.values
+    for start in range(0, len(times), time_batch):
+        stop = start + time_batch
+        until = times[stop] if stop < len(times) else None
+        yield data.isel(time=slice(start, stop)), until
+
+
+def batched_wofs_counts(water: DataArray, time_batch: int) -> Dataset:
+    """`wofs_counts`, computed for `time_batch` time steps of `water` at a
+    time and summed into running totals. Only one batch of WOfLs is loaded at
+    once, so memory is bounded by the batch size rather than the length of the
+    time series. The counts returned are computed."""
+    totals = None
+    for batch, _ in time_batches(water.transpose("time", ...), time_batch):
+        if is_dask_collection(batch):
+            # One block of counts per spatial chunk, rather than per WOfL
+            batch = batch.chunk(time=-1)
+        counts = wofs_counts(batch).compute()
+        if totals is None:
+            totals = counts
+        else:
+            for name in COUNTS:
+                totals[name].values += counts[name].values
+    return totals
+
+
+def wofs_summary(counts: Dataset) -> Dataset:
+    """Turn the output of `wofs_counts` into "count_wet", "count_clear" and
+    "frequency" variables, identical to those from `StatsWofs.reduce`."""
+    count_wet = counts.count_wet
+    count_clear = counts.count_clear
+
+    frequency = where(
+        count_clear == 0,
+        np.float32(np.nan),
+        count_wet.astype("float32") / np.maximum(count_clear, 1).astype("float32"),
+    )
+    frequency.attrs["nodata"] = np.nan
+
+    # Pixels which were never observed at all are nodata rather than 0
+    is_ok = counts.count_some > 0
+    count_wet = count_wet.where(is_ok, np.int16(WOFS_NODATA))
+    count_wet.attrs["nodata"] = WOFS_NODATA
+    count_clear = count_clear.where(is_ok, np.int16(WOFS_NODATA))
+    count_clear.attrs["nodata"] = WOFS_NODATA
+
+    return Dataset(
+        {"count_wet": count_wet, "count_clear": count_clear, "frequency": frequency}
+    )
+
+
+def full_history_counts(annuals: Dataset) -> Dataset:
+    """Sum a time series of annual summaries into int32 "count_wet" and
+    "count_clear" totals, ignoring nodata, plus "count_observed", the number of
+    annual summaries with data for each pixel."""
+    nodata = annuals.count_clear.attrs.get("nodata", WOFS_NODATA)
+    has_data = annuals.count_clear != nodata
+    return Dataset(
+        {
+            "count_wet": annuals.count_wet.where(
+                annuals.count_wet != nodata, np.int16(0)
+            ).sum("time", dtype="int32"),
+            "count_clear": annuals.count_clear.where(has_data, np.int16(0)).sum(
+                "time", dtype="int32"
+            ),
+            "count_observed": has_data.sum("time", dtype="int16"),
+        }
+    )
+
+
+def full_history_summary(counts: Dataset) -> Dataset:
+    """Turn the output of `full_history_counts` into "count_clear",
+    "count_wet" and "frequency" variables, matching those from
+    `StatsWofsFullHistory.reduce`. Counts are accumulated as int32 but stored
+    as int16, so totals which don't fit are clipped."""
+    int16_max = np.iinfo("int16").max
+    if (counts.count_clear > int16_max).any():
+        warnings.warn("count_clear exceeds the int16 range and has been clipped")
+
+    count_clear = counts.count_clear
+    count_wet = counts.count_wet
+    frequency = where(
+        count_clear == 0,
+        np.float32(np.nan),
+        count_wet.astype("float32") / np.maximum(count_clear, 1).astype("float32"),
+    )
+    frequency.attrs["nodata"] = np.nan
+
+    missing = counts.count_observed == 0
+    nodata = np.int16(WOFS_NODATA)
+    count_clear = where(missing, nodata, count_clear.clip(max=int16_max)).astype(
+        "int16"
+    )
+    count_clear.attrs["nodata"] = WOFS_NODATA
+    count_wet = where(missing, nodata, count_wet.clip(max=int16_max)).astype("int16")
+    count_wet.attrs["nodata"] = WOFS_NODATA
+
+    return Dataset(
+        {"count_clear": count_clear, "count_wet": count_wet, "frequency": frequency}
+    )
@@ -0,0 +1,206 @@
+"""A compacted copy of the task logs written by `CsvLogger`.
+
+Finding which tasks still need to run used to mean downloading and parsing
+each year's log in full, which gets slower as the logs grow. `TaskState`
+instead keeps the status of every task in each log in SQLite, along with how
+much of each log has been read, so only lines appended since the last
+refresh are fetched (concurrently, with ranged reads). The database is
+itself stored in the bucket so the next run starts from it.
+
+Appending to a log in S3 rewrites it, so its ETag changes whether it was
+appended to or replaced. Logs whose ETag hasn't changed aren't read at all,
+and the last `_TAIL` bytes read of each log are kept to tell the two apart:
+the ranged read starts that far before the offset, and if those bytes
+differ the log was replaced and is read from scratch.
+"""
+
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from dep_wofs.config import TASK_STATE_PATH
+from dep_wofs.storage import read_bytes, read_bytes_from, s3_client, write_bytes
+
+_ERROR_STATUS = "error"
+# Statuses which say nothing about whether the task as a whole finished, like
+# scenes of a path/row being skipped
+_IGNORED_STATUSES = {"skipped"}
+
+_TAIL = 64
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (
+    key TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    etag TEXT,
+    tail BLOB
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    key TEXT NOT NULL,
+    task TEXT NOT NULL,
+    status TEXT NOT NULL,
+    done INTEGER NOT NULL,
+    errored INTEGER NOT NULL,
+    PRIMARY KEY (key, task)
+);
+"""
+
+_UPSERT = """
+INSERT INTO tasks VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (key, task) DO UPDATE SET
+    status = excluded.status,
+    done = max(done, excluded.done),
+    errored = max(errored, excluded.errored)
+"""
+
+
+def task_key(index) -> str:
+    """How a task is identified in the state, e.g. "63,20" for tile (63, 20)."""
+    return ",".join(str(i) for i in index)
+
+
+def parse_log_lines(data: bytes) -> dict[str, tuple[str, bool, bool]]:
+    """The last status of each task in `data`, a chunk of complete log lines,
+    and whether any line marked it done (i.e. any status but an error) or
+    errored."""
+    tasks = dict()
+    for line in data.decode().splitlines():
+        fields = line.split("|", 3)
+        if len(fields) < 3 or not fields[1].startswith("("):
+            # The header, or the rest of a multi-line error message
+            continue
+        task = fields[1].strip("()").replace(" ", "")
+        status = fields[2]
+        _, done, errored = tasks.get(task, (None, False, False))
+        tasks[task] = (
+            status,
+            done or (status != _ERROR_STATUS and status not in _IGNORED_STATUSES),
+            errored or status == _ERROR_STATUS,
+        )
+    return tasks
+
+
+class TaskState:
+    """Task statuses from any number of logs, keyed by the S3 key of the log,
+    in a SQLite database at `path`."""
+
+    def __init__(self, path: Path | str = TASK_STATE_PATH):
+        self._path = Path(path)
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(self._path)
+        self._db.executescript(_SCHEMA)
+        # States saved before the ETag and tail were kept
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(logs)")}
+        with self._db:
+            for column, kind in [("etag", "TEXT"), ("tail", "BLOB")]:
+                if column not in columns:
+                    self._db.execute(f"ALTER TABLE logs ADD COLUMN {column} {kind}")
+
+    @classmethod
+    def download(
+        cls, bucket: str, key: str, path: Path | str = TASK_STATE_PATH, client=None
+    ) -> "TaskState":
+        """The state stored at s3://`bucket`/`key`, or an empty one."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = read_bytes(bucket, key, client)
+        if data is not None:
+            path.write_bytes(data)
+        else:
+            path.unlink(missing_ok=True)
+        return cls(path)
+
+    def upload(self, bucket: str, key: str, client=None) -> None:
+        self._db.commit()
+        write_bytes(self._path.read_bytes(), bucket, key, client)
+
+    def offset(self, log_key: str) -> int:
+        """How many bytes of the log have been read."""
+        return self._log(log_key)[0]
+
+    def _log(self, log_key: str) -> tuple[int, str | None, bytes | None]:
+        """How many bytes of the log have been read, its ETag when they were
+        and the last of those bytes."""
+        row = self._db.execute(
+            "SELECT offset, etag, tail FROM logs WHERE key = ?", (log_key,)
+        ).fetchone()
+        return tuple(row) if row is not None else (0, None, b"")
+
+    def reset(self, log_key: str) -> None:
+        with self._db:
+            self._db.execute("DELETE FROM logs WHERE key = ?", (log_key,))
+            self._db.execute("DELETE FROM tasks WHERE key = ?", (log_key,))
+
+    def update(
+        self, log_key: str, data: bytes, size: int, etag: str | None = None
+    ) -> None:
+        """Add `data`, the log from the current offset up to `size` bytes,
+        when its ETag was `etag`. A partial last line is left to be read next
+        time."""
+        end = data.rfind(b"\n") + 1
+        _, _, tail = self._log(log_key)
+        tail = ((tail or b"") + data[:end])[-_TAIL:]
+        tasks = parse_log_lines(data[:end])
+        with self._db:
+            self._db.executemany(
+                _UPSERT,
+                (
+                    (log_key, task, status, done, errored)
+                    for task, (status, done, errored) in tasks.items()
+                ),
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?)",
+                (log_key, size - len(data) + end, etag, tail),
+            )
+
+    def refresh(
+        self, bucket: str, log_keys: list[str], client=None, max_workers: int = 8
+    ) -> None:
+        """Read whatever has been appended to each log since the last refresh.
+        Logs which have been deleted or replaced are read from scratch."""
+        client = client if client is not None else s3_client()
+        logs = {log_key: self._log(log_key) for log_key in log_keys}
+
+        def fetch(log_key):
+            offset, etag, tail = logs[log_key]
+            if offset > 0 and tail is None:
+                # Read before tails were kept, so appends can't be told apart
+                # from replacements
+                return log_key, read_bytes_from(bucket, log_key, 0, client), True
+            contents = read_bytes_from(
+                bucket, log_key, offset - len(tail), client, etag
+            )
+            if contents is None:
+                return log_key, None, True
+            data, size, current = contents
+            if etag is not None and current == etag:
+                return log_key, None, False
+            if size < offset or not data.startswith(tail):
+                return log_key, read_bytes_from(bucket, log_key, 0, client), True
+            return log_key, (data[len(tail) :], size, current), False
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for log_key, contents, replaced in executor.map(fetch, log_keys):
+                if replaced:
+                    self.reset(log_key)
+                if contents is not None:
+                    self.update(log_key, *contents)
+
+    def finished(self, log_key: str, retry_errors: bool = True) -> set[str]:
+        """Tasks in the log which shouldn't be run again: those that are done,
+        and, unless `retry_errors`, those with errors."""
+        rows = self._db.execute(
+            "SELECT task FROM tasks WHERE key = ? AND (done OR (errored AND ?))",
+            (log_key, not retry_errors),
+        )
+        return {task for (task,) in rows}
+
+    def filter(
+        self, grid: pd.DataFrame, log_key: str, retry_errors: bool = True
+    ) -> pd.DataFrame:
+        """The rows of `grid` whose tasks still need to be run."""
+        finished = self.finished(log_key, retry_errors)
+        return grid[[task_key(index) not in finished for index in grid.index]]
@@ -0,0 +1,142 @@
+"""A long running worker which processes many tiles in one process.
+
+Running each tile in its own pod means paying for the image pull, imports,
+dask cluster startup and loading of the grids and caches every time, which
+for small tiles takes longer than the processing. This instead reads tasks,
+in the format `print_tasks.py` writes (a JSON list, newline delimited JSON,
+batches or the S3 URIs of shards), from stdin or a file and runs them one
+after another with everything kept warm. The time taken by each task is
+reported as a line of JSON.
+
+    python dep_wofs/print_tasks.py --datetime 2020 --version 0.2.0 --ndjson True \\
+        | python dep_wofs/worker.py wofs --version 0.2.0
+"""
+
+import json
+import sys
+import time
+import traceback
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from typer import Argument, Exit, Option, run
+from typing_extensions import Annotated
+
+from dep_wofs import (
+    process_wofls_tile,
+    process_wofs_full_history_tile,
+    process_wofs_tile,
+)
+from dep_wofs.cluster import SCHEDULERS, dask_scheduler
+from dep_wofs.process_wofs_tile import bool_parser
+from dep_wofs.storage import configure_s3_endpoint, read_bytes, s3_location
+
+PROCESSORS = dict(
+    wofls=process_wofls_tile.process_tile,
+    wofs=process_wofs_tile.process_tile,
+    wofs_full_history=process_wofs_full_history_tile.process_tile,
+)
+
+
+def read_tasks(lines: Iterable[str]) -> Iterator[dict]:
+    """Tasks from `lines` of JSON, each a task, a list of tasks, a batch
+    (`{"batch": <JSON list of tasks>}`) or a shard (`{"shard": <S3 URI or
+    path>}`)."""
+    for line in lines:
+        if line.strip() == "":
+            continue
+        parsed = json.loads(line)
+        for task in parsed if isinstance(parsed, list) else [parsed]:
+            if "batch" in task:
+                yield from json.loads(task["batch"])
+            elif "shard" in task:
+                yield from read_tasks(read_shard(task["shard"]))
+            else:
+                yield task
+
+
+def read_shard(uri: str) -> list[str]:
+    """The lines of the shard at `uri`, in the bucket or a local file."""
+    location = s3_location(uri)
+    if location is None:
+        with open(uri) as shard:
+            return shard.readlines()
+    data = read_bytes(*location)
+    if data is None:
+        raise FileNotFoundError(uri)
+    return data.decode().splitlines()
+
+
+def report(**fields) -> None:
+    print(json.dumps(fields), flush=True)
+
+
+def main(
+    kind: Annotated[str, Argument(help=f"One of {', '.join(PROCESSORS)}")],
+    version: Annotated[str, Option()],
+    tasks: Annotated[
+        Optional[Path], Option(help="A file of tasks, read from stdin if not given")
+    ] = None,
+    dataset_id: Optional[str] = None,
+    incremental: Annotated[Optional[str], Option(parser=bool_parser)] = None,
+    verify: Annotated[Optional[str], Option(parser=bool_parser)] = None,
+    concurrency: Optional[int] = None,
+    cube: Annotated[Optional[str], Option(parser=bool_parser)] = None,
+    cube_version: Optional[str] = None,
+    time_batch: Optional[int] = None,
+    checkpoint: Annotated[Optional[str], Option(parser=bool_parser)] = None,
+    screen: Annotated[Optional[str], Option(parser=bool_parser)] = None,
+    scheduler: Annotated[
+        str,
+        Option(help=f"The dask scheduler, one of {', '.join(SCHEDULERS)}"),
+    ] = "distributed",
+) -> None:
+    process_tile = PROCESSORS[kind]
+    # Only what was given, so the defaults of each kind of task apply
+    kwargs = {
+        name: value
+        for name, value in dict(
+            dataset_id=dataset_id,
+            incremental=incremental,
+            verify=verify,
+            concurrency=concurrency,
+            cube=cube,
+            cube_version=cube_version,
+            time_batch=time_batch,
+            checkpoint=checkpoint,
+            screen=screen,
+        ).items()
+        if value is not None
+    }
+
+    # Before the cluster starts, so its workers get the same configuration
+    configure_s3_endpoint()
+    n_tasks = n_errors = 0
+    worker_start = time.perf_counter()
+    with (
+        open(tasks) if tasks is not None else sys.stdin as src,
+        dask_scheduler(scheduler),
+    ):
+        for task in read_tasks(src):
+            start = time.perf_counter()
+            try:
+                process_tile(**task, version=version, **kwargs)
+                status = "complete"
+            except Exception:
+                traceback.print_exc()
+                status = "error"
+                n_errors += 1
+            n_tasks += 1
+            report(task=task, status=status, seconds=time.perf_counter() - start)
+
+    report(
+        tasks=n_tasks,
+        errors=n_errors,
+        seconds=time.perf_counter() - worker_start,
+    )
+    if n_errors > 0:
+        raise Exit(code=1)
+
+
+if __name__ == "__main__":
+    run(main)